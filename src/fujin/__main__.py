@@ -14,6 +14,7 @@ from fujin.commands.init import Init
 from fujin.commands.prune import Prune
 from fujin.commands.rollback import Rollback
 from fujin.commands.server import Server
+from fujin.commands.stats import Stats
 from fujin.commands.up import Up
 from fujin.commands.printenv import Printenv
 
@@ -37,6 +38,7 @@ class Fujin:
         | Rollback
         | Prune
         | Printenv
+        | Stats
     ]
 
 
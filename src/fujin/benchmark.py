@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import socket
+from contextlib import ExitStack
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import cappa
+import msgspec
+from rich.table import Table
+
+from fujin.config import Config
+from fujin.connection import Connection
+from fujin.loadgen import WindowStats
+from fujin.localstate import ignored_dir
+
+
+class BenchRecord(msgspec.Struct, kw_only=True):
+    timestamp: float
+    app: str
+    host: str
+    version: str
+    target: str
+    paths: list[str]
+    concurrency: int
+    duration: float
+    requests: int
+    errors: int
+    throughput: float
+    p50: float | None = None
+    p95: float | None = None
+    p99: float | None = None
+
+
+def history_path(config: Config) -> Path:
+    return config.local_config_dir / "history" / "bench.jsonl"
+
+
+def append(path: Path, record: BenchRecord) -> None:
+    ignored_dir(path.parent)
+    with path.open("ab") as f:
+        f.write(msgspec.json.encode(record) + b"\n")
+
+
+def read(path: Path) -> list[BenchRecord]:
+    if not path.exists():
+        return []
+    decoder = msgspec.json.Decoder(BenchRecord)
+    records = []
+    for line in path.read_bytes().splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(decoder.decode(line))
+        except msgspec.DecodeError:
+            continue
+    return records
+
+
+def build_record(
+    config: Config,
+    *,
+    version: str,
+    target: str,
+    paths: list[str],
+    concurrency: int,
+    duration: float,
+    stats: WindowStats,
+    timestamp: float,
+) -> BenchRecord:
+    return BenchRecord(
+        timestamp=timestamp,
+        app=config.app_name,
+        host=config.host.ip,
+        version=version,
+        target=target,
+        paths=paths,
+        concurrency=concurrency,
+        duration=round(duration, 3),
+        requests=stats.requests,
+        errors=stats.errors,
+        throughput=round(stats.requests / duration, 2) if duration else 0.0,
+        p50=stats.p50,
+        p95=stats.p95,
+        p99=stats.p99,
+    )
+
+
+def find_baseline(
+    records: list[BenchRecord], record: BenchRecord, version: str
+) -> BenchRecord | None:
+    """Latest run of ``version`` with the same host, target and requested paths."""
+    matches = [
+        r
+        for r in records
+        if r.version == version
+        and r.host == record.host
+        and r.app == record.app
+        and r.target == record.target
+        and r.paths == record.paths
+    ]
+    return matches[-1] if matches else None
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def forwarded(conn: Connection, upstreams: list[str]) -> Iterator[list[str]]:
+    """Forward a local port to each ``host:port`` upstream through the ssh connection."""
+    if not hasattr(conn, "forward_local"):
+        # the app runs on this machine
+        yield [f"http://{upstream}" for upstream in upstreams]
+        return
+    with ExitStack() as stack:
+        urls = []
+        for upstream in upstreams:
+            host, _, port = upstream.rpartition(":")
+            local_port = _free_port()
+            stack.enter_context(
+                conn.forward_local(
+                    local_port, remote_port=int(port), remote_host=host or "localhost"
+                )
+            )
+            urls.append(f"http://127.0.0.1:{local_port}")
+        yield urls
+
+
+def tcp_upstreams(upstreams: list[str]) -> list[str]:
+    if any(u.startswith("unix/") for u in upstreams):
+        raise cappa.Exit(
+            "The web process listens on a unix socket that can't be forwarded, use --through-caddy",
+            code=1,
+        )
+    return upstreams
+
+
+def _ms(value: float | None) -> str:
+    return f"{value * 1000:.1f} ms" if value is not None else "-"
+
+
+def _change(before: float | None, after: float | None, lower_is_better: bool) -> str:
+    if not before or after is None:
+        return "-"
+    change = (after - before) / before
+    worse = change > 0 if lower_is_better else change < 0
+    text = f"{change:+.1%}"
+    # changes under 5% are within the noise of a short run
+    if abs(change) < 0.05:
+        return f"[dim]{text}[/dim]"
+    return f"[red]{text}[/red]" if worse else f"[green]{text}[/green]"
+
+
+def results_table(record: BenchRecord, baseline: BenchRecord | None = None) -> Table:
+    table = Table(
+        title=f"{record.app} v{record.version} via {record.target}",
+        header_style="bold cyan",
+    )
+    table.add_column("Metric")
+    if baseline:
+        table.add_column(f"v{baseline.version}", justify="right")
+    table.add_column(f"v{record.version}", justify="right")
+    if baseline:
+        table.add_column("Change", justify="right")
+    rows = [
+        ("Requests/s", "throughput", lambda v: f"{v:.1f}", False),
+        ("Errors", "errors", str, True),
+        ("p50", "p50", _ms, True),
+        ("p95", "p95", _ms, True),
+        ("p99", "p99", _ms, True),
+    ]
+    for label, field, fmt, lower_is_better in rows:
+        value = getattr(record, field)
+        current = fmt(value) if value is not None else "-"
+        if baseline:
+            before = getattr(baseline, field)
+            table.add_row(
+                label,
+                fmt(before) if before is not None else "-",
+                current,
+                _change(before, value, lower_is_better),
+            )
+        else:
+            table.add_row(label, current)
+    table.caption = (
+        f"{record.requests} requests, {record.concurrency} connections, "
+        f"{record.duration:.1f}s"
+    )
+    return table
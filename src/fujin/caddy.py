@@ -1,10 +1,20 @@
 from __future__ import annotations
 
 import json
+import shlex
 import urllib.request
+from contextlib import contextmanager
+from typing import Callable
+from typing import Iterator
 
+import cappa
+
+from fujin import trace
 from fujin.config import Config
+from fujin.config import next_color
 from fujin.connection import Connection
+from fujin.connection import host_connection
+from fujin.plan import echoed_hash
 
 DEFAULT_VERSION = "2.10.2"
 GH_TAR_FILENAME = "caddy_{version}_linux_amd64.tar.gz"
@@ -66,20 +76,145 @@ def uninstall(conn: Connection):
     conn.run("sudo rm -rf /etc/caddy", pty=True)
 
 
-def setup(conn: Connection, config: Config):
+@trace.span("caddy")
+def setup(conn: Connection, config: Config, current_hash: str | None = None):
     rendered_content = config.render_caddyfile()
+    if current_hash == echoed_hash(rendered_content):
+        # the site is already served with this exact configuration
+        return True
 
-    remote_path = config.caddy_config_path
+    return _write_and_reload(conn, config.caddy_config_path, rendered_content)
+
+
+def _write_and_reload(conn: Connection, path: str, content: str) -> bool:
     res = conn.run(
-        f"echo '{rendered_content}' | sudo tee {remote_path}",
-        hide="out",
+        f"echo '{content}' | sudo tee {path} > /dev/null "
+        "&& sudo systemctl reload caddy",
         pty=True,
         warn=True,
     )
-    conn.run("sudo systemctl reload caddy", pty=True, warn=True)
     return res.ok
 
 
+_READY = (
+    "ready() { code=$(curl -s -o /dev/null -w '%{http_code}' --max-time 2 \"$1\"); "
+    "case $code in 000|5*) return 1;; esac; }"
+)
+
+
+@trace.span("switch")
+def switch_color(
+    conn: Connection,
+    config: Config,
+    live: str | None,
+    on_ready: Callable[[str], None] | None = None,
+) -> tuple[str, int | None]:
+    """
+    Start the web instances of the idle color, wait until they answer, point Caddy at
+    them and stop the live color once its requests in flight had time to complete.
+    ``on_ready`` is called with the new color before it takes traffic.
+    Returns the color now serving the traffic and how long the Caddy reload took, in ms.
+    """
+    blue_green = config.webserver.blue_green
+    color = next_color(live)
+    new_units = " ".join(config.get_active_unit_names("web", color))
+    old_units = " ".join(config.get_active_unit_names("web", live)) if live else ""
+    checks = " && ".join(
+        f"ready {shlex.quote(f'http://{upstream}{blue_green.readiness_path}')}"
+        for upstream in config.get_web_upstreams(color)
+    )
+    with trace.span("readiness", color=color):
+        result = conn.run(
+            f"{_READY}; sudo systemctl restart {new_units} "
+            f"&& deadline=$(( $(date +%s) + {blue_green.readiness_timeout} )) "
+            f"&& until {checks}; do [ $(date +%s) -ge $deadline ] && exit 1; sleep 0.5; done",
+            warn=True,
+            hide=True,
+        )
+    if not result.ok:
+        conn.run(f"sudo systemctl stop {new_units}", warn=True, pty=True)
+        raise cappa.Exit(
+            f"The {color} instances were not ready after {blue_green.readiness_timeout}s, "
+            f"traffic stays on {live or 'the current instances'}",
+            code=1,
+        )
+    if on_ready:
+        on_ready(color)
+
+    # the reload gap is measured on the host, the stop of the old color is deferred
+    # by the grace period so that requests in flight complete
+    commands = [
+        "start=$(date +%s%N)",
+        f"echo '{config.render_caddyfile(color)}' | sudo tee {config.caddy_config_path} > /dev/null",
+        "sudo systemctl reload caddy",
+        'echo "::switched:: $(( ($(date +%s%N) - start) / 1000000 ))"',
+        f"echo {color} > {config.app_dir}/.color",
+        f"sudo systemctl enable {new_units}",
+    ]
+    if old_units:
+        commands += [
+            f"sleep {blue_green.grace_period}",
+            f"sudo systemctl disable --now {old_units}",
+        ]
+    with trace.span("switchover", color=color):
+        result = conn.run(" && ".join(commands), warn=True, pty=True)
+    gap = None
+    for line in str(result.stdout).splitlines():
+        if line.startswith("::switched::") and line.split()[-1].isdigit():
+            gap = int(line.split()[-1])
+    if not result.ok and gap is None:
+        # the live file would point the next caddy reload at the stopped instances
+        _write_and_reload(conn, config.caddy_config_path, config.render_caddyfile(live))
+        conn.run(f"sudo systemctl stop {new_units}", warn=True, pty=True)
+        raise cappa.Exit(
+            f"Failed to point Caddy at the {color} instances, "
+            f"traffic stays on {live or 'the current instances'}",
+            code=1,
+        )
+    return color, gap
+
+
+@contextmanager
+def edge_drained(config: Config) -> Iterator[None]:
+    """
+    Take the host out of the edge rotation while the block runs, then publish the
+    edge config with every backend. Caddy reloads gracefully, requests in flight to
+    the drained backend complete.
+    """
+    if not config.edge:
+        yield
+        return
+    path = f"{config.edge.config_dir}/{config.app_name}.caddy"
+    with host_connection(host=config.edge_host) as conn:
+        if config.edge.backend:
+            with trace.span("edge-drain", backend=config.edge.backend):
+                drained = config.render_edge_caddyfile(drained=(config.edge.backend,))
+                if not _write_and_reload(conn, path, drained):
+                    raise cappa.Exit(
+                        f"Failed to drain {config.edge.backend} on the edge {config.edge.ip}",
+                        code=1,
+                    )
+        try:
+            yield
+        except BaseException as e:
+            # never leave the host drained, a single backend would serve errors
+            with trace.span("edge-restore"):
+                restored = _write_and_reload(conn, path, config.render_edge_caddyfile())
+            if not restored:
+                raise cappa.Exit(
+                    f"{e}\nFailed to restore {config.edge.backend} on the edge {config.edge.ip}",
+                    code=1,
+                ) from e
+            raise
+        with trace.span("edge-restore"):
+            if not _write_and_reload(conn, path, config.render_edge_caddyfile()):
+                raise cappa.Exit(
+                    f"Failed to update the caddy config of the edge {config.edge.ip}",
+                    code=1,
+                )
+
+
+@trace.span("caddy")
 def teardown(conn: Connection, config: Config):
     remote_path = config.caddy_config_path
     conn.run(f"sudo rm {remote_path}", warn=True, pty=True)
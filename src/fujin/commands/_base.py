@@ -1,13 +1,20 @@
+from collections.abc import Callable
 from contextlib import contextmanager
 from dataclasses import dataclass
 from functools import cached_property
+from functools import partial
+from typing import ClassVar
 from typing import Generator
+from typing import TypeVar
 
 import cappa
 
 from fujin.config import Config
 from fujin.connection import Connection
 from fujin.connection import host_connection
+from fujin.plan import gather_host_facts
+
+T = TypeVar("T")
 
 
 @dataclass
@@ -17,9 +24,30 @@ class BaseCommand:
     including configuring the web proxy and managing systemd services.
     """
 
+    # commands gathering the host facts and live color in their own preflight round trip
+    discovers_host_facts: ClassVar[bool] = False
+
     @cached_property
     def config(self) -> Config:
-        return Config.read()
+        config = Config.read()
+        if not self.discovers_host_facts:
+            # only contacts the host when a command or unit name needs them
+            config.fetch_host_facts = partial(self._on_host, gather_host_facts)
+            config.fetch_live_color = partial(self._on_host, self._read_live_color)
+        return config
+
+    def _on_host(self, gather: Callable[[Connection], T]) -> T:
+        # reuse the connection of the running command when there is one
+        if conn := getattr(self, "_open_connection", None):
+            return gather(conn)
+        with host_connection(host=self.config.host) as conn:
+            return gather(conn)
+
+    def _read_live_color(self, conn: Connection) -> str | None:
+        result = conn.run(f"cat {self.config.app_dir}/.color", warn=True, hide=True)
+        if not result.ok:
+            return None
+        return result.stdout.strip() or None
 
     @cached_property
     def stdout(self) -> cappa.Output:
@@ -28,7 +56,11 @@ class BaseCommand:
     @contextmanager
     def connection(self):
         with host_connection(host=self.config.host) as conn:
-            yield conn
+            self._open_connection = conn
+            try:
+                yield conn
+            finally:
+                self._open_connection = None
 
     @contextmanager
     def app_environment(self) -> Generator[Connection, None, None]:
@@ -1,102 +1,134 @@
 from __future__ import annotations
 
+import sys
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
 from typing import Annotated
+from typing import Iterator
 
 import cappa
+import msgspec
+from rich.filesize import decimal
+from rich.live import Live
 from rich.table import Table
+from rich.text import Text
 
-
+from fujin import benchmark
+from fujin import journal
+from fujin import loadgen
+from fujin import logindex
+from fujin import profiling
+from fujin import status
 from fujin.commands import BaseCommand
 from fujin.config import InstallationMode
+from fujin.connection import Connection
+from fujin.connection import iter_output
+from fujin.top import CADDY_METRICS_URL
+from fujin.top import build_table
+from fujin.top import iter_samples
+from fujin.top import sampler_command
 
 
 @cappa.command(help="Run application-related tasks")
 class App(BaseCommand):
     @cappa.command(help="Display information about the application")
-    def info(self):
+    def info(
+        self,
+        as_json: Annotated[
+            bool,
+            cappa.Arg(long="--json", help="Print the information as json"),
+        ] = False,
+    ):
+        names = self.config.active_systemd_units
+        if self.config.slice_name:
+            names = [*names, self.config.slice_name]
+        # versions and the state of every unit in a single round trip
+        command = f"cat {self.config.app_dir}/.versions 2>/dev/null; echo '::units::'"
+        if names:
+            command += f"; {status.show_command(names)}"
         with self.connection() as conn:
-            remote_version = (
-                conn.run("head -n 1 .versions", warn=True, hide=True).stdout.strip()
-                or "N/A"
-            )
-            rollback_targets = conn.run(
-                "sed -n '2,$p' .versions", warn=True, hide=True
-            ).stdout.strip()
-            infos = {
-                "app_name": self.config.app_name,
-                "app_dir": self.config.app_dir,
-                "app_bin": self.config.app_bin,
-                "local_version": self.config.version,
-                "remote_version": remote_version,
-                "rollback_targets": (
-                    ", ".join(rollback_targets.split("\n"))
-                    if rollback_targets
-                    else "N/A"
-                ),
-            }
-            if self.config.installation_mode == InstallationMode.PY_PACKAGE:
-                infos["python_version"] = self.config.python_version
-
-            if self.config.webserver.enabled:
-                infos["running_at"] = f"https://{self.config.host.domain_name}"
-
-            names = self.config.active_systemd_units
-            if names:
-                result = conn.run(
-                    f"sudo systemctl is-active {' '.join(names)}",
-                    warn=True,
-                    hide=True,
-                )
-                statuses = result.stdout.strip().split("\n")
-                services_status = dict(zip(names, statuses))
-            else:
-                services_status = {}
-
-            services = {}
-            for process_name in self.config.processes:
-                active_systemd_units = self.config.get_active_unit_names(process_name)
-                running_count = sum(
-                    1
-                    for name in active_systemd_units
-                    if services_status.get(name) == "active"
-                )
-                total_count = len(active_systemd_units)
+            output = conn.run(command, warn=True, hide=True).stdout
+        versions_output, _, show_output = output.partition("::units::")
+        versions = versions_output.split()
 
-                if total_count == 1:
-                    services[process_name] = services_status.get(
-                        active_systemd_units[0], "unknown"
-                    )
-                else:
-                    services[process_name] = f"{running_count}/{total_count}"
+        infos = {
+            "app_name": self.config.app_name,
+            "app_dir": self.config.app_dir,
+            "app_bin": self.config.app_bin,
+            "local_version": self.config.version,
+            "remote_version": versions[0] if versions else "N/A",
+            "rollback_targets": ", ".join(versions[1:]) or "N/A",
+        }
+        if self.config.installation_mode == InstallationMode.PY_PACKAGE:
+            infos["python_version"] = self.config.python_version
+
+        if self.config.webserver.enabled:
+            infos["running_at"] = f"https://{self.config.host.domain_name}"
 
-            socket_name = f"{self.config.app_name}.socket"
-            if socket_name in services_status:
-                services["socket"] = services_status[socket_name]
+        # values resolved from the host facts, fetched only when needed
+        resolved = {}
+        for name, process in self.config.processes.items():
+            if process.replicas == "auto":
+                resolved[f"{name}_replicas"] = self.config.get_replicas(name)
+            if self.config.get_command(name) != process.command:
+                resolved[f"{name}_command"] = self.config.get_command(name)
+        if facts := self.config.cached_host_facts:
+            infos["host_cpus"] = facts.cpus
+            infos["host_mem_mb"] = facts.mem_mb
+        infos.update(resolved)
+
+        units = status.unit_statuses(self.config, show_output)
+        slice_status = status.slice_status(self.config, show_output)
+        if as_json:
+            data = {
+                **infos,
+                "remote_version": versions[0] if versions else None,
+                "rollback_targets": versions[1:],
+                "units": units,
+            }
+            if slice_status:
+                data["slice"] = slice_status
+            sys.stdout.write(
+                msgspec.json.format(msgspec.json.encode(data), indent=2).decode() + "\n"
+            )
+            return
 
         infos_text = "\n".join(f"{key}: {value}" for key, value in infos.items())
 
         table = Table(title="", header_style="bold cyan")
         table.add_column("Process", style="")
         table.add_column("Status")
-        for service, status in services.items():
-            if status == "active":
-                status_str = f"[bold green]{status}[/bold green]"
-            elif status == "failed":
-                status_str = f"[bold red]{status}[/bold red]"
-            elif status in ("inactive", "unknown"):
-                status_str = f"[dim]{status}[/dim]"
-            elif "/" in status:
-                running, total = map(int, status.split("/"))
-                if running == total:
-                    status_str = f"[bold green]{status}[/bold green]"
-                elif running == 0:
-                    status_str = f"[bold red]{status}[/bold red]"
-                else:
-                    status_str = f"[bold yellow]{status}[/bold yellow]"
+        table.add_column("PID", justify="right")
+        table.add_column("Memory", justify="right")
+        table.add_column("CPU", justify="right")
+        table.add_column("Restarts", justify="right")
+        table.add_column("Since")
+        for unit in [*units, *([slice_status] if slice_status else [])]:
+            if unit is slice_status:
+                table.add_section()
+            state = unit.active_state
+            if state == "active":
+                status_str = f"[bold green]{state}[/bold green]"
+            elif state == "failed":
+                status_str = f"[bold red]{state}[/bold red]"
+            elif state in ("inactive", "unknown"):
+                status_str = f"[dim]{state}[/dim]"
             else:
-                status_str = status
+                status_str = f"[bold yellow]{state}[/bold yellow]"
+            if unit.sub_state and unit.sub_state != state:
+                status_str += f" ({unit.sub_state})"
 
-            table.add_row(service, status_str)
+            table.add_row(
+                unit.process,
+                status_str,
+                str(unit.main_pid or "-"),
+                decimal(unit.memory_bytes) if unit.memory_bytes is not None else "-",
+                f"{unit.cpu_seconds:.1f}s" if unit.cpu_seconds is not None else "-",
+                str(unit.restarts) if unit.restarts is not None else "-",
+                unit.active_since or "-",
+            )
 
         self.stdout.output(infos_text)
         self.stdout.output(table)
@@ -137,6 +169,17 @@ class App(BaseCommand):
     ):
         self._run_service_command("restart", name)
 
+    @cappa.command(
+        help="Gracefully reload the specified service or all services if no name is provided, services that can't reload are restarted"
+    )
+    def reload(
+        self,
+        name: Annotated[
+            str | None, cappa.Arg(help="Service name, no value means all")
+        ] = None,
+    ):
+        self._run_service_command("reload-or-restart", name)
+
     @cappa.command(
         help="Stop the specified service or all services if no name is provided"
     )
@@ -151,6 +194,9 @@ class App(BaseCommand):
     def _run_service_command(self, command: str, name: str | None):
         with self.connection() as conn:
             names = self._resolve_active_systemd_units(name)
+            if command == "reload-or-restart":
+                # sockets and timers have nothing to reload
+                names = [n for n in names if n.endswith(".service")]
             if not names:
                 self.stdout.output("[yellow]No services found[/yellow]")
                 return
@@ -165,6 +211,7 @@ class App(BaseCommand):
             "start": "started",
             "restart": "restarted",
             "stop": "stopped",
+            "reload-or-restart": "reloaded",
         }.get(command, command)
         self.stdout.output(f"[green]{msg} {past_tense} successfully![/green]")
 
@@ -173,19 +220,442 @@ class App(BaseCommand):
         self,
         name: Annotated[str | None, cappa.Arg(help="Service name")] = None,
         follow: Annotated[bool, cappa.Arg(short="-f")] = False,
-        lines: Annotated[int, cappa.Arg(short="-n", long="--lines")] = 50,
+        lines: Annotated[
+            int | None,
+            cappa.Arg(
+                short="-n",
+                long="--lines",
+                help="Number of most recent entries to show, 50 unless --since or --until is set",
+            ),
+        ] = None,
+        since: Annotated[
+            str | None,
+            cappa.Arg(
+                long="--since",
+                help="Show entries on or newer than this date, e.g: '1 hour ago', '2025-01-06 10:00'",
+            ),
+        ] = None,
+        until: Annotated[
+            str | None,
+            cappa.Arg(long="--until", help="Show entries on or older than this date"),
+        ] = None,
+        grep: Annotated[
+            str | None,
+            cappa.Arg(
+                short="-g",
+                long="--grep",
+                help="Only show entries with a message matching this pattern",
+            ),
+        ] = None,
+        priority: Annotated[
+            str | None,
+            cappa.Arg(
+                short="-p",
+                long="--priority",
+                help="Only show entries up to this priority, e.g: err, or a range like warning..err",
+            ),
+        ] = None,
+        as_json: Annotated[
+            bool,
+            cappa.Arg(
+                long="--json", help="Print the raw journal entries as json lines"
+            ),
+        ] = False,
+        output: Annotated[
+            Path | None,
+            cappa.Arg(
+                short="-o",
+                long="--output",
+                help="Write the logs to this file instead of the terminal",
+            ),
+        ] = None,
     ):
+        names = self._resolve_active_systemd_units(name)
+        if not names:
+            self.stdout.output("[yellow]No services found[/yellow]")
+            return
+        sudo, stdin = self._journal_sudo()
+        if lines is None and not (since or until):
+            lines = 50
+        command = journal.journalctl_command(
+            names,
+            sudo=sudo,
+            lines=lines,
+            follow=follow,
+            since=since,
+            until=until,
+            grep=grep,
+            priority=priority,
+            compress=not follow,
+        )
+        app_name = self.config.app_name
+        label_width = max(
+            len(journal.unit_label({"_SYSTEMD_UNIT": n}, app_name)) for n in names
+        )
+
         with self.connection() as conn:
-            names = self._resolve_active_systemd_units(name)
-            if names:
-                units = " ".join(f"-u {n}" for n in names)
-                conn.run(
-                    f"sudo journalctl {units} -n {lines} {'-f' if follow else ''}",
-                    warn=True,
-                    pty=True,
+            chunks = self._sudo_output(conn, command, stdin)
+            target = output.open("w") if output else sys.stdout
+            try:
+                if as_json:
+                    for line in journal.iter_lines(chunks, compressed=not follow):
+                        target.write(f"{line.decode(errors='replace')}\n")
+                        if follow:
+                            target.flush()
+                else:
+                    for entry in journal.iter_entries(chunks, compressed=not follow):
+                        target.write(
+                            f"{journal.format_entry(entry, app_name, label_width)}\n"
+                        )
+                        if follow:
+                            target.flush()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                if output:
+                    target.close()
+        if output:
+            self.stdout.output(f"[green]Logs written to {output}[/green]")
+
+    @cappa.command(
+        name="logs-sync",
+        help="Fetch new log entries of all services into the local search index",
+    )
+    def logs_sync(self):
+        host = self.config.host.ip
+        sudo, stdin = self._journal_sudo()
+        path = logindex.index_path(self.config)
+        with logindex.open_index(path) as db, self.connection() as conn:
+            cursors = logindex.get_cursors(db, host, self.config.active_systemd_units)
+            chunks = self._sudo_output(
+                conn, journal.sync_command(cursors, sudo=sudo), stdin
+            )
+            counts = logindex.store(
+                db,
+                journal.iter_lines(chunks, compressed=True),
+                host=host,
+                app=self.config.app_name,
+            )
+        table = Table(title=f"Synced logs from {host}", header_style="bold cyan")
+        table.add_column("Unit")
+        table.add_column("New entries", justify="right")
+        for unit, count in counts.items():
+            table.add_row(unit, str(count))
+        table.caption = str(path)
+        self.stdout.output(table)
+
+    @cappa.command(
+        name="logs-search",
+        help="Search the log entries fetched with logs-sync, across all hosts",
+    )
+    def logs_search(
+        self,
+        query: Annotated[
+            str, cappa.Arg(help="Full text query, e.g: 'timeout AND redis'")
+        ],
+        since: Annotated[
+            str | None,
+            cappa.Arg(
+                long="--since",
+                help="Only entries newer than this, e.g: 2h, 30m, 1d or 2025-01-06T10:00",
+            ),
+        ] = None,
+        name: Annotated[
+            str | None, cappa.Arg(long="--unit", help="Only entries of this service")
+        ] = None,
+        limit: Annotated[
+            int,
+            cappa.Arg(
+                short="-n", long="--limit", help="Maximum number of entries to show"
+            ),
+        ] = 100,
+    ):
+        path = logindex.index_path(self.config)
+        if not path.exists():
+            raise cappa.Exit(
+                "No logs indexed yet, run `fujin app logs-sync` first", code=1
+            )
+        since_ts = logindex.parse_since(since) if since else None
+        units = self._resolve_active_systemd_units(name) if name else [None]
+        rows = []
+        with logindex.open_index(path) as db:
+            for unit in units:
+                rows += logindex.search(
+                    db, query, since=since_ts, unit=unit, limit=limit
                 )
+        rows = sorted(rows, key=lambda r: r["ts"])[-limit:]
+        if not rows:
+            self.stdout.output("[blue]No matching entries[/blue]")
+            return
+        hosts = {row["host"] for row in rows}
+        for row in rows:
+            entry = {
+                "__REALTIME_TIMESTAMP": int(row["ts"] * 1_000_000),
+                "_SYSTEMD_UNIT": row["unit"],
+                "MESSAGE": row["message"],
+            }
+            line = journal.format_entry(entry, row["app"])
+            if len(hosts) > 1:
+                line = f"{row['host']} {line}"
+            sys.stdout.write(f"{line}\n")
+
+    @cappa.command(help="Live view of the resource usage of every process")
+    def top(
+        self,
+        interval: Annotated[
+            float,
+            cappa.Arg(short="-i", long="--interval", help="Seconds between samples"),
+        ] = 2.0,
+        record: Annotated[
+            Path | None,
+            cappa.Arg(
+                long="--record",
+                help="Also append every sample to this file, as json lines",
+            ),
+        ] = None,
+        count: Annotated[
+            int | None,
+            cappa.Arg(
+                short="-n",
+                long="--count",
+                help="Stop after this many samples, runs until interrupted by default",
+            ),
+        ] = None,
+        caddy_metrics: Annotated[
+            str,
+            cappa.Arg(
+                long="--caddy-metrics",
+                help="Caddy metrics endpoint on the host, used to show the request rate",
+            ),
+        ] = CADDY_METRICS_URL,
+    ):
+        command = sampler_command(
+            self.config,
+            interval=interval,
+            caddy_metrics_url=caddy_metrics if self.config.webserver.enabled else None,
+        )
+        encoder = msgspec.json.Encoder()
+        previous = None
+        with (
+            self.connection() as conn,
+            Live(console=self.stdout.output_console, auto_refresh=False) as live,
+        ):
+            recording = record.open("ab") if record else None
+            try:
+                # a single long lived sampler on the host, no new channel per refresh
+                lines = journal.iter_lines(iter_output(conn, command), compressed=False)
+                for i, sample in enumerate(iter_samples(lines), start=1):
+                    live.update(build_table(self.config, sample, previous))
+                    live.refresh()
+                    if recording:
+                        recording.write(encoder.encode(sample) + b"\n")
+                        recording.flush()
+                    previous = sample
+                    if count and i >= count:
+                        break
+            except KeyboardInterrupt:
+                pass
+            finally:
+                if recording:
+                    recording.close()
+
+    @cappa.command(
+        help="Send an HTTP load to the app and compare the results with a previous release"
+    )
+    def bench(
+        self,
+        paths: Annotated[
+            list[str] | None,
+            cappa.Arg(
+                short="-p",
+                long="--path",
+                help="Path to request, can be repeated, / by default",
+            ),
+        ] = None,
+        concurrency: Annotated[
+            int,
+            cappa.Arg(short="-c", long="--concurrency", help="Concurrent connections"),
+        ] = 8,
+        duration: Annotated[
+            float,
+            cappa.Arg(
+                short="-d", long="--duration", help="Seconds to run the load for"
+            ),
+        ] = 10.0,
+        through_caddy: Annotated[
+            bool,
+            cappa.Arg(
+                long="--through-caddy",
+                help="Request the domain through Caddy instead of the web upstreams over ssh",
+            ),
+        ] = False,
+        compare: Annotated[
+            str | None,
+            cappa.Arg(
+                long="--compare",
+                help="Compare with the last run against this version",
+            ),
+        ] = None,
+    ):
+        paths = paths or ["/"]
+        domain = self.config.host.domain_name
+        if through_caddy and not self.config.webserver.enabled:
+            raise cappa.Exit("The webserver is disabled, there is no Caddy", code=1)
+        with self.connection() as conn:
+            app_dir = self.config.app_dir
+            output = conn.run(
+                f"head -n 1 {app_dir}/.versions; echo '::color::'; cat {app_dir}/.color",
+                warn=True,
+                hide=True,
+            ).stdout
+            version_output, _, color = output.partition("::color::")
+            version = version_output.strip() or self.config.version
+            if through_caddy:
+                target = "caddy"
+                bases = nullcontext([f"https://{domain}"])
             else:
-                self.stdout.output("[yellow]No services found[/yellow]")
+                target = "upstream"
+                upstreams = self.config.get_web_upstreams(color.strip() or None)
+                bases = benchmark.forwarded(conn, benchmark.tcp_upstreams(upstreams))
+            with bases as base_urls:
+                load = loadgen.LoadGenerator(
+                    *(f"{base}{path}" for path in paths for base in base_urls),
+                    concurrency=concurrency,
+                    # the app checks the host header, e.g: django ALLOWED_HOSTS
+                    host_header=None if through_caddy else domain,
+                )
+                self.stdout.output(
+                    f"[blue]Sending requests to v{version} via {target} for {duration:g}s...[/blue]"
+                )
+                timestamp = time.time()
+                start = time.perf_counter()
+                with load.running():
+                    time.sleep(duration)
+                elapsed = time.perf_counter() - start
+
+        record = benchmark.build_record(
+            self.config,
+            version=version,
+            target=target,
+            paths=paths,
+            concurrency=concurrency,
+            duration=elapsed,
+            stats=loadgen.window_stats("bench", load.responses),
+            timestamp=timestamp,
+        )
+        path = benchmark.history_path(self.config)
+        baseline = None
+        if compare:
+            baseline = benchmark.find_baseline(benchmark.read(path), record, compare)
+            if baseline is None:
+                self.stdout.output(
+                    f"[yellow]No run of v{compare} with the same target and paths to compare with[/yellow]"
+                )
+        benchmark.append(path, record)
+        self.stdout.output(benchmark.results_table(record, baseline))
+
+    @cappa.command(
+        help="Profile a running process with py-spy, saving a flamegraph or dumping its stacks"
+    )
+    def profile(
+        self,
+        name: Annotated[str, cappa.Arg(help="Process name")],
+        replica: Annotated[
+            int | None,
+            cappa.Arg(
+                short="-r",
+                long="--replica",
+                help="Replica to profile, the first running one by default",
+            ),
+        ] = None,
+        duration: Annotated[
+            str,
+            cappa.Arg(
+                short="-d", long="--duration", help="How long to sample, e.g: 30s"
+            ),
+        ] = "30s",
+        rate: Annotated[int, cappa.Arg(long="--rate", help="Samples per second")] = 100,
+        speedscope: Annotated[
+            bool,
+            cappa.Arg(
+                long="--speedscope",
+                help="Save a speedscope json profile instead of a flamegraph svg",
+            ),
+        ] = False,
+        output: Annotated[
+            Path | None,
+            cappa.Arg(
+                short="-o",
+                long="--output",
+                help="File to save the profile to, named after the process by default",
+            ),
+        ] = None,
+        dump: Annotated[
+            bool,
+            cappa.Arg(
+                long="--dump",
+                help="Print the current stacks of every replica instead of sampling",
+            ),
+        ] = False,
+    ):
+        units = profiling.resolve_units(self.config, name, replica)
+        sudo, stdin = self._journal_sudo()
+        if dump:
+            command = profiling.dump_command(self.config, units, sudo=sudo)
+            with self.connection() as conn:
+                data = b"".join(self._sudo_output(conn, command, stdin))
+            for unit, stacks in profiling.parse_dumps(data.decode()).items():
+                self.stdout.output(f"[bold cyan]{unit}[/bold cyan]")
+                self.stdout.output(Text(stacks))
+            return
+
+        seconds = profiling.parse_seconds(duration)
+        output_format = "speedscope" if speedscope else "flamegraph"
+        if output is None:
+            suffix = ".speedscope.json" if speedscope else ".svg"
+            label = f"{name}-{replica}" if replica else name
+            output = Path(f"{label}-{datetime.now():%Y%m%d-%H%M%S}{suffix}")
+        command = profiling.record_command(
+            self.config,
+            units,
+            sudo=sudo,
+            duration=seconds,
+            rate=rate,
+            output_format=output_format,
+        )
+        self.stdout.output(
+            f"[blue]Sampling {name} for {seconds}s, this installs py-spy on the host on first use...[/blue]"
+        )
+        with self.connection() as conn:
+            size = profiling.write_decompressed(
+                self._sudo_output(conn, command, stdin), output
+            )
+        self.stdout.output(
+            f"[green]Saved the {output_format} profile to {output} ({decimal(size)})[/green]"
+        )
+
+    def _journal_sudo(self) -> tuple[str, bytes | None]:
+        # no pty to answer a sudo prompt, the password goes through stdin
+        password = self.config.host.password
+        if password:
+            return "sudo -S -p ''", f"{password}\n".encode()
+        return "sudo -n", None
+
+    def _sudo_output(
+        self, conn: Connection, command: str, stdin: bytes | None
+    ) -> Iterator[bytes]:
+        """``iter_output`` of a command using the sudo of ``_journal_sudo``."""
+        try:
+            yield from iter_output(conn, command, stdin=stdin)
+        except cappa.Exit as e:
+            if stdin is not None or "a password is required" not in str(e.message):
+                raise
+            host = self.config.host
+            raise cappa.Exit(
+                f"sudo on {host.ip} requires a password for {host.user}. Set 'password_env' "
+                "in the host config to the environment variable holding it.",
+                code=1,
+            ) from e
 
     def _resolve_active_systemd_units(self, name: str | None) -> list[str]:
         if not name:
@@ -195,9 +665,14 @@ class App(BaseCommand):
             return self.config.get_active_unit_names(name)
 
         if name == "socket":
-            has_socket = any(config.socket for config in self.config.processes.values())
-            if has_socket:
-                return [f"{self.config.app_name}.socket"]
+            sockets = [
+                socket
+                for process_name, config in self.config.processes.items()
+                if config.socket
+                for socket in self.config.get_active_socket_names(process_name)
+            ]
+            if sockets:
+                return sockets
 
         if name == "timer":
             return [n for n in self.config.active_systemd_units if n.endswith(".timer")]
@@ -1,54 +1,169 @@
 from __future__ import annotations
 
-import hashlib
 import subprocess
+from contextlib import nullcontext
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Annotated
 
 import cappa
+from rich.filesize import decimal
+from rich.table import Table
 
 from fujin import caddy
+from fujin import history
+from fujin import loadgen
+from fujin import metrics
+from fujin import trace
+from fujin import warmup
 from fujin.commands import BaseCommand
 from fujin.config import InstallationMode
 from fujin.connection import Connection
+from fujin.plan import SYSTEMD_DIR
+from fujin.plan import DeployPlan
+from fujin.plan import RemoteState
+from fujin.plan import build_plan
+from fujin.plan import echoed_hash
+from fujin.plan import gather_remote_state
+from fujin.plan import gather_server_errors
+from fujin.plan import md5_hexdigest
+from fujin.plan import reloaded_units
 from fujin.secrets import resolve_secrets
 
 
 @cappa.command(
     help="Deploy the project by building, transferring files, installing, and configuring services"
 )
+@dataclass
 class Deploy(BaseCommand):
+    discovers_host_facts = True
+
+    plan: Annotated[
+        bool,
+        cappa.Arg(
+            long="--plan",
+            help="Show what the deploy would change on the host without building or changing anything",
+        ),
+    ] = False
+
+    trace_file: Annotated[
+        Path | None,
+        cappa.Arg(
+            long="--trace",
+            help="Write a timing trace of the deploy to this file, in the Chrome trace event format",
+        ),
+    ] = None
+
+    verify_zero_downtime: Annotated[
+        bool,
+        cappa.Arg(
+            long="--verify-zero-downtime",
+            help="Send requests to the app for the whole deploy and report the errors and latencies around the restart",
+        ),
+    ] = False
+
+    verify_url: Annotated[
+        str | None,
+        cappa.Arg(
+            long="--verify-url",
+            help="Url requested by --verify-zero-downtime, defaults to the domain of the host",
+        ),
+    ] = None
+
     def __call__(self):
+        if self.plan:
+            parsed_env = self.resolve_env()
+            with self.connection() as conn:
+                remote = gather_remote_state(conn, self.config, disk_usage=True)
+            self.print_plan(build_plan(self.config, remote, parsed_env))
+            return
+
+        load = self.load_generator()
+        with trace.tracing() as tracer:
+            try:
+                with (
+                    history.recording(self.config, "deploy", self.config.version),
+                    load.running(loadgen.SETTLE_SECONDS) if load else nullcontext(),
+                ):
+                    caddy_configured = self.deploy()
+            finally:
+                if self.trace_file:
+                    tracer.save(self.trace_file)
+
+        if caddy_configured:
+            self.stdout.output("[green]Deployment completed successfully![/green]")
+            self.stdout.output(
+                f"[blue]Application is available at: https://{self.config.host.domain_name}[/blue]"
+            )
+        self.stdout.output(tracer.summary_table())
+        if load:
+            self.report_downtime(load, tracer)
+
+    def load_generator(self) -> loadgen.LoadGenerator | None:
+        if not self.verify_zero_downtime:
+            return None
+        url = self.verify_url or f"https://{self.config.host.domain_name}/"
+        self.stdout.output(
+            f"[blue]Sending requests to {url} during the deploy...[/blue]"
+        )
+        return loadgen.LoadGenerator(url)
+
+    def report_downtime(self, load: loadgen.LoadGenerator, tracer: trace.Tracer):
+        windows = loadgen.restart_windows(load.responses, tracer)
+        title = f"Requests to {', '.join(load.urls)}"
+        self.stdout.output(loadgen.stats_table(title, windows))
+        errors = sum(w.errors for w in windows)
+        if errors:
+            raise cappa.Exit(f"{errors} requests failed during the deploy", code=1)
+        self.stdout.output("[green]No failed requests, zero downtime verified.[/green]")
+
+    def resolve_env(self) -> str:
         # parse and resolve secrets in .env file
-        if self.config.secret_config:
-            self.stdout.output("[blue]Resolving secrets from configuration...[/blue]")
-            parsed_env = resolve_secrets(
+        if not self.config.secret_config:
+            return self.config.host.env_content
+        self.stdout.output("[blue]Resolving secrets from configuration...[/blue]")
+        with trace.span("secrets"):
+            return resolve_secrets(
                 self.config.host.env_content, self.config.secret_config
             )
-        else:
-            parsed_env = self.config.host.env_content
+
+    def deploy(self) -> bool:
+        parsed_env = self.resolve_env()
 
         # run build command
         try:
             self.stdout.output("[blue]Building application...[/blue]")
-            subprocess.run(self.config.build_command, check=True, shell=True)
+            with trace.span("build", command=self.config.build_command):
+                subprocess.run(self.config.build_command, check=True, shell=True)
         except subprocess.CalledProcessError as e:
             raise cappa.Exit(f"build command failed: {e}", code=1) from e
         # the build commands might be responsible for creating the requirements file
         if self.config.requirements and not Path(self.config.requirements).exists():
             raise cappa.Exit(f"{self.config.requirements} not found", code=1)
 
+        caddy_configured = True
         with self.connection() as conn:
+            # everything later steps need to know about the host, in one round trip
+            with trace.span("preflight"):
+                remote = gather_remote_state(conn, self.config)
             self.stdout.output("[blue]Installing project on remote host...[/blue]")
-            conn.run(f"mkdir -p {self.config.app_dir}")
-            # copy env file
-            conn.run(f"echo '{parsed_env}' > {self.config.app_dir}/.env")
-            self.install_project(conn)
+            with trace.span("env"):
+                release_dir = self.config.get_release_dir(self.config.version)
+                command = f"mkdir -p {release_dir}"
+                if remote.env_hash != echoed_hash(parsed_env):
+                    command += f" && echo '{parsed_env}' > {self.config.app_dir}/.env"
+                conn.run(command)
+            self.install_project(conn, remote=remote)
             self.stdout.output("[blue]Configuring systemd services...[/blue]")
-            self.install_services(conn)
-            self.restart_services(conn)
-            if self.config.webserver.enabled:
+            self.install_services(conn, remote=remote)
+            with caddy.edge_drained(self.config):
+                self.restart_services(conn, remote=remote, env_content=parsed_env)
+            # blue/green deploys configured caddy when switching the traffic
+            if self.config.webserver.enabled and not self.config.webserver.blue_green:
                 self.stdout.output("[blue]Configuring web server...[/blue]")
-                caddy_configured = caddy.setup(conn, self.config)
+                caddy_configured = caddy.setup(
+                    conn, self.config, current_hash=remote.caddy_hash
+                )
                 if not caddy_configured:
                     self.stdout.output(
                         "[red]Failed to reload Caddy.[/red]\n"
@@ -59,137 +174,262 @@ class Deploy(BaseCommand):
                     )
 
             # prune old versions
-            with conn.cd(self.config.app_dir):
-                if self.config.versions_to_keep:
-                    result = conn.run(
-                        f"sed -n '{self.config.versions_to_keep + 1},$p' .versions",
+            # the metrics textfile is written along the last remote call of the deploy
+            with conn.cd(self.config.app_dir), trace.span("prune"):
+                keep = self.config.versions_to_keep
+                versions = remote.versions_after_deploy(self.config.version)
+                to_prune = versions[keep:] if keep else []
+                command = None
+                if to_prune:
+                    self.stdout.output("[blue]Pruning old release versions...[/blue]")
+                    paths = [self.config.get_release_dir(v) for v in to_prune]
+                    command = (
+                        f"rm -r {' '.join(paths)}; sed -i '{keep + 1},$d' .versions"
+                    )
+                elif self.config.metrics:
+                    command = "true"
+                if command:
+                    conn.run(
+                        metrics.with_textfile(
+                            self.config,
+                            command,
+                            command="deploy",
+                            version=self.config.version,
+                        ),
+                        warn=True,
                         hide=True,
-                    ).stdout.strip()
-                    if result:
-                        result_list = result.split("\n")
-                        to_prune = [f"{self.config.app_dir}/v{v}" for v in result_list]
-                        if to_prune:
-                            self.stdout.output(
-                                "[blue]Pruning old release versions...[/blue]"
-                            )
-                            conn.run(f"rm -r {' '.join(to_prune)}", warn=True)
-                            conn.run(
-                                f"sed -i '{self.config.versions_to_keep + 1},$d' .versions",
-                                warn=True,
-                            )
-        if caddy_configured:
-            self.stdout.output("[green]Deployment completed successfully![/green]")
+                    )
+        return caddy_configured
+
+    def print_plan(self, plan: DeployPlan) -> None:
+        styles = {
+            "new": "[green]new[/green]",
+            "changed": "[yellow]changed[/yellow]",
+            "unchanged": "[dim]unchanged[/dim]",
+            "stale": "[red]removed[/red]",
+        }
+        table = Table(
+            title=f"Deploy plan for {self.config.app_name} v{plan.version} "
+            f"(current: {plan.current_version or 'none'})",
+            header_style="bold cyan",
+        )
+        table.add_column("Step")
+        table.add_column("Target")
+        table.add_column("Change")
+        table.add_column("Size", justify="right")
+
+        for change in plan.uploads:
+            size = decimal(change.size) if change.size else "not built yet"
+            table.add_row("upload", change.path, styles[change.status], size)
+        for change in plan.rewrites:
+            size = decimal(change.size) if change.status != "stale" else ""
+            table.add_row("rewrite", change.path, styles[change.status], size)
+        if plan.rebuild_venv is not None:
+            table.add_row(
+                "rebuild",
+                ".venv",
+                "[yellow]rebuild[/yellow]" if plan.rebuild_venv else "[dim]reuse[/dim]",
+                "",
+            )
+        for unit in plan.restarts:
+            table.add_row("restart", unit, "[yellow]restart[/yellow]", "")
+        for unit in plan.reloads:
+            table.add_row("reload", unit, "[yellow]reload[/yellow]", "")
+        for version in plan.prunes:
+            table.add_row(
+                "prune", self.config.get_release_dir(version), styles["stale"], ""
+            )
+
+        self.stdout.output(table)
+        self.stdout.output(
+            f"[bold]Estimated transfer:[/bold] {decimal(plan.transfer_bytes)}"
+        )
+        if plan.remote.free_bytes is not None:
+            used = decimal(plan.remote.app_dir_bytes or 0)
             self.stdout.output(
-                f"[blue]Application is available at: https://{self.config.host.domain_name}[/blue]"
+                f"[bold]Disk:[/bold] app directory uses {used}, "
+                f"{decimal(plan.remote.free_bytes)} free on the host"
             )
+        self.stdout.output("[dim]Plan only, nothing was changed on the host.[/dim]")
 
-    def install_services(self, conn: Connection) -> None:
+    @trace.span("install services")
+    def install_services(self, conn: Connection, *, remote: RemoteState) -> None:
         new_units = self.config.render_systemd_units()
+        # only rewrite the unit files that differ from what is on the host
+        writes = []
         for filename, content in new_units.items():
-            conn.run(
-                f"echo '{content}' | sudo tee /etc/systemd/system/{filename}",
-                hide="out",
-                pty=True,
+            if remote.unit_hashes.get(filename) == echoed_hash(content):
+                continue
+            if "/" in filename:
+                # drop-in, e.g: app@1.service.d/cpu-affinity.conf
+                writes.append(f"sudo mkdir -p {SYSTEMD_DIR}/{Path(filename).parent}")
+            writes.append(
+                f"echo '{content}' | sudo tee {SYSTEMD_DIR}/{filename} > /dev/null"
             )
-
-        conn.run("sudo systemctl daemon-reload")
+        if writes:
+            with trace.span("daemon-reload"):
+                conn.run(
+                    " && ".join([*writes, "sudo systemctl daemon-reload"]), pty=True
+                )
         conn.run(
-            f"sudo systemctl enable --now {' '.join(self.config.active_systemd_units)}",
-            pty=True,
+            f"sudo systemctl enable --now {' '.join(self.in_place_units)}", pty=True
         )
 
-        valid_units = [*self.config.active_systemd_units, *(list(new_units.keys()))]
-
-        # Cleanup Stale Instances (e.g: replicas downgrade)
-        ls_units = conn.run(
-            f"systemctl list-units --full --all --plain --no-legend '{self.config.app_name}*'",
-            warn=True,
-            hide=True,
-        )
-        stale_units = []
-        if ls_units.ok:
-            for line in ls_units.stdout.splitlines():
-                unit = line.split()[0]
-                if unit not in valid_units:
-                    stale_units.append(unit)
+        # the idle color of a blue/green web process is not stale
+        valid_units = [*self.config.all_systemd_units, *(list(new_units.keys()))]
 
+        # Cleanup Stale Instances (e.g: replicas downgrade), files and symlinks
+        stale_units = [u for u in remote.loaded_units if u not in valid_units]
+        stale_paths = [
+            *(
+                f"{SYSTEMD_DIR}/{name}"
+                for name in remote.unit_hashes
+                if name not in valid_units
+            ),
+            *(
+                f"{SYSTEMD_DIR}/multi-user.target.wants/{name}"
+                for name in remote.enabled_links
+                if name not in valid_units
+            ),
+        ]
+        cleanup = []
         if stale_units:
             self.stdout.output(
                 f"[yellow]Stopping stale service units: {', '.join(stale_units)}[/yellow]"
             )
-            conn.run(f"sudo systemctl disable --now {' '.join(stale_units)}", warn=True)
-
-        # Cleanup Stale Files & Symlinks
-        stale_paths = []
-        search_dirs = [
-            "/etc/systemd/system",
-            "/etc/systemd/system/multi-user.target.wants",
-        ]
-
-        for directory in search_dirs:
-            result = conn.run(
-                f"ls {directory}/{self.config.app_name}*", warn=True, hide=True
-            )
-            if result.ok:
-                for path in result.stdout.split():
-                    filename = Path(path).name
-                    if filename not in valid_units:
-                        stale_paths.append(path)
-
+            cleanup.append(f"sudo systemctl disable --now {' '.join(stale_units)}")
         if stale_paths:
             self.stdout.output(
                 f"[yellow]Cleaning up stale service files and symlinks: {', '.join([Path(p).name for p in stale_paths])}[/yellow]"
             )
-            conn.run(f"sudo rm {' '.join(stale_paths)}", warn=True)
+            cleanup.append(f"sudo rm {' '.join(stale_paths)}")
+        if cleanup:
+            conn.run("; ".join(cleanup), warn=True)
 
-    def restart_services(self, conn: Connection) -> None:
+    @property
+    def in_place_units(self) -> list[str]:
+        """Units restarted in place, blue/green deploys switch the web instances."""
+        if not self.config.webserver.blue_green:
+            return self.config.active_systemd_units
+        web = self.config.get_active_unit_names("web")
+        return [u for u in self.config.active_systemd_units if u not in web]
+
+    @trace.span("restart")
+    def restart_services(
+        self, conn: Connection, *, remote: RemoteState, env_content: str | None = None
+    ) -> None:
         self.stdout.output("[blue]Restarting services...[/blue]")
-        conn.run(
-            f"sudo systemctl restart {' '.join(self.config.active_systemd_units)}",
-            pty=True,
-        )
+        blue_green = self.config.webserver.blue_green
+        if units := self.in_place_units:
+            # graceful reloads, unless the unit files changed since the last deploy
+            reloads = [
+                u
+                for u in reloaded_units(self.config, remote, env_content)
+                if u in units
+            ]
+            restarts = [u for u in units if u not in reloads]
+            commands = []
+            if restarts:
+                commands.append(f"sudo systemctl restart {' '.join(restarts)}")
+            if reloads:
+                commands.append(f"sudo systemctl reload-or-restart {' '.join(reloads)}")
+            conn.run(" && ".join(commands), pty=True)
+            self.warm_up(
+                conn,
+                [
+                    name
+                    for name, process in self.config.processes.items()
+                    if process.warmup and not (name == "web" and blue_green)
+                ],
+            )
+        if blue_green:
+            color, gap = caddy.switch_color(
+                conn,
+                self.config,
+                remote.live_color,
+                on_ready=lambda color: self.warm_up(conn, ["web"], color),
+            )
+            self.config.live_color = color
+            took = f" in {gap} ms" if gap is not None else ""
+            self.stdout.output(f"[green]Switched traffic to {color}{took}[/green]")
+        # the first sample of the 5xx responses was taken by the preflight
+        if remote.server_errors is not None:
+            errors_after = gather_server_errors(conn, self.config)
+            if errors_after is not None:
+                # the counters start over when caddy itself restarted
+                errors = max(errors_after - remote.server_errors, 0)
+                style = "yellow" if errors else "green"
+                self.stdout.output(
+                    f"[{style}]Caddy returned {errors} 5xx responses during the deploy[/{style}]"
+                )
+
+    def warm_up(
+        self, conn: Connection, process_names: list[str], color: str | None = None
+    ) -> None:
+        """Send the warm-up requests of the processes, all in a single round trip."""
+        names = [n for n in process_names if self.config.processes[n].warmup]
+        if not names:
+            return
+        self.stdout.output(f"[blue]Warming up {', '.join(names)}...[/blue]")
+        with trace.span("warm-up"):
+            result = conn.run(
+                "; ".join(
+                    warmup.warmup_command(self.config, name, color) for name in names
+                ),
+                warn=True,
+                hide=True,
+            )
+        for report in warmup.parse_reports(str(result.stdout)):
+            line = (
+                f"{report.process} warm-up: {len(report.latencies)} requests, "
+                f"first {report.first * 1000:.0f} ms, last {report.last * 1000:.0f} ms"
+            )
+            if report.failures:
+                line = f"[yellow]{line}, {report.failures} failed[/yellow]"
+            self.stdout.output(line)
 
     def install_project(
         self,
         conn: Connection,
         *,
+        remote: RemoteState,
         version: str | None = None,
         rolling_back: bool = False,
     ):
         version = version or self.config.version
 
-        # transfer binary or package file
+        # transfer binary or package file, the release directory is created by the caller
         release_dir = self.config.get_release_dir(version)
-        conn.run(f"mkdir -p {release_dir}")
-
         distfile_path = self.config.get_distfile_path(version)
         remote_package_path = f"{release_dir}/{distfile_path.name}"
         if not rolling_back:
-            conn.put(str(distfile_path), remote_package_path)
+            with trace.span("upload"):
+                conn.put(str(distfile_path), remote_package_path)
 
         # install project
         with conn.cd(self.config.app_dir):
-            if self.config.installation_mode == InstallationMode.PY_PACKAGE:
-                self._install_python_package(
-                    conn,
-                    remote_package_path=remote_package_path,
-                    release_dir=release_dir,
-                )
-            else:
-                self._install_binary(conn, remote_package_path)
+            with trace.span("install"):
+                if self.config.installation_mode == InstallationMode.PY_PACKAGE:
+                    self._install_python_package(
+                        conn,
+                        remote=remote,
+                        remote_package_path=remote_package_path,
+                        release_dir=release_dir,
+                    )
+                else:
+                    self._install_binary(conn, remote_package_path)
 
             # run release command
             if self.config.release_command:
                 self.stdout.output("[blue]Executing release command...[/blue]")
-                conn.run(f"source .appenv && {self.config.release_command}")
+                with trace.span("release command"):
+                    conn.run(f"source .appenv && {self.config.release_command}")
 
-            # update version history
-            result = conn.run(
-                "head -n 1 .versions", warn=True, hide=True
-            ).stdout.strip()
-            if result == version:
+            # update version history, a rollback rewrites it itself once the newer
+            # releases are removed
+            if rolling_back or remote.current_version == version:
                 return
-            if result == "":
+            if not remote.current_version:
                 conn.run(f"echo '{version}' > .versions")
             else:
                 conn.run(f"sed -i '1i {version}' .versions")
@@ -198,6 +438,7 @@ class Deploy(BaseCommand):
         self,
         conn: Connection,
         *,
+        remote: RemoteState,
         remote_package_path: str,
         release_dir: str,
     ):
@@ -217,23 +458,14 @@ export PATH=".venv/bin:$PATH"
             local_reqs_path = Path(self.config.requirements)
             curr_release_reqs = f"{release_dir}/requirements.txt"
 
-            # Get the version currently running on the host to find previous requirements
-            prev_version = conn.run(
-                "head -n 1 .versions", warn=True, hide=True
-            ).stdout.strip()
+            # requirements of the version currently running on the host
+            prev_version = remote.current_version
             prev_release_reqs = (
                 f"{self.config.get_release_dir(prev_version)}/requirements.txt"
             )
+            local_hash = md5_hexdigest(local_reqs_path.read_bytes())
 
-            local_hash = hashlib.md5(local_reqs_path.read_bytes()).hexdigest()
-            remote_hash = ""
-
-            if prev_version:
-                res = conn.run(f"md5sum {prev_release_reqs}", warn=True, hide=True)
-                if res.ok:
-                    remote_hash = res.stdout.strip().split()[0]
-
-            if local_hash == remote_hash:
+            if prev_version and local_hash == remote.requirements_hash:
                 rebuild_venv = False
                 # Even if we don't rebuild, we copy the reqs file to the new folder
                 # so the new release folder is complete and self-contained.
@@ -246,11 +478,15 @@ export PATH=".venv/bin:$PATH"
         # Execution
         if rebuild_venv:
             self.stdout.output("[blue]Installing Python dependencies...[/blue]")
-            conn.run("sudo rm -rf .venv")
-            conn.run(f"uv python install {self.config.python_version}")
-            conn.run("uv venv")
-            if self.config.requirements:
-                conn.run(f"uv pip install -r {release_dir}/requirements.txt")
+            with trace.span("venv rebuild"):
+                commands = [
+                    "sudo rm -rf .venv",
+                    f"uv python install {self.config.python_version}",
+                    "uv venv",
+                ]
+                if self.config.requirements:
+                    commands.append(f"uv pip install -r {release_dir}/requirements.txt")
+                conn.run(" && ".join(commands))
         else:
             self.stdout.output(
                 "[blue]Requirements unchanged, skipping virtualenv rebuild...[/blue]"
@@ -266,5 +502,4 @@ export PATH="{self.config.app_dir}:$PATH"
 """
         conn.run(f"echo '{appenv.strip()}' > {self.config.app_dir}/.appenv")
         full_path_app_bin = f"{self.config.app_dir}/{self.config.app_bin}"
-        conn.run(f"rm {full_path_app_bin}", warn=True)
-        conn.run(f"ln -s {remote_package_path} {full_path_app_bin}")
+        conn.run(f"ln -sfn {remote_package_path} {full_path_app_bin}")
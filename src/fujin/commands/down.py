@@ -41,7 +41,7 @@ class Down(BaseCommand):
             if self.config.webserver.enabled:
                 caddy.teardown(conn, self.config)
 
-            active_systemd_units = self.config.active_systemd_units
+            active_systemd_units = self.config.all_systemd_units
             self.stdout.output(
                 f"[blue]Stopping and disabling services: {' '.join(active_systemd_units)}[/blue]"
             )
@@ -49,10 +49,12 @@ class Down(BaseCommand):
                 f"sudo systemctl disable --now {' '.join(active_systemd_units)}",
                 warn=True,
             )
-            # Remove service files
-            unit_files = list(self.config.render_systemd_units().keys())
-            paths = [f"/etc/systemd/system/{name}" for name in unit_files]
-            conn.run(f"sudo rm {' '.join(paths)}", warn=True)
+            # Remove service files and drop-in directories
+            names = {
+                name.split("/", 1)[0]: None for name in self.config.systemd_unit_files
+            }
+            paths = [f"/etc/systemd/system/{name}" for name in names]
+            conn.run(f"sudo rm -rf {' '.join(paths)}", warn=True)
 
             conn.run("sudo systemctl daemon-reload")
             conn.run("sudo systemctl reset-failed")
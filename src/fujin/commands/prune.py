@@ -38,6 +38,8 @@ class Prune(BaseCommand):
             ):
                 return
             to_prune = [f"{self.config.app_dir}/v{v}" for v in result_list]
-            conn.run(f"rm -r {' '.join(to_prune)}", warn=True)
-            conn.run(f"sed -i '{self.keep + 1},$d' .versions", warn=True)
+            conn.run(
+                f"rm -r {' '.join(to_prune)}; sed -i '{self.keep + 1},$d' .versions",
+                warn=True,
+            )
             self.stdout.output("[green]Pruning completed successfully[/green]")
@@ -1,37 +1,65 @@
+from contextlib import nullcontext
 from dataclasses import dataclass
+from pathlib import Path
+from typing import Annotated
 
 import cappa
+from fabric import Connection
 from rich.prompt import Confirm
 from rich.prompt import Prompt
 
+from fujin import caddy
+from fujin import history
+from fujin import loadgen
+from fujin import metrics
+from fujin import trace
 from fujin.commands import BaseCommand
 from fujin.commands.deploy import Deploy
+from fujin.plan import RemoteState
+from fujin.plan import gather_remote_state
 
 
 @cappa.command(help="Rollback application to a previous version")
 @dataclass
 class Rollback(BaseCommand):
+    discovers_host_facts = True
+
+    trace_file: Annotated[
+        Path | None,
+        cappa.Arg(
+            long="--trace",
+            help="Write a timing trace of the rollback to this file, in the Chrome trace event format",
+        ),
+    ] = None
+
+    verify_zero_downtime: Annotated[
+        bool,
+        cappa.Arg(
+            long="--verify-zero-downtime",
+            help="Send requests to the app for the whole rollback and report the errors and latencies around the restart",
+        ),
+    ] = False
+
+    verify_url: Annotated[
+        str | None,
+        cappa.Arg(
+            long="--verify-url",
+            help="Url requested by --verify-zero-downtime, defaults to the domain of the host",
+        ),
+    ] = None
+
     def __call__(self):
-        with self.connection() as conn:
-            result = conn.run(
-                "sed -n '2,$p' .versions", warn=True, hide=True
-            ).stdout.strip()
-            if not result:
-                self.stdout.output("[blue]No rollback targets available")
+        deploy = Deploy(
+            verify_zero_downtime=self.verify_zero_downtime, verify_url=self.verify_url
+        )
+        deploy.config = self.config
+        with self.connection() as conn, conn.cd(self.config.app_dir):
+            remote = gather_remote_state(conn, self.config)
+            versions = remote.versions[1:]
+            version = self.choose_version(versions)
+            if not version:
                 return
-            versions: list[str] = result.split("\n")
-            try:
-                version = Prompt.ask(
-                    "Enter the version you want to rollback to:",
-                    choices=versions,
-                    default=versions[0],
-                )
-            except KeyboardInterrupt as e:
-                raise cappa.Exit("Rollback aborted by user.", code=0) from e
-
-            current_app_version = conn.run(
-                "head -n 1 .versions", warn=True, hide=True
-            ).stdout.strip()
+            current_app_version = remote.current_version
             versions_to_clean = [current_app_version] + versions[
                 : versions.index(version)
             ]
@@ -40,11 +68,65 @@ class Rollback(BaseCommand):
             )
             if not confirm:
                 return
-            deploy = Deploy()
-            deploy.install_project(conn, version=version, rolling_back=True)
-            deploy.restart_services(conn)
-            conn.run(f"rm -r {' '.join(f'v{v}' for v in versions_to_clean)}", warn=True)
-            conn.run(f"sed -i '1,/{version}/{{/{version}/!d}}' .versions", warn=True)
+            # recorded once the prompts are answered, so the time spent on them doesn't
+            # count in the rollback duration
+            load = deploy.load_generator()
+            with trace.tracing() as tracer:
+                try:
+                    with (
+                        history.recording(self.config, "rollback", version),
+                        load.running(loadgen.SETTLE_SECONDS) if load else nullcontext(),
+                    ):
+                        self.rollback(
+                            conn,
+                            deploy,
+                            remote=remote,
+                            version=version,
+                            versions_to_clean=versions_to_clean,
+                        )
+                finally:
+                    if self.trace_file:
+                        tracer.save(self.trace_file)
             self.stdout.output(
                 f"[green]Rollback to version {version} from {current_app_version} completed successfully![/green]"
             )
+        self.stdout.output(tracer.summary_table())
+        if load:
+            deploy.report_downtime(load, tracer)
+
+    def choose_version(self, versions: list[str]) -> str | None:
+        if not versions:
+            self.stdout.output("[blue]No rollback targets available")
+            return None
+        try:
+            return Prompt.ask(
+                "Enter the version you want to rollback to:",
+                choices=versions,
+                default=versions[0],
+            )
+        except KeyboardInterrupt as e:
+            raise cappa.Exit("Rollback aborted by user.", code=0) from e
+
+    def rollback(
+        self,
+        conn: Connection,
+        deploy: Deploy,
+        *,
+        remote: RemoteState,
+        version: str,
+        versions_to_clean: list[str],
+    ) -> None:
+        deploy.install_project(conn, remote=remote, version=version, rolling_back=True)
+        with caddy.edge_drained(self.config):
+            deploy.restart_services(conn, remote=remote)
+        with trace.span("cleanup"):
+            conn.run(
+                metrics.with_textfile(
+                    self.config,
+                    f"rm -r {' '.join(f'v{v}' for v in versions_to_clean)}; "
+                    f"sed -i '1,{len(versions_to_clean)}d' .versions",
+                    command="rollback",
+                    version=version,
+                ),
+                warn=True,
+            )
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Annotated
+
+import cappa
+from rich.filesize import decimal
+from rich.table import Table
+
+from fujin import history
+from fujin.commands import BaseCommand
+
+
+@cappa.command(help="Show timing statistics of past deploys and rollbacks")
+@dataclass
+class Stats(BaseCommand):
+    command: Annotated[
+        str,
+        cappa.Arg(
+            choices=["deploy", "rollback"],
+            short="-c",
+            long="--command",
+            help="Which kind of run to report on",
+        ),
+    ] = "deploy"
+    last: Annotated[
+        int,
+        cappa.Arg(
+            short="-n",
+            long="--last",
+            help="Number of most recent runs to include",
+        ),
+    ] = 20
+    threshold: Annotated[
+        float,
+        cappa.Arg(
+            long="--threshold",
+            help="Flag a step as regressed when the latest run is this many times slower than the median",
+        ),
+    ] = 1.5
+
+    def __call__(self):
+        records = [
+            r
+            for r in history.read(history.history_path(self.config))
+            if r.command == self.command
+            and r.app == self.config.app_name
+            and r.host == self.config.host.ip
+        ][-self.last :]
+        if not records:
+            self.stdout.output(f"[blue]No {self.command} recorded yet[/blue]")
+            return
+
+        successes = [r for r in records if r.outcome == "success"]
+        latest = successes[-1] if successes else None
+        previous = successes[:-1]
+
+        table = Table(
+            title=f"{self.command.capitalize()} steps over the last {len(records)} runs",
+            header_style="bold cyan",
+        )
+        table.add_column("Step")
+        table.add_column("Runs", justify="right")
+        table.add_column("p50", justify="right")
+        table.add_column("p95", justify="right")
+        table.add_column("Latest", justify="right")
+        table.add_column("")
+
+        steps = {name: None for r in successes for name in r.steps}
+        for name in [*steps, "total"]:
+            if name == "total":
+                values = [r.duration for r in successes]
+                latest_value = latest.duration if latest else None
+                baseline = [r.duration for r in previous]
+            else:
+                values = [r.steps[name] for r in successes if name in r.steps]
+                latest_value = latest.steps.get(name) if latest else None
+                baseline = [r.steps[name] for r in previous if name in r.steps]
+            if not values:
+                continue
+            flag = ""
+            if latest_value is not None and baseline:
+                median = history.percentile(baseline, 50)
+                if median and latest_value > median * self.threshold:
+                    flag = (
+                        f"[bold red]regressed x{latest_value / median:.1f}[/bold red]"
+                    )
+            table.add_row(
+                f"[bold]{name}[/bold]" if name == "total" else name,
+                str(len(values)),
+                f"{history.percentile(values, 50):.2f}s",
+                f"{history.percentile(values, 95):.2f}s",
+                f"{latest_value:.2f}s" if latest_value is not None else "-",
+                flag,
+            )
+
+        failures = len(records) - len(successes)
+        rebuilds = sum(1 for r in successes if r.venv_rebuilt)
+        uploaded = [r.bytes_uploaded for r in successes]
+        table.caption = (
+            f"{failures} failed, {rebuilds} virtualenv rebuilds, "
+            f"median upload {decimal(int(history.percentile(uploaded, 50)))}"
+        )
+        self.stdout.output(table)
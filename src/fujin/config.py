@@ -1,14 +1,20 @@
 from __future__ import annotations
 
-import importlib.util
 import os
+import re
 import sys
+from collections.abc import Callable
 from pathlib import Path
+from typing import Iterator
 
 import msgspec
-from jinja2 import Environment, FileSystemLoader, TemplateNotFound
 
 from .errors import ImproperlyConfiguredError
+from .localstate import ignored_dir
+from .templating import is_template_string
+from .templating import render_string
+from .templating import select_template
+from .templating import template_variables
 
 if sys.version_info >= (3, 11):
     import tomllib
@@ -41,24 +47,263 @@ class SecretConfig(msgspec.Struct):
     password_env: str | None = None
 
 
+_CPU_QUOTA = re.compile(r"^\d+%$")
+_MEMORY = re.compile(r"^(\d+[KMGT]?|\d+%|infinity)$")
+_CPU_LIST = re.compile(r"^\d+(-\d+)?(,\d+(-\d+)?)*$")
+
+# resource fields and the systemd setting they render to, in rendering order
+_DIRECTIVES = {
+    "cpu_quota": "CPUQuota",
+    "cpu_weight": "CPUWeight",
+    "io_weight": "IOWeight",
+    "memory_high": "MemoryHigh",
+    "memory_max": "MemoryMax",
+    "nice": "Nice",
+    "limit_nofile": "LimitNOFILE",
+    "tasks_max": "TasksMax",
+    "timeout_stop_sec": "TimeoutStopSec",
+    "cpu_affinity": "CPUAffinity",
+}
+
+
+def _validate_resource_controls(config: ResourcesConfig | SliceConfig) -> None:
+    def value(name: str):
+        return getattr(config, name, None)
+
+    if value("cpu_quota") is not None and not _CPU_QUOTA.match(value("cpu_quota")):
+        raise ImproperlyConfiguredError(
+            f"Invalid cpu_quota {value('cpu_quota')!r}, use a percentage e.g: '150%'"
+        )
+    for name in ("memory_high", "memory_max"):
+        if value(name) is not None and not _MEMORY.match(value(name)):
+            raise ImproperlyConfiguredError(
+                f"Invalid {name} {value(name)!r}, use bytes with an optional K, M, G or T suffix, a percentage or 'infinity'"
+            )
+    for name in ("cpu_weight", "io_weight"):
+        if value(name) is not None and not 1 <= value(name) <= 10000:
+            raise ImproperlyConfiguredError(
+                f"{name} must be between 1 and 10000, got {value(name)}"
+            )
+    if value("nice") is not None and not -20 <= value("nice") <= 19:
+        raise ImproperlyConfiguredError(
+            f"nice must be between -20 and 19, got {value('nice')}"
+        )
+    for name in ("limit_nofile", "tasks_max", "timeout_stop_sec"):
+        if value(name) is not None and value(name) < 1:
+            raise ImproperlyConfiguredError(
+                f"{name} must be positive, got {value(name)}"
+            )
+    if value("cpu_affinity") is not None and not _CPU_LIST.match(value("cpu_affinity")):
+        raise ImproperlyConfiguredError(
+            f"Invalid cpu_affinity {value('cpu_affinity')!r}, use a cpu list e.g: '0-3,8'"
+        )
+
+
+def _directives(config: ResourcesConfig | SliceConfig) -> dict[str, str]:
+    """Systemd settings of the configured resource controls, in rendering order."""
+    directives = {}
+    for name, key in _DIRECTIVES.items():
+        value = getattr(config, name, None)
+        if value is not None:
+            directives[key] = str(value)
+    return directives
+
+
+class ResourcesConfig(msgspec.Struct, kw_only=True, forbid_unknown_fields=True):
+    cpu_quota: str | None = None
+    cpu_weight: int | None = None
+    io_weight: int | None = None
+    memory_high: str | None = None
+    memory_max: str | None = None
+    nice: int | None = None
+    limit_nofile: int | None = None
+    tasks_max: int | None = None
+    timeout_stop_sec: int | None = None
+    cpu_affinity: str | None = None
+    pin_replicas: bool = False
+
+    def __post_init__(self):
+        _validate_resource_controls(self)
+        if self.pin_replicas and not self.cpu_affinity:
+            raise ImproperlyConfiguredError(
+                "'pin_replicas' needs a 'cpu_affinity' to split between the replicas."
+            )
+
+    @property
+    def directives(self) -> dict[str, str]:
+        return _directives(self)
+
+    def replica_affinities(self, replicas: int) -> list[str]:
+        """
+        Split the cpu_affinity set into one disjoint cpu list per replica, if there are
+        fewer cpus than replicas, the replicas are spread round robin over the cpus.
+        """
+        cpus = parse_cpu_list(self.cpu_affinity or "")
+        if len(cpus) < replicas:
+            return [str(cpus[i % len(cpus)]) for i in range(replicas)]
+        size, extra = divmod(len(cpus), replicas)
+        affinities, start = [], 0
+        for i in range(replicas):
+            end = start + size + (1 if i < extra else 0)
+            affinities.append(format_cpu_list(cpus[start:end]))
+            start = end
+        return affinities
+
+
+class SliceConfig(msgspec.Struct, kw_only=True, forbid_unknown_fields=True):
+    """Resource budget shared by all the units of the app."""
+
+    cpu_weight: int | None = None
+    cpu_quota: str | None = None
+    io_weight: int | None = None
+    memory_high: str | None = None
+    memory_max: str | None = None
+    tasks_max: int | None = None
+
+    def __post_init__(self):
+        _validate_resource_controls(self)
+
+    @property
+    def directives(self) -> dict[str, str]:
+        return _directives(self)
+
+
+_BUFFER = re.compile(r"^\d+[KMG]?$")
+
+
+class SocketConfig(msgspec.Struct, kw_only=True, forbid_unknown_fields=True):
+    """Listener of a socket activated process, ``socket = true`` uses the defaults."""
+
+    listen: str | None = None
+    reuse_port: bool = False
+    backlog: int | None = None
+    receive_buffer: str | None = None
+    send_buffer: str | None = None
+
+    def __post_init__(self):
+        if self.backlog is not None and self.backlog < 1:
+            raise ImproperlyConfiguredError(
+                f"backlog must be positive, got {self.backlog}"
+            )
+        for name in ("receive_buffer", "send_buffer"):
+            value = getattr(self, name)
+            if value is not None and not _BUFFER.match(value):
+                raise ImproperlyConfiguredError(
+                    f"Invalid {name} {value!r}, use bytes with an optional K, M or G suffix"
+                )
+
+    @property
+    def is_unix(self) -> bool:
+        return self.listen is None or self.listen.startswith("/")
+
+    @property
+    def directives(self) -> dict[str, str]:
+        """Systemd settings of the [Socket] section, besides the ListenStream."""
+        values = {
+            "ReusePort": "true" if self.reuse_port else None,
+            "Backlog": self.backlog,
+            "ReceiveBuffer": self.receive_buffer,
+            "SendBuffer": self.send_buffer,
+        }
+        return {key: str(value) for key, value in values.items() if value is not None}
+
+
+class HostFacts(msgspec.Struct, kw_only=True):
+    """Hardware of the host, available to the templates as ``host``."""
+
+    cpus: int
+    mem_mb: int
+
+
+def uses_host_facts(command: str) -> bool:
+    """Whether a process command renders the ``host`` template variable."""
+    return is_template_string(command) and "host" in template_variables(command)
+
+
+class WarmupConfig(msgspec.Struct, kw_only=True, forbid_unknown_fields=True):
+    urls: list[str] = msgspec.field(default_factory=list)
+    command: str | None = None
+    requests: int = 10
+
+    def __post_init__(self):
+        if bool(self.urls) == bool(self.command):
+            raise ImproperlyConfiguredError(
+                "A warm-up needs either 'urls' or a 'command'."
+            )
+        if self.requests < 1:
+            raise ImproperlyConfiguredError("Warm-up requests must be at least 1.")
+        for url in self.urls:
+            if not url.startswith(("/", "http://", "https://")):
+                raise ImproperlyConfiguredError(
+                    f"Invalid warm-up url {url!r}, use a path or an absolute url"
+                )
+
+
 class ProcessConfig(msgspec.Struct):
     command: str
-    replicas: int = 1
-    socket: bool = False
+    replicas: int | str = 1
+    socket: bool | SocketConfig = False
     timer: str | None = None
+    resources: ResourcesConfig | None = None
+    warmup: WarmupConfig | None = None
+    restart_strategy: str = "restart"
 
     def __post_init__(self):
         if self.socket and self.timer:
             raise ImproperlyConfiguredError(
                 "A process cannot have both 'socket' and 'timer' enabled."
             )
-        if self.replicas > 1 and (self.socket or self.timer):
+        if self.restart_strategy not in RESTART_STRATEGIES:
+            raise ImproperlyConfiguredError(
+                f"Invalid restart_strategy {self.restart_strategy!r}, use one of {', '.join(RESTART_STRATEGIES)}"
+            )
+        if isinstance(self.replicas, str) and self.replicas != "auto":
             raise ImproperlyConfiguredError(
-                "A process cannot have replicas > 1 and either 'socket' or 'timer' enabled."
+                f"Invalid replicas {self.replicas!r}, use a number or 'auto'"
             )
+        if self.templated and self.timer:
+            raise ImproperlyConfiguredError(
+                "A process cannot have replicas > 1 and 'timer' enabled."
+            )
+        socket = self.socket_config
+        if self.templated and socket and not socket.is_unix and not socket.reuse_port:
+            raise ImproperlyConfiguredError(
+                "Replicas of a socket activated process can only share a tcp listener with 'reuse_port' enabled."
+            )
+        if self.templated and socket and socket.listen and socket.is_unix:
+            if "%i" not in socket.listen:
+                raise ImproperlyConfiguredError(
+                    f"Replicas of a socket activated process need their own unix socket, add '%i' to the listen path {socket.listen!r}."
+                )
+
+    @property
+    def socket_config(self) -> SocketConfig | None:
+        if isinstance(self.socket, SocketConfig):
+            return self.socket
+        return SocketConfig() if self.socket else None
 
+    @property
+    def templated(self) -> bool:
+        """Whether the process runs as instances of a template unit."""
+        # auto replicas always use a template, the unit names don't depend on the host
+        return self.replicas == "auto" or self.replicas > 1
+
+    @property
+    def pinned_replicas(self) -> bool:
+        return bool(self.resources and self.resources.pin_replicas and self.templated)
 
-class Config(msgspec.Struct, kw_only=True):
+    @property
+    def service_directives(self) -> dict[str, str]:
+        if not self.resources:
+            return {}
+        directives = self.resources.directives
+        if self.pinned_replicas:
+            # each replica gets its own cpus through a drop-in
+            directives.pop("CPUAffinity")
+        return directives
+
+
+class Config(msgspec.Struct, kw_only=True, dict=True):
     app_name: str = msgspec.field(name="app")
     version: str = msgspec.field(default_factory=lambda: read_version_from_pyproject())
     versions_to_keep: int | None = 5
@@ -72,6 +317,9 @@ class Config(msgspec.Struct, kw_only=True):
     processes: dict[str, ProcessConfig] = msgspec.field(default_factory=dict)
     webserver: Webserver
     requirements: str | None = None
+    metrics: MetricsConfig | None = None
+    slice: SliceConfig | None = None
+    edge: EdgeConfig | None = None
     local_config_dir: Path = Path(".fujin")
     secret_config: SecretConfig | None = msgspec.field(
         name="secrets",
@@ -79,6 +327,12 @@ class Config(msgspec.Struct, kw_only=True):
     )
 
     def __post_init__(self):
+        # runtime state, kept out of the fujin.toml schema
+        self._host_facts: HostFacts | None = None
+        self.fetch_host_facts: Callable[[], HostFacts | None] | None = None
+        self._live_color: str | None = None
+        self.fetch_live_color: Callable[[], str | None] | None = None
+
         if self.installation_mode == InstallationMode.PY_PACKAGE:
             if not self.python_version:
                 self.python_version = find_python_version()
@@ -91,6 +345,48 @@ class Config(msgspec.Struct, kw_only=True):
                 "Missing web process or set the proxy enabled to False to disable the use of a proxy"
             )
 
+        web = self.processes.get("web")
+        for name, process in self.processes.items():
+            if (
+                name != "web"
+                and process.warmup
+                and any(url.startswith("/") for url in process.warmup.urls)
+            ):
+                raise ImproperlyConfiguredError(
+                    f"Warm-up paths are requested from the web upstreams, use absolute urls for the {name} process."
+                )
+        if self.webserver.blue_green and not self.webserver.enabled:
+            raise ImproperlyConfiguredError(
+                "Blue/green deploys switch the traffic with Caddy, the webserver must be enabled."
+            )
+        if self.webserver.blue_green and not self.webserver.port_base:
+            raise ImproperlyConfiguredError(
+                "Blue/green deploys run the colors of the web process on their own ports, set the webserver 'port_base'."
+            )
+        if self.webserver.blue_green and web and web.socket:
+            raise ImproperlyConfiguredError(
+                "Blue/green deploys are not supported for a socket activated web process."
+            )
+        if (
+            self.webserver.port_base
+            and not self.webserver.blue_green
+            and not (web and web.templated)
+        ):
+            raise ImproperlyConfiguredError(
+                "'port_base' gives each replica of the web process its own port, it needs replicas."
+            )
+        per_instance_sockets = bool(
+            web and web.templated and web.socket and web.socket_config.is_unix
+        )
+        if (
+            self.webserver.enabled
+            and not self.webserver.upstream
+            and not (self.webserver.port_base or per_instance_sockets)
+        ):
+            raise ImproperlyConfiguredError(
+                "Set the webserver upstream, the address your web process listens on."
+            )
+
     @property
     def app_bin(self) -> str:
         if self.installation_mode == InstallationMode.PY_PACKAGE:
@@ -120,105 +416,344 @@ class Config(msgspec.Struct, kw_only=True):
         except msgspec.ValidationError as e:
             raise ImproperlyConfiguredError(f"Improperly configured, {e}") from e
 
-    def get_unit_template_name(self, process_name: str) -> str:
+    @property
+    def host_facts_path(self) -> Path:
+        return self.local_config_dir / ".cache" / "hosts" / f"{self.host.ip}.json"
+
+    @property
+    def cached_host_facts(self) -> HostFacts | None:
+        """Hardware of the host as last discovered, without contacting the host."""
+        if self._host_facts is None and self.host_facts_path.exists():
+            try:
+                self._host_facts = msgspec.json.decode(
+                    self.host_facts_path.read_bytes(), type=HostFacts
+                )
+            except msgspec.DecodeError:
+                return None
+        return self._host_facts
+
+    @property
+    def host_facts(self) -> HostFacts | None:
+        """
+        Hardware of the host, discovered by the deploy preflight and cached in the
+        local config directory for the other commands. When the cache is missing they
+        are fetched once with ``fetch_host_facts``, if set.
+        """
+        if self.cached_host_facts is None and self.fetch_host_facts:
+            fetch, self.fetch_host_facts = self.fetch_host_facts, None
+            if facts := fetch():
+                self.host_facts = facts
+        return self._host_facts
+
+    @host_facts.setter
+    def host_facts(self, facts: HostFacts) -> None:
+        self._host_facts = facts
+        try:
+            ignored_dir(self.local_config_dir / ".cache")
+            self.host_facts_path.parent.mkdir(parents=True, exist_ok=True)
+            self.host_facts_path.write_bytes(msgspec.json.encode(facts))
+        except OSError:
+            # read-only checkout, the facts are discovered again next time
+            pass
+
+    @property
+    def live_color(self) -> str | None:
+        """
+        Color of the web instances serving the traffic with blue/green deploys, read by
+        the deploy preflight or fetched once with ``fetch_live_color``, if set.
+        """
+        if self._live_color is None and self.fetch_live_color:
+            fetch, self.fetch_live_color = self.fetch_live_color, None
+            self._live_color = fetch()
+        return self._live_color
+
+    @live_color.setter
+    def live_color(self, color: str | None) -> None:
+        self._live_color = color
+        self.fetch_live_color = None
+
+    @property
+    def needs_host_facts(self) -> bool:
+        """Whether the unit names or the process commands depend on the host hardware."""
+        return any(
+            config.replicas == "auto" or uses_host_facts(config.command)
+            for config in self.processes.values()
+        )
+
+    def get_replicas(self, process_name: str) -> int:
         config = self.processes[process_name]
-        suffix = "@.service" if config.replicas > 1 else ".service"
+        if config.replicas != "auto":
+            return config.replicas
+        if self.host_facts is None:
+            raise ImproperlyConfiguredError(
+                f"The number of cpus of {self.host.ip} is unknown, it is required by the 'auto' replicas of {process_name}"
+            )
+        return self.host_facts.cpus
+
+    def get_command(self, process_name: str) -> str:
+        """The process command, rendered with the host facts when it is a template."""
+        command = self.processes[process_name].command
+        if not is_template_string(command):
+            return command
+        if uses_host_facts(command) and self.host_facts is None:
+            raise ImproperlyConfiguredError(
+                f"The hardware of {self.host.ip} is unknown, it is required by the command of {process_name}"
+            )
+        return render_string(self.local_config_dir, command, host=self.host_facts)
+
+    def is_template(self, process_name: str) -> bool:
+        """Whether the process runs as instances of a template unit."""
+        if process_name == "web" and self.webserver.blue_green:
+            return True
+        return self.processes[process_name].templated
+
+    def get_instances(
+        self,
+        process_name: str,
+        color: str | None = None,
+        *,
+        all_colors: bool = False,
+    ) -> list[str]:
+        """
+        Instance names of a template unit, the replica numbers, prefixed by the color
+        with blue/green deploys of the web process, e.g: blue-1. Only the live color
+        is listed unless another ``color`` or ``all_colors`` is given.
+        """
+        replicas = range(1, self.get_replicas(process_name) + 1)
+        if process_name == "web" and self.webserver.blue_green:
+            if all_colors:
+                colors = COLORS
+            else:
+                # before the first blue/green deploy, the color it will start
+                colors = (color or self.live_color or next_color(None),)
+            return [f"{c}-{i}" for c in colors for i in replicas]
+        return [str(i) for i in replicas]
+
+    def get_unit_template_name(self, process_name: str) -> str:
+        suffix = "@.service" if self.is_template(process_name) else ".service"
         if process_name == "web":
             return f"{self.app_name}{suffix}"
         return f"{self.app_name}-{process_name}{suffix}"
 
-    def get_active_unit_names(self, process_name: str) -> list[str]:
-        config = self.processes[process_name]
+    def get_active_unit_names(
+        self,
+        process_name: str,
+        color: str | None = None,
+        *,
+        all_colors: bool = False,
+    ) -> list[str]:
         service_name = self.get_unit_template_name(process_name)
-        if config.replicas > 1:
+        if self.is_template(process_name):
             base = service_name.replace("@.service", "")
-            return [f"{base}@{i}.service" for i in range(1, config.replicas + 1)]
+            instances = self.get_instances(process_name, color, all_colors=all_colors)
+            return [f"{base}@{instance}.service" for instance in instances]
         return [service_name]
 
+    def get_socket_unit_name(self, process_name: str) -> str:
+        """Socket unit file of a socket activated process, a template for replicas."""
+        if self.processes[process_name].templated:
+            service_name = self.get_unit_template_name(process_name)
+            return service_name.replace("@.service", "@.socket")
+        return f"{self.app_name}.socket"
+
+    def get_active_socket_names(self, process_name: str) -> list[str]:
+        if self.processes[process_name].templated:
+            # one listener per replica, each activating its own instance
+            return [
+                name.replace(".service", ".socket")
+                for name in self.get_active_unit_names(process_name)
+            ]
+        return [self.get_socket_unit_name(process_name)]
+
+    def get_listen_address(self, process_name: str) -> str:
+        config = self.processes[process_name]
+        if config.socket_config.listen:
+            return config.socket_config.listen
+        if config.templated:
+            base = self.get_unit_template_name(process_name).replace("@.service", "")
+            return f"/run/{base}-%i.sock"
+        return f"/run/{self.app_name}.sock"
+
+    def get_instance_port(self, instance: str) -> int:
+        """Port of a web instance, the colors of blue/green deploys use distinct ports."""
+        color, _, replica = instance.rpartition("-")
+        offset = COLORS.index(color) * self.get_replicas("web") if color else 0
+        return self.webserver.port_base + offset + int(replica)
+
+    def get_web_upstreams(self, color: str | None = None) -> list[str]:
+        """
+        Addresses proxied by the web server, one per replica when the replicas listen on
+        their own port or socket. Blue/green deploys proxy to the instances of ``color``,
+        the live color by default.
+        """
+        web = self.processes.get("web")
+        if self.webserver.port_base:
+            return [
+                f"localhost:{self.get_instance_port(instance)}"
+                for instance in self.get_instances("web", color)
+            ]
+        socket = web.socket_config if web else None
+        if not (socket and web.templated and socket.is_unix):
+            return [self.webserver.upstream]
+        listen = self.get_listen_address("web")
+        return [
+            f"unix/{listen.replace('%i', str(i))}"
+            for i in range(1, self.get_replicas("web") + 1)
+        ]
+
+    @property
+    def slice_name(self) -> str | None:
+        return f"{self.app_name}.slice" if self.slice else None
+
     @property
     def active_systemd_units(self) -> list[str]:
+        """Units of the app, only the live color of a blue/green web process."""
+        return self._systemd_units(all_colors=False)
+
+    @property
+    def all_systemd_units(self) -> list[str]:
+        """Units of the app, both colors of a blue/green web process."""
+        return self._systemd_units(all_colors=True)
+
+    def _systemd_units(self, *, all_colors: bool) -> list[str]:
         services = []
         for name in self.processes:
-            services.extend(self.get_active_unit_names(name))
+            services.extend(self.get_active_unit_names(name, all_colors=all_colors))
         for name, config in self.processes.items():
             if config.socket:
-                services.append(f"{self.app_name}.socket")
+                services.extend(self.get_active_socket_names(name))
             if config.timer:
                 service_name = self.get_unit_template_name(name)
                 services.append(f"{service_name.replace('.service', '')}.timer")
         return services
 
-    def render_systemd_units(self) -> dict[str, str]:
-        package_templates = (
-            Path(importlib.util.find_spec("fujin").origin).parent / "templates"
-        )
-        search_paths = [self.local_config_dir, package_templates]
-        env = Environment(loader=FileSystemLoader(search_paths))
-
-        context = {
-            "app_name": self.app_name,
-            "user": self.host.user,
-            "app_dir": self.app_dir,
-        }
-
-        files = {}
+    def _iter_systemd_units(self) -> Iterator[tuple[str, tuple[str, ...], dict]]:
+        """
+        Yield the filename, the candidate templates and the extra render context for
+        every unit file of the app, without rendering anything.
+        """
         for name, config in self.processes.items():
             service_name = self.get_unit_template_name(name)
             process_name = service_name.replace(".service", "")
-            command = config.command
-            process_config = config
-
             # Try to find a specific template for the process, otherwise use default
-            try:
-                template = env.get_template(f"{name}.service.j2")
-            except TemplateNotFound:
-                template = env.get_template("default.service.j2")
-
-            body = template.render(
-                **context,
-                command=command,
-                process_name=process_name,
-                process=process_config,
+            yield (
+                service_name,
+                (f"{name}.service.j2", "default.service.j2"),
+                {
+                    "process_name": process_name,
+                    "process": config,
+                    "resources": config.service_directives,
+                    "socket_unit": self.get_socket_unit_name(name).replace(
+                        "@.socket", "@%i.socket"
+                    ),
+                },
             )
-            files[service_name] = body
-
-            if process_config.socket:
-                socket_name = f"{self.app_name}.socket"
-                try:
-                    template = env.get_template(f"{name}.socket.j2")
-                except TemplateNotFound:
-                    template = env.get_template("default.socket.j2")
-                body = template.render(**context)
-                files[socket_name] = body
-
-            if process_config.timer:
-                timer_name = f"{service_name.replace('.service', '')}.timer"
-                try:
-                    template = env.get_template(f"{name}.timer.j2")
-                except TemplateNotFound:
-                    template = env.get_template("default.timer.j2")
-                body = template.render(
-                    **context,
-                    process_name=process_name,
-                    process=process_config,
+            if config.pinned_replicas:
+                affinities = config.resources.replica_affinities(
+                    self.get_replicas(name)
+                )
+                for instance in self.get_instances(name, all_colors=True):
+                    replica = int(instance.rpartition("-")[2])
+                    yield (
+                        f"{process_name}{instance}.service.d/cpu-affinity.conf",
+                        (f"{name}.cpu-affinity.conf.j2", "cpu-affinity.conf.j2"),
+                        {"cpus": affinities[replica - 1]},
+                    )
+            if name == "web" and self.webserver.port_base:
+                for instance in self.get_instances(name, all_colors=True):
+                    yield (
+                        f"{process_name}{instance}.service.d/port.conf",
+                        ("web.port.conf.j2", "port.conf.j2"),
+                        {"port": self.get_instance_port(instance)},
+                    )
+            if config.socket:
+                yield (
+                    self.get_socket_unit_name(name),
+                    (f"{name}.socket.j2", "default.socket.j2"),
+                    {
+                        "listen": self.get_listen_address(name),
+                        "socket": config.socket_config.directives,
+                    },
                 )
-                files[timer_name] = body
+            if config.timer:
+                yield (
+                    f"{process_name}.timer",
+                    (f"{name}.timer.j2", "default.timer.j2"),
+                    {"process_name": process_name, "process": config},
+                )
+        if self.slice:
+            yield (
+                self.slice_name,
+                ("default.slice.j2",),
+                {"resources": self.slice.directives},
+            )
+
+    @property
+    def systemd_unit_files(self) -> list[str]:
+        """Names of the unit files generated for the app, bodies are not rendered."""
+        return [filename for filename, _, _ in self._iter_systemd_units()]
 
+    def render_systemd_units(self) -> dict[str, str]:
+        # listed first, the commands and replicas fetch the host facts they need
+        units = list(self._iter_systemd_units())
+        commands = {
+            self.get_unit_template_name(name): self.get_command(name)
+            for name in self.processes
+        }
+        context = {
+            "app_name": self.app_name,
+            "user": self.host.user,
+            "app_dir": self.app_dir,
+            "slice_name": self.slice_name,
+            "host": self.cached_host_facts,
+        }
+        files = {}
+        for filename, template_names, extra_context in units:
+            if filename in commands:
+                extra_context = {**extra_context, "command": commands[filename]}
+            template = select_template(self.local_config_dir, *template_names)
+            files[filename] = template.render(**context, **extra_context)
         return files
 
-    def render_caddyfile(self) -> str:
-        package_templates = (
-            Path(importlib.util.find_spec("fujin").origin).parent / "templates"
-        )
-        search_paths = [self.local_config_dir, package_templates]
-        env = Environment(loader=FileSystemLoader(search_paths))
-        template = env.get_template("Caddyfile.j2")
+    def render_caddyfile(self, color: str | None = None) -> str:
+        template = select_template(self.local_config_dir, "Caddyfile.j2")
+        upstreams = self.get_web_upstreams(color)
         return template.render(
             domain_name=self.host.domain_name,
-            upstream=self.webserver.upstream,
+            upstream=" ".join(upstreams),
+            upstreams=upstreams,
+            proxy=self.webserver.proxy_directives,
+            transport=self.webserver.transport_directives,
             statics=self.webserver.statics,
         )
 
+    def render_edge_caddyfile(self, drained: tuple[str, ...] = ()) -> str:
+        """Caddy config of the edge host, without the ``drained`` backends."""
+        backends = [b for b in self.edge.backends if b.address not in drained]
+        upstreams = [b.address for b in backends]
+        template = select_template(
+            self.local_config_dir, "edge.Caddyfile.j2", "Caddyfile.j2"
+        )
+        return template.render(
+            domain_name=self.host.domain_name,
+            upstream=" ".join(upstreams),
+            upstreams=upstreams,
+            proxy=self.edge.proxy_directives(backends),
+            transport={},
+            statics={},
+        )
+
+    @property
+    def edge_host(self) -> HostConfig:
+        return HostConfig(
+            ip=self.edge.ip,
+            domain_name=self.host.domain_name,
+            user=self.edge.user,
+            ssh_port=self.edge.ssh_port,
+            password_env=self.edge.password_env,
+            _key_filename=self.edge.key_filename,
+        )
+
     @property
     def caddy_config_path(self) -> str:
         return f"{self.webserver.config_dir}/{self.app_name}.caddy"
@@ -265,11 +800,224 @@ class HostConfig(msgspec.Struct, kw_only=True):
         return password
 
 
+class MetricsConfig(msgspec.Struct):
+    textfile_dir: str = "/var/lib/prometheus/node-exporter"
+    enabled: bool = True
+
+
+_DURATION = re.compile(r"^\d+(ms|s|m|h)$")
+_SIZE = re.compile(r"^(\d+([kKMGT]i?B)?|unlimited)$")
+# long enough for the web process to stop (5s by default) and start again
+HOLD_TRY_DURATION = "10s"
+HOLD_TRY_INTERVAL = "250ms"
+COLORS = ("blue", "green")
+RESTART_STRATEGIES = ("restart", "reload")
+
+
+def next_color(live: str | None) -> str:
+    """Color of the web instances started by the next blue/green deploy."""
+    return COLORS[1] if live == COLORS[0] else COLORS[0]
+
+
+class BlueGreenConfig(msgspec.Struct, kw_only=True, forbid_unknown_fields=True):
+    readiness_path: str = "/"
+    readiness_timeout: int = 60
+    grace_period: int = 5
+
+    def __post_init__(self):
+        if not self.readiness_path.startswith("/"):
+            raise ImproperlyConfiguredError(
+                f"readiness_path must be a path, got {self.readiness_path!r}"
+            )
+        if self.readiness_timeout < 1 or self.grace_period < 0:
+            raise ImproperlyConfiguredError(
+                "readiness_timeout must be positive and grace_period can't be negative"
+            )
+
+
+# https://caddyserver.com/docs/caddyfile/directives/reverse_proxy#load-balancing
+LB_POLICIES = {
+    "random",
+    "random_choose",
+    "least_conn",
+    "round_robin",
+    "weighted_round_robin",
+    "first",
+    "ip_hash",
+    "client_ip_hash",
+    "uri_hash",
+    "query",
+    "header",
+    "cookie",
+}
+
+
 class Webserver(msgspec.Struct):
-    upstream: str
+    upstream: str = ""
     enabled: bool = True
     statics: dict[str, str] = msgspec.field(default_factory=dict)
     config_dir: str = "/etc/caddy/conf.d"
+    port_base: int | None = None
+    lb_policy: str | None = None
+    lb_try_duration: str | None = None
+    lb_try_interval: str | None = None
+    fail_duration: str | None = None
+    hold_requests: bool = True
+    request_buffers: str | None = None
+    health_uri: str | None = None
+    health_interval: str | None = None
+    health_timeout: str | None = None
+    keepalive: str | None = None
+    keepalive_idle_conns: int | None = None
+    keepalive_idle_conns_per_host: int | None = None
+    blue_green: BlueGreenConfig | None = None
+
+    def __post_init__(self):
+        if self.lb_policy and self.lb_policy.split()[0] not in LB_POLICIES:
+            raise ImproperlyConfiguredError(
+                f"Unknown lb_policy {self.lb_policy!r}, use one of {', '.join(sorted(LB_POLICIES))}"
+            )
+        for name in (
+            "lb_try_duration",
+            "lb_try_interval",
+            "fail_duration",
+            "health_interval",
+            "health_timeout",
+            "keepalive",
+        ):
+            value = getattr(self, name)
+            if value is not None and not _DURATION.match(value):
+                raise ImproperlyConfiguredError(
+                    f"Invalid {name} {value!r}, use a duration e.g: 500ms, 5s, 2m"
+                )
+        if self.health_uri is not None and not self.health_uri.startswith("/"):
+            raise ImproperlyConfiguredError(
+                f"health_uri must be a path, got {self.health_uri!r}"
+            )
+        if self.request_buffers is not None and not _SIZE.match(self.request_buffers):
+            raise ImproperlyConfiguredError(
+                f"Invalid request_buffers {self.request_buffers!r}, use a size e.g: 64KB, 4MB or unlimited"
+            )
+        for name in (
+            "port_base",
+            "keepalive_idle_conns",
+            "keepalive_idle_conns_per_host",
+        ):
+            value = getattr(self, name)
+            if value is not None and value < 1:
+                raise ImproperlyConfiguredError(f"{name} must be positive, got {value}")
+
+    @property
+    def proxy_directives(self) -> dict[str, str]:
+        """
+        Load balancing and health check settings of the reverse_proxy block. Unless
+        ``hold_requests`` is disabled, requests are retried while an upstream restarts.
+        """
+        lb_try_duration, lb_try_interval = self.lb_try_duration, self.lb_try_interval
+        if self.hold_requests:
+            lb_try_duration = lb_try_duration or HOLD_TRY_DURATION
+            lb_try_interval = lb_try_interval or HOLD_TRY_INTERVAL
+        values = {
+            "lb_policy": self.lb_policy,
+            "lb_try_duration": lb_try_duration,
+            "lb_try_interval": lb_try_interval,
+            "fail_duration": self.fail_duration,
+            "health_uri": self.health_uri,
+            "health_interval": self.health_interval,
+            "health_timeout": self.health_timeout,
+            "request_buffers": self.request_buffers,
+        }
+        return {key: str(value) for key, value in values.items() if value is not None}
+
+    @property
+    def transport_directives(self) -> dict[str, str]:
+        """Connection pool settings of the http transport."""
+        values = {
+            "keepalive": self.keepalive,
+            "keepalive_idle_conns": self.keepalive_idle_conns,
+            "keepalive_idle_conns_per_host": self.keepalive_idle_conns_per_host,
+        }
+        return {key: str(value) for key, value in values.items() if value is not None}
+
+
+class EdgeBackend(msgspec.Struct, kw_only=True):
+    address: str
+    weight: int = 1
+
+    def __post_init__(self):
+        if self.weight < 1:
+            raise ImproperlyConfiguredError(
+                f"The weight of {self.address} must be positive, got {self.weight}"
+            )
+
+
+class EdgeConfig(msgspec.Struct, kw_only=True):
+    """A Caddy host spreading the traffic of the app over the private network."""
+
+    ip: str
+    user: str
+    ssh_port: int = 22
+    key_filename: str | None = None
+    password_env: str | None = None
+    backends: list[EdgeBackend]
+    backend: str | None = None
+    lb_policy: str | None = None
+    lb_try_duration: str | None = "5s"
+    health_uri: str | None = None
+    health_interval: str | None = None
+    config_dir: str = "/etc/caddy/conf.d"
+
+    def __post_init__(self):
+        if not self.backends:
+            raise ImproperlyConfiguredError("The edge needs at least one backend")
+        addresses = [b.address for b in self.backends]
+        if self.backend is not None and self.backend not in addresses:
+            raise ImproperlyConfiguredError(
+                f"The edge backend {self.backend!r} is not one of {', '.join(addresses)}"
+            )
+        # same rules as the reverse proxy of the app host
+        Webserver(
+            upstream=addresses[0],
+            lb_policy=self.lb_policy,
+            lb_try_duration=self.lb_try_duration,
+            health_uri=self.health_uri,
+            health_interval=self.health_interval,
+        )
+
+    def proxy_directives(self, backends: list[EdgeBackend]) -> dict[str, str]:
+        lb_policy = self.lb_policy
+        if lb_policy is None and any(b.weight != 1 for b in backends):
+            weights = " ".join(str(b.weight) for b in backends)
+            lb_policy = f"weighted_round_robin {weights}"
+        values = {
+            "lb_policy": lb_policy,
+            "lb_try_duration": self.lb_try_duration,
+            "health_uri": self.health_uri,
+            "health_interval": self.health_interval,
+        }
+        return {key: str(value) for key, value in values.items() if value is not None}
+
+
+def parse_cpu_list(value: str) -> list[int]:
+    """Expand a systemd cpu list such as ``0-3,8`` into the cpu indexes."""
+    cpus: list[int] = []
+    for part in filter(None, value.split(",")):
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return sorted(set(cpus))
+
+
+def format_cpu_list(cpus: list[int]) -> str:
+    ranges: list[str] = []
+    start = previous = None
+    for cpu in [*cpus, None]:
+        if start is not None and cpu != previous + 1:
+            ranges.append(f"{start}-{previous}" if previous != start else str(start))
+            start = None
+        if start is None:
+            start = cpu
+        previous = cpu
+    return ",".join(ranges)
 
 
 def read_version_from_pyproject():
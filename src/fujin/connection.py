@@ -1,21 +1,199 @@
 from __future__ import annotations
 
+import getpass
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import threading
 from contextlib import contextmanager
 from functools import partial
-from typing import TYPE_CHECKING, Generator
+from pathlib import Path
+from typing import TYPE_CHECKING
+from typing import Callable
+from typing import Generator
+from typing import Iterator
 
 import cappa
 from fabric import Connection
+from invoke import Context
 from invoke import Responder
 from invoke.exceptions import UnexpectedExit
 from paramiko.ssh_exception import AuthenticationException
 from paramiko.ssh_exception import NoValidConnectionsError
 from paramiko.ssh_exception import SSHException
 
+from fujin import trace
+
 if TYPE_CHECKING:
     from fujin.config import HostConfig
 
 
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+# ioctl request to share the extents of a file (btrfs, xfs, bcachefs)
+FICLONE = 0x40049409
+
+
+class LocalConnection(Context):
+    """
+    Runs commands on the current machine with subprocess, with the same ``run``, ``put``,
+    ``cd`` and ``prefix`` interface as a fabric ``Connection``. Relative paths are relative
+    to the home directory, like on a remote host. Files are reflinked when the
+    filesystem supports it, hardlinked when their mode is kept and copied otherwise.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # like an ssh session, commands start in the home directory
+        self.command_cwds.append(str(Path.home()))
+
+    def open(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def put(self, local, remote: str | None = None, preserve_mode: bool = True):
+        if not isinstance(local, (str, os.PathLike)):
+            # a file like object
+            target = self._target_path(remote or "")
+            target.write_bytes(local.read())
+            return
+        source = Path(local)
+        target = self._target_path(remote or source.name)
+        if target.is_dir():
+            target = target / source.name
+        target.unlink(missing_ok=True)
+        source_mode = stat.S_IMODE(source.stat().st_mode)
+        mode = source_mode & 0o777 if preserve_mode else None
+        # a hardlink shares its mode with the source, only link when it is kept as is
+        linked = _clone_file(source, target, hardlink=mode == source_mode)
+        if mode is not None and not linked:
+            target.chmod(mode)
+
+    def _target_path(self, remote: str) -> Path:
+        # like sftp, relative paths are relative to the home directory
+        return Path.home() / remote
+
+
+def _clone_file(source: Path, target: Path, *, hardlink: bool = True) -> bool:
+    """Reflink, hardlink or copy ``source`` to ``target``, returns whether it was hardlinked."""
+    try:
+        import fcntl
+
+        with source.open("rb") as src, target.open("wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return False
+    except (ImportError, OSError):
+        target.unlink(missing_ok=True)
+    if hardlink:
+        try:
+            os.link(source, target)
+            return True
+        except OSError:
+            pass
+    shutil.copyfile(source, target)
+    return False
+
+
+def iter_output(
+    conn: Connection | LocalConnection,
+    command: str,
+    *,
+    stdin: bytes | None = None,
+    chunk_size: int = 64 * 1024,
+) -> Iterator[bytes]:
+    """
+    Run a command on the host without a pty and yield its raw stdout as it arrives, so
+    large or binary outputs are never buffered in memory. Raises if the command fails.
+    The command finds the same executables as ``conn.run``.
+    """
+    with trace.command_span(command) as span:
+        if isinstance(conn, LocalConnection):
+            env = {
+                **os.environ,
+                "PATH": f"{_bin_dirs(getpass.getuser())}:{os.environ.get('PATH', '')}",
+            }
+            # stderr goes to a file, a full stderr pipe would block the command
+            # while stdout is still being read
+            with tempfile.TemporaryFile() as stderr_file:
+                process = subprocess.Popen(
+                    ["bash", "-c", command],
+                    stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=stderr_file,
+                    env=env,
+                )
+                try:
+                    if stdin:
+                        process.stdin.write(stdin)
+                        process.stdin.close()
+                    while chunk := process.stdout.read1(chunk_size):
+                        yield chunk
+                    exit_code = process.wait()
+                finally:
+                    if process.poll() is None:
+                        process.kill()
+                stderr_file.seek(0)
+                stderr = stderr_file.read()
+        else:
+            channel = conn.client.get_transport().open_session()
+            try:
+                # like fabric does for the env of conn.run
+                channel.exec_command(
+                    f'export PATH="{_bin_dirs(conn.user)}:$PATH" && {command}'
+                )
+                # stdout and stderr share the channel window, an unread stderr
+                # would stall stdout too
+                stderr_chunks: list[bytes] = []
+                reader = threading.Thread(
+                    target=_drain_stderr,
+                    args=(channel, stderr_chunks, chunk_size),
+                    daemon=True,
+                )
+                reader.start()
+                if stdin:
+                    channel.sendall(stdin)
+                    channel.shutdown_write()
+                while chunk := channel.recv(chunk_size):
+                    yield chunk
+                exit_code = channel.recv_exit_status()
+                reader.join()
+                stderr = b"".join(stderr_chunks)
+            finally:
+                channel.close()
+        span.args["exit_code"] = exit_code
+        if exit_code != 0:
+            raise cappa.Exit(
+                stderr.decode(errors="replace").strip()
+                or f"{command} exited with {exit_code}",
+                code=1,
+            )
+
+
+def _drain_stderr(channel, chunks: list[bytes], chunk_size: int) -> None:
+    while chunk := channel.recv_stderr(chunk_size):
+        chunks.append(chunk)
+
+
+def _bin_dirs(user: str) -> str:
+    return f"/home/{user}/.cargo/bin:/home/{user}/.local/bin"
+
+
+def is_local_host(host: HostConfig) -> bool:
+    """
+    The host is the current machine and commands would run as the current user. A
+    loopback address on another ssh port is a forwarded VM or container, not this machine.
+    """
+    return (
+        host.ip in LOCAL_HOSTS
+        and host.ssh_port == 22
+        and host.user == getpass.getuser()
+    )
+
+
 def _get_watchers(host: HostConfig) -> list[Responder]:
     if not host.password:
         return []
@@ -31,27 +209,53 @@ def _get_watchers(host: HostConfig) -> list[Responder]:
     ]
 
 
+def _traced_run(run: Callable, command: str, **kwargs):
+    with trace.command_span(command) as span:
+        try:
+            result = run(command, **kwargs)
+        except UnexpectedExit as e:
+            span.args["exit_code"] = e.result.exited
+            raise
+        span.args["exit_code"] = result.exited
+        return result
+
+
+def _traced_put(put: Callable, local, remote=None, **kwargs):
+    size = os.path.getsize(local) if isinstance(local, (str, os.PathLike)) else 0
+    with trace.span(f"put {remote}", "transfer", remote=remote, bytes=size):
+        return put(local, remote, **kwargs)
+
+
 @contextmanager
 def host_connection(host: HostConfig) -> Generator[Connection, None, None]:
-    connect_kwargs = None
-    if host.key_filename:
-        connect_kwargs = {"key_filename": str(host.key_filename)}
-    elif host.password:
-        connect_kwargs = {"password": host.password}
-    conn = Connection(
-        host.ip,
-        user=host.user,
-        port=host.ssh_port,
-        connect_kwargs=connect_kwargs,
-    )
+    bin_dirs = _bin_dirs(host.user)
+    if is_local_host(host):
+        # no shell expands the PATH of a local subprocess environment
+        conn = LocalConnection()
+        path = f"{bin_dirs}:{os.environ.get('PATH', '')}"
+    else:
+        connect_kwargs = None
+        if host.key_filename:
+            connect_kwargs = {"key_filename": str(host.key_filename)}
+        elif host.password:
+            connect_kwargs = {"password": host.password}
+        conn = Connection(
+            host.ip,
+            user=host.user,
+            port=host.ssh_port,
+            connect_kwargs=connect_kwargs,
+        )
+        path = f"{bin_dirs}:$PATH"
     try:
-        conn.run = partial(
+        with trace.span("connect", host=host.ip):
+            conn.open()
+        run = partial(
             conn.run,
-            env={
-                "PATH": f"/home/{host.user}/.cargo/bin:/home/{host.user}/.local/bin:$PATH"
-            },
+            env={"PATH": path},
             watchers=_get_watchers(host),
         )
+        conn.run = partial(_traced_run, run)
+        conn.put = partial(_traced_put, conn.put)
         yield conn
     except AuthenticationException as e:
         msg = f"Authentication failed for {host.user}@{host.ip} -p {host.ssh_port}.\n"
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import msgspec
+
+from fujin import trace
+from fujin.config import Config
+from fujin.config import InstallationMode
+from fujin.localstate import ignored_dir
+
+
+class HistoryRecord(msgspec.Struct, kw_only=True):
+    timestamp: float
+    command: str
+    app: str
+    host: str
+    version: str
+    outcome: str
+    duration: float
+    steps: dict[str, float] = msgspec.field(default_factory=dict)
+    bytes_uploaded: int = 0
+    venv_rebuilt: bool | None = None
+
+
+def history_path(config: Config) -> Path:
+    return config.local_config_dir / "history" / "deploys.jsonl"
+
+
+def append(path: Path, record: HistoryRecord) -> None:
+    ignored_dir(path.parent)
+    with path.open("ab") as f:
+        f.write(msgspec.json.encode(record) + b"\n")
+
+
+def read(path: Path) -> list[HistoryRecord]:
+    if not path.exists():
+        return []
+    decoder = msgspec.json.Decoder(HistoryRecord)
+    records = []
+    for line in path.read_bytes().splitlines():
+        if not line.strip():
+            continue
+        try:
+            records.append(decoder.decode(line))
+        except msgspec.DecodeError:
+            # a partially written line from an interrupted run, skip it
+            continue
+    return records
+
+
+@contextmanager
+def recording(config: Config, command: str, version: str) -> Iterator[None]:
+    """
+    Append a record of the enclosed deploy or rollback to the local history, using the
+    spans collected by the active tracer. Failures are recorded too.
+    """
+    outcome = "failure"
+    try:
+        yield
+        outcome = "success"
+    finally:
+        tracer = trace.current_tracer()
+        if tracer is not None:
+            venv_rebuilt = None
+            if config.installation_mode == InstallationMode.PY_PACKAGE:
+                venv_rebuilt = tracer.has_step("venv rebuild")
+            append(
+                history_path(config),
+                HistoryRecord(
+                    timestamp=time.time(),
+                    command=command,
+                    app=config.app_name,
+                    host=config.host.ip,
+                    version=version,
+                    outcome=outcome,
+                    duration=round(tracer.duration, 3),
+                    steps={
+                        name: round(duration, 3)
+                        for name, duration in tracer.step_durations().items()
+                    },
+                    bytes_uploaded=tracer.bytes_transferred,
+                    venv_rebuilt=venv_rebuilt,
+                ),
+            )
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Linear interpolation percentile, ``p`` is between 0 and 100."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import json
+import shlex
+import zlib
+from datetime import datetime
+from typing import Iterable
+from typing import Iterator
+
+
+def journalctl_command(
+    units: list[str],
+    *,
+    sudo: str = "sudo",
+    lines: int | None = None,
+    follow: bool = False,
+    since: str | None = None,
+    until: str | None = None,
+    grep: str | None = None,
+    priority: str | None = None,
+    compress: bool = True,
+) -> str:
+    """
+    Build a journalctl command that filters on the host and prints entries as json lines.
+    Entries of all the units are merged chronologically by journalctl itself.
+    """
+    args = ["journalctl", *(f"-u {shlex.quote(u)}" for u in units)]
+    args += ["-o json", "--no-pager"]
+    if lines is not None:
+        args.append(f"-n {lines}")
+    if since:
+        args.append(f"--since {shlex.quote(since)}")
+    if until:
+        args.append(f"--until {shlex.quote(until)}")
+    if grep:
+        args.append(f"--grep {shlex.quote(grep)}")
+    if priority:
+        args.append(f"--priority {shlex.quote(priority)}")
+    if follow:
+        args.append("-f")
+    command = f"{sudo} {' '.join(args)}"
+    if compress:
+        # a follow stream is never flushed by gzip, only finite output is compressed
+        command = f"set -o pipefail; {command} | gzip -c -1"
+    return command
+
+
+def sync_command(cursors: dict[str, str | None], *, sudo: str = "sudo") -> str:
+    """
+    Build a command printing, for each unit, a ``::unit::<name>`` marker followed by its
+    json entries written after the given cursor, the whole stream is gzip compressed.
+    """
+    parts = []
+    for unit, cursor in cursors.items():
+        command = f"{sudo} journalctl -u {shlex.quote(unit)} -o json --no-pager"
+        if cursor:
+            command += f" --after-cursor {shlex.quote(cursor)}"
+        parts.append(f"echo {shlex.quote(f'::unit::{unit}')} && {command}")
+    return f"set -o pipefail; {{ {' && '.join(parts)}; }} | gzip -c -1"
+
+
+def iter_lines(chunks: Iterable[bytes], *, compressed: bool) -> Iterator[bytes]:
+    """Decompress and split a byte stream into lines, holding at most one partial line."""
+    decompressor = zlib.decompressobj(wbits=31) if compressed else None
+    pending = b""
+    for chunk in chunks:
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        yield from lines
+    if decompressor is not None:
+        pending += decompressor.flush()
+    if pending:
+        yield pending
+
+
+def iter_entries(chunks: Iterable[bytes], *, compressed: bool) -> Iterator[dict]:
+    for line in iter_lines(chunks, compressed=compressed):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            continue
+
+
+def entry_message(entry: dict) -> str:
+    message = entry.get("MESSAGE", "")
+    if isinstance(message, list):
+        # journald exports non utf-8 messages as a list of bytes
+        message = bytes(message).decode(errors="replace")
+    return message or ""
+
+
+def unit_label(entry: dict, app_name: str) -> str:
+    """Short name of the unit that emitted the entry, e.g: web, worker@2."""
+    unit = entry.get("_SYSTEMD_UNIT") or entry.get("UNIT") or "?"
+    if not unit.startswith(app_name):
+        return unit
+    unit = unit.removeprefix(app_name)
+    for suffix in (".service", ".socket", ".timer"):
+        unit = unit.removesuffix(suffix)
+    # the web process unit is named after the app
+    return unit.removeprefix("-") or "web"
+
+
+def format_entry(entry: dict, app_name: str, label_width: int = 0) -> str:
+    timestamp = int(entry.get("__REALTIME_TIMESTAMP", 0)) / 1_000_000
+    when = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+    label = unit_label(entry, app_name).ljust(label_width)
+    return f"{label} | {when} {entry_message(entry)}"
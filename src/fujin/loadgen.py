@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import http.client
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+from urllib.parse import urlsplit
+
+import cappa
+import msgspec
+from rich.table import Table
+
+from fujin.history import percentile as _percentile
+from fujin.trace import Tracer
+
+# how long the load keeps running once the deploy is done, to sample the new release
+SETTLE_SECONDS = 3.0
+
+
+class Response(msgspec.Struct, array_like=True):
+    at: float  # time.perf_counter() when the request was sent
+    latency: float
+    status: int  # 0 when no response was received
+
+
+class WindowStats(msgspec.Struct, kw_only=True):
+    name: str
+    requests: int
+    errors: int
+    p50: float | None
+    p95: float | None
+    p99: float | None
+    max: float | None
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    return _percentile(values, q) if values else None
+
+
+def is_error(status: int) -> bool:
+    return status == 0 or status >= 500
+
+
+class LoadGenerator:
+    """
+    Sends requests to ``urls`` in turn from ``concurrency`` threads, each with its own
+    keep-alive connections, until stopped. Every response is recorded, connection
+    errors included.
+    """
+
+    def __init__(
+        self,
+        *urls: str,
+        concurrency: int = 4,
+        timeout: float = 10.0,
+        host_header: str | None = None,
+    ):
+        for url in urls:
+            parts = urlsplit(url)
+            if parts.scheme not in ("http", "https") or not parts.hostname:
+                raise cappa.Exit(
+                    f"Invalid url {url!r}, use e.g: https://example.com/", code=1
+                )
+        self.urls = list(urls)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.host_header = host_header
+        self.responses: list[Response] = []
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+
+    def _connect(self, scheme: str, netloc: str) -> http.client.HTTPConnection:
+        cls = (
+            http.client.HTTPSConnection
+            if scheme == "https"
+            else http.client.HTTPConnection
+        )
+        return cls(netloc, timeout=self.timeout)
+
+    def _worker(self, offset: int) -> None:
+        headers = {"User-Agent": "fujin-loadgen"}
+        if self.host_header:
+            headers["Host"] = self.host_header
+        connections: dict[tuple[str, str], http.client.HTTPConnection] = {}
+        i = offset
+        while not self._stop.is_set():
+            parts = urlsplit(self.urls[i % len(self.urls)])
+            i += 1
+            path = parts.path or "/"
+            if parts.query:
+                path += f"?{parts.query}"
+            key = (parts.scheme, parts.netloc)
+            conn = connections.get(key) or self._connect(*key)
+            connections[key] = conn
+            start = time.perf_counter()
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                status = 0
+                conn.close()
+                del connections[key]
+            record = Response(
+                at=start, latency=time.perf_counter() - start, status=status
+            )
+            with self._lock:
+                self.responses.append(record)
+            if status == 0:
+                # don't spin while the host refuses connections
+                self._stop.wait(0.05)
+        for conn in connections.values():
+            conn.close()
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._worker, args=(i,), daemon=True)
+            for i in range(self.concurrency)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> list[Response]:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(self.timeout + 1)
+        return self.responses
+
+    @contextmanager
+    def running(self, settle: float = 0.0) -> Iterator[LoadGenerator]:
+        self.start()
+        try:
+            yield self
+            self._stop.wait(settle)
+        finally:
+            self.stop()
+
+
+def window_stats(name: str, responses: list[Response]) -> WindowStats:
+    latencies = [r.latency for r in responses]
+    return WindowStats(
+        name=name,
+        requests=len(responses),
+        errors=sum(is_error(r.status) for r in responses),
+        p50=percentile(latencies, 50),
+        p95=percentile(latencies, 95),
+        p99=percentile(latencies, 99),
+        max=max(latencies) if latencies else None,
+    )
+
+
+def restart_windows(
+    responses: list[Response], tracer: Tracer, step: str = "restart"
+) -> list[WindowStats]:
+    """Split the responses around the spans of the ``step`` recorded by the tracer."""
+    spans = [s for s in tracer.steps if s.name == step]
+    if not spans:
+        return [window_stats("deploy", responses)]
+    start = tracer.origin + min(s.start for s in spans)
+    end = tracer.origin + max(s.start + s.duration for s in spans)
+    return [
+        window_stats("before", [r for r in responses if r.at < start]),
+        window_stats("during", [r for r in responses if start <= r.at <= end]),
+        window_stats("after", [r for r in responses if r.at > end]),
+    ]
+
+
+def _ms(value: float | None) -> str:
+    return f"{value * 1000:.0f} ms" if value is not None else "-"
+
+
+def stats_table(title: str, windows: list[WindowStats]) -> Table:
+    table = Table(title=title, header_style="bold cyan")
+    table.add_column("Window")
+    for column in ("Requests", "Errors", "p50", "p95", "p99", "Max"):
+        table.add_column(column, justify="right")
+    for window in windows:
+        errors = str(window.errors)
+        table.add_row(
+            window.name,
+            str(window.requests),
+            f"[red]{errors}[/red]" if window.errors else errors,
+            _ms(window.p50),
+            _ms(window.p95),
+            _ms(window.p99),
+            _ms(window.max),
+        )
+    return table
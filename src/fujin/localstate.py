@@ -0,0 +1,15 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+
+def ignored_dir(path: Path) -> Path:
+    """
+    Create a directory of local state under the local config directory, with a
+    ``.gitignore`` so its content never shows up in the project repository.
+    """
+    path.mkdir(parents=True, exist_ok=True)
+    gitignore = path / ".gitignore"
+    if not gitignore.exists():
+        gitignore.write_text("*\n")
+    return path
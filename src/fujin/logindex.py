@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import json
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable
+from typing import Iterator
+
+import cappa
+
+from fujin.config import Config
+from fujin.journal import entry_message
+from fujin.localstate import ignored_dir
+
+UNIT_MARKER = b"::unit::"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cursors (
+    host TEXT NOT NULL,
+    unit TEXT NOT NULL,
+    cursor TEXT NOT NULL,
+    PRIMARY KEY (host, unit)
+);
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    host TEXT NOT NULL,
+    app TEXT NOT NULL,
+    unit TEXT NOT NULL,
+    priority INTEGER,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_ts ON entries (ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+    message, content='entries', content_rowid='id'
+);
+"""
+
+_DURATION = re.compile(r"^(\d+)\s*([smhdw])$")
+_SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def index_path(config: Config) -> Path:
+    return config.local_config_dir / "logs" / "index.sqlite3"
+
+
+@contextmanager
+def open_index(path: Path) -> Iterator[sqlite3.Connection]:
+    ignored_dir(path.parent)
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    try:
+        try:
+            db.executescript(SCHEMA)
+        except sqlite3.OperationalError as e:
+            raise cappa.Exit(
+                f"The local log index needs sqlite with FTS5 support: {e}", code=1
+            ) from e
+        with db:
+            yield db
+    finally:
+        db.close()
+
+
+def get_cursors(db: sqlite3.Connection, host: str, units: list[str]) -> dict:
+    rows = db.execute("SELECT unit, cursor FROM cursors WHERE host = ?", (host,))
+    known = {row["unit"]: row["cursor"] for row in rows}
+    return {unit: known.get(unit) for unit in units}
+
+
+def store(
+    db: sqlite3.Connection,
+    lines: Iterable[bytes],
+    *,
+    host: str,
+    app: str,
+    batch_size: int = 1000,
+) -> dict[str, int]:
+    """
+    Index the journal entries of a sync stream, where the entries of each unit follow a
+    ``::unit::<name>`` marker line. Returns the number of new entries per unit.
+    """
+    counts: dict[str, int] = {}
+    cursors: dict[str, str] = {}
+    batch: list[tuple] = []
+    unit = None
+
+    def flush():
+        for row in batch:
+            cur = db.execute(
+                "INSERT INTO entries (ts, host, app, unit, priority, message) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                row,
+            )
+            db.execute(
+                "INSERT INTO entries_fts (rowid, message) VALUES (?, ?)",
+                (cur.lastrowid, row[-1]),
+            )
+        batch.clear()
+
+    for line in lines:
+        if line.startswith(UNIT_MARKER):
+            unit = line[len(UNIT_MARKER) :].decode().strip()
+            counts.setdefault(unit, 0)
+            continue
+        if unit is None or not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        priority = entry.get("PRIORITY")
+        batch.append(
+            (
+                int(entry.get("__REALTIME_TIMESTAMP", 0)) / 1_000_000,
+                host,
+                app,
+                unit,
+                int(priority) if priority is not None else None,
+                entry_message(entry),
+            )
+        )
+        cursors[unit] = entry["__CURSOR"]
+        counts[unit] += 1
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    db.executemany(
+        "INSERT INTO cursors (host, unit, cursor) VALUES (?, ?, ?) "
+        "ON CONFLICT (host, unit) DO UPDATE SET cursor = excluded.cursor",
+        [(host, u, c) for u, c in cursors.items()],
+    )
+    return counts
+
+
+def parse_since(value: str, now: float | None = None) -> float:
+    """Parse a relative duration (``2h``, ``30m``, ``1d``) or an ISO date into a timestamp."""
+    now = time.time() if now is None else now
+    if match := _DURATION.match(value.strip()):
+        amount, unit = match.groups()
+        return now - int(amount) * _SECONDS[unit]
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError as e:
+        raise cappa.Exit(
+            f"Invalid --since value {value!r}, use e.g: 2h, 30m, 1d or 2025-01-06T10:00",
+            code=1,
+        ) from e
+
+
+def search(
+    db: sqlite3.Connection,
+    query: str,
+    *,
+    since: float | None = None,
+    unit: str | None = None,
+    limit: int = 100,
+) -> list[sqlite3.Row]:
+    sql = (
+        "SELECT e.ts, e.host, e.app, e.unit, e.priority, e.message "
+        "FROM entries_fts JOIN entries e ON e.id = entries_fts.rowid "
+        "WHERE entries_fts MATCH ?"
+    )
+    params: list = [query]
+    if since is not None:
+        sql += " AND e.ts >= ?"
+        params.append(since)
+    if unit is not None:
+        sql += " AND e.unit = ?"
+        params.append(unit)
+    # most recent matches, printed oldest first
+    sql = f"SELECT * FROM ({sql} ORDER BY e.ts DESC LIMIT ?) ORDER BY ts"
+    params.append(limit)
+    try:
+        return db.execute(sql, params).fetchall()
+    except sqlite3.OperationalError as e:
+        raise cappa.Exit(f"Invalid search query {query!r}: {e}", code=1) from e
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import time
+
+from fujin import trace
+from fujin.config import Config
+from fujin.config import InstallationMode
+
+
+def render_textfile(
+    config: Config, tracer: trace.Tracer, *, command: str, version: str
+) -> str:
+    """Render the metrics of a deploy or rollback in the Prometheus text format."""
+    app = f'app="{config.app_name}"'
+    lines = [
+        "# HELP fujin_deploy_duration_seconds Duration of each step of the last fujin deploy or rollback.",
+        "# TYPE fujin_deploy_duration_seconds gauge",
+    ]
+    durations = {**tracer.step_durations(), "total": tracer.duration}
+    for step, duration in durations.items():
+        lines.append(
+            f'fujin_deploy_duration_seconds{{{app},command="{command}",step="{step}"}} {duration:.3f}'
+        )
+    lines += [
+        "# HELP fujin_release_info Version currently released by fujin.",
+        "# TYPE fujin_release_info gauge",
+        f'fujin_release_info{{{app},version="{version}"}} 1',
+    ]
+    distfile = config.get_distfile_path(version)
+    if distfile.exists():
+        lines += [
+            "# HELP fujin_artifact_bytes Size of the released distribution file.",
+            "# TYPE fujin_artifact_bytes gauge",
+            f"fujin_artifact_bytes{{{app}}} {distfile.stat().st_size}",
+        ]
+    if config.installation_mode == InstallationMode.PY_PACKAGE:
+        lines += [
+            "# HELP fujin_venv_rebuilt Whether the last release rebuilt the virtualenv.",
+            "# TYPE fujin_venv_rebuilt gauge",
+            f"fujin_venv_rebuilt{{{app}}} {int(tracer.has_step('venv rebuild'))}",
+        ]
+    lines += [
+        "# HELP fujin_last_deploy_timestamp Unix time of the last fujin deploy or rollback.",
+        "# TYPE fujin_last_deploy_timestamp gauge",
+        f'fujin_last_deploy_timestamp{{{app},command="{command}"}} {time.time():.0f}',
+    ]
+    return "\n".join(lines)
+
+
+def with_textfile(
+    config: Config, remote_command: str, *, command: str, version: str
+) -> str:
+    """
+    Fold the write of the node_exporter textfile into an existing remote command, so
+    publishing metrics doesn't cost an extra round trip. The file is written to a
+    temporary name first and then renamed, the collector never reads a partial file.
+    """
+    tracer = trace.current_tracer()
+    if not config.metrics or not config.metrics.enabled or tracer is None:
+        return remote_command
+    content = render_textfile(config, tracer, command=command, version=version)
+    target = f"{config.metrics.textfile_dir}/fujin_{config.app_name}.prom"
+    write = (
+        f"echo '{content}' | sudo tee {target}.tmp > /dev/null "
+        f"&& sudo mv {target}.tmp {target}"
+    )
+    return f"{{ {write}; }} 2>/dev/null; {remote_command}"
@@ -0,0 +1,333 @@
+from __future__ import annotations
+
+import hashlib
+import re
+import shlex
+from pathlib import Path
+
+import msgspec
+
+from fujin.config import Config
+from fujin.config import HostFacts
+from fujin.config import InstallationMode
+from fujin.config import next_color
+from fujin.connection import Connection
+from fujin.top import CADDY_METRICS_URL
+
+SYSTEMD_DIR = "/etc/systemd/system"
+HOST_FACTS_COMMAND = "nproc; free -m | awk '/^Mem:/ {print $2}'"
+
+
+class RemoteState(msgspec.Struct, kw_only=True):
+    """Snapshot of what is currently installed on the host for the app."""
+
+    versions: list[str] = msgspec.field(default_factory=list)
+    requirements_hash: str | None = None
+    unit_hashes: dict[str, str] = msgspec.field(default_factory=dict)
+    enabled_links: list[str] = msgspec.field(default_factory=list)
+    loaded_units: list[str] = msgspec.field(default_factory=list)
+    caddy_hash: str | None = None
+    env_hash: str | None = None
+    app_dir_bytes: int | None = None
+    free_bytes: int | None = None
+    host_facts: HostFacts | None = None
+    live_color: str | None = None
+    server_errors: int | None = None
+
+    @property
+    def current_version(self) -> str:
+        return self.versions[0] if self.versions else ""
+
+    def versions_after_deploy(self, version: str) -> list[str]:
+        """Release history as it will be once ``version`` is installed."""
+        if self.current_version == version:
+            return list(self.versions)
+        return [version, *self.versions]
+
+
+class FileChange(msgspec.Struct):
+    path: str
+    status: str  # one of "new", "changed", "unchanged", "stale"
+    size: int = 0
+
+
+class DeployPlan(msgspec.Struct, kw_only=True):
+    version: str
+    current_version: str
+    uploads: list[FileChange]
+    rewrites: list[FileChange]
+    rebuild_venv: bool | None
+    restarts: list[str]
+    reloads: list[str] = msgspec.field(default_factory=list)
+    prunes: list[str]
+    remote: RemoteState
+
+    @property
+    def transfer_bytes(self) -> int:
+        changes = [*self.uploads, *self.rewrites]
+        return sum(c.size for c in changes if c.status in ("new", "changed"))
+
+
+def md5_hexdigest(content: bytes) -> str:
+    return hashlib.md5(content).hexdigest()
+
+
+def echoed_hash(content: str) -> str:
+    """Hash of a file written on the host with ``echo '{content}' > file``."""
+    return md5_hexdigest(f"{content}\n".encode())
+
+
+def gather_remote_state(
+    conn: Connection, config: Config, *, disk_usage: bool = False
+) -> RemoteState:
+    """
+    Collect everything needed to predict a deploy in a single round trip. The disk usage
+    of the app directory is only measured with ``disk_usage``, walking every release and
+    the virtualenv is too slow for the preflight of a deploy.
+    """
+    result = conn.run(
+        remote_state_script(config, disk_usage=disk_usage), warn=True, hide=True
+    )
+    remote = parse_remote_state(result.stdout)
+    if remote.host_facts:
+        config.host_facts = remote.host_facts
+    config.live_color = remote.live_color
+    return remote
+
+
+def remote_state_script(config: Config, *, disk_usage: bool = False) -> str:
+    app_dir = config.app_dir
+    sections = {
+        "versions": f"cat {app_dir}/.versions",
+        "requirements": f"md5sum {app_dir}/v$(head -n 1 {app_dir}/.versions 2>/dev/null)/requirements.txt",
+        "units": f"md5sum {SYSTEMD_DIR}/{config.app_name}* {SYSTEMD_DIR}/{config.app_name}*.d/*.conf",
+        "wants": f"ls {SYSTEMD_DIR}/multi-user.target.wants/{config.app_name}*",
+        "loaded": f"systemctl list-units --full --all --plain --no-legend '{config.app_name}*'",
+        "caddy": f"md5sum {config.caddy_config_path}",
+        "env": f"md5sum {app_dir}/.env",
+        "host": HOST_FACTS_COMMAND,
+        "color": f"cat {app_dir}/.color",
+    }
+    if config.webserver.enabled:
+        # first sample of the 5xx responses, the deploy compares it after the restart
+        sections["5xx"] = server_errors_command(config)
+    if disk_usage:
+        sections["disk"] = (
+            f"du -sb {app_dir} | cut -f1; df -B1 --output=avail ~ | tail -n 1"
+        )
+    return "\n".join(
+        f"echo '::{name}::'; {{ {command}; }} 2>/dev/null"
+        for name, command in sections.items()
+    )
+
+
+def parse_remote_state(output: str) -> RemoteState:
+    sections: dict[str, list[str]] = {}
+    current: list[str] = []
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith("::") and line.endswith("::"):
+            current = sections.setdefault(line.strip(":"), [])
+        elif line:
+            current.append(line)
+
+    def hashes(name: str) -> dict[str, str]:
+        result = {}
+        for line in sections.get(name, []):
+            parts = line.split(maxsplit=1)
+            if len(parts) == 2:
+                result[Path(parts[1]).name] = parts[0]
+        return result
+
+    def unit_hashes() -> dict[str, str]:
+        # drop-ins are keyed by their path relative to the systemd directory
+        result = {}
+        for line in sections.get("units", []):
+            parts = line.split(maxsplit=1)
+            if len(parts) == 2:
+                name = parts[1].partition(f"{SYSTEMD_DIR}/")[2] or Path(parts[1]).name
+                result[name] = parts[0]
+        return result
+
+    def first_hash(name: str) -> str | None:
+        values = list(hashes(name).values())
+        return values[0] if values else None
+
+    disk = [int(v) for v in sections.get("disk", []) if v.isdigit()]
+    return RemoteState(
+        versions=sections.get("versions", []),
+        requirements_hash=first_hash("requirements"),
+        unit_hashes=unit_hashes(),
+        enabled_links=[Path(line).name for line in sections.get("wants", [])],
+        loaded_units=[line.split()[0] for line in sections.get("loaded", [])],
+        caddy_hash=first_hash("caddy"),
+        env_hash=first_hash("env"),
+        app_dir_bytes=disk[0] if len(disk) > 1 else None,
+        free_bytes=disk[-1] if disk else None,
+        host_facts=parse_host_facts(sections.get("host", [])),
+        live_color=next(iter(sections.get("color", [])), None),
+        server_errors=parse_server_errors(sections.get("5xx", [])),
+    )
+
+
+def parse_host_facts(lines: list[str]) -> HostFacts | None:
+    values = [int(v) for v in lines if v.isdigit()]
+    if len(values) != 2:
+        return None
+    return HostFacts(cpus=values[0], mem_mb=values[1])
+
+
+def gather_host_facts(conn: Connection) -> HostFacts | None:
+    result = conn.run(HOST_FACTS_COMMAND, warn=True, hide=True)
+    return parse_host_facts(result.stdout.split())
+
+
+def server_errors_command(config: Config) -> str:
+    """
+    Number of 5xx responses caddy proxied for the site of the app since it started.
+    Caddy labels the metrics with the site with its ``per_host`` metrics option, nothing
+    is printed without it, the counters of the other sites never count.
+    """
+    site = f'host="{config.host.domain_name}"'
+    return (
+        f"curl -sf --max-time 1 {CADDY_METRICS_URL} | awk -v site={shlex.quote(site)} "
+        "'/^caddy_http_request_duration_seconds_count\\{/ && index($0, site) "
+        '&& index($0, "handler=\\"reverse_proxy\\"") '
+        '{n++; if ($0 ~ /code="5/) s += $NF} END {if (n) printf "%d\\n", s}\''
+    )
+
+
+def parse_server_errors(lines: list[str]) -> int | None:
+    values = [int(v) for v in lines if v.isdigit()]
+    return values[0] if values else None
+
+
+def gather_server_errors(conn: Connection, config: Config) -> int | None:
+    result = conn.run(server_errors_command(config), warn=True, hide=True)
+    return parse_server_errors(str(result.stdout).split())
+
+
+def changed_processes(config: Config, remote: RemoteState) -> set[str]:
+    """Processes whose unit files, sockets, timers or drop-ins differ from the host."""
+    bases = {
+        config.get_unit_template_name(name).removesuffix(".service").rstrip("@"): name
+        for name in config.processes
+    }
+    changed = set()
+    for filename, content in config.render_systemd_units().items():
+        if remote.unit_hashes.get(filename) == echoed_hash(content):
+            continue
+        # e.g: app-worker@.service, app@1.service.d/port.conf, app.socket
+        base = re.split(r"[@.]", filename, maxsplit=1)[0]
+        if base in bases and not filename.endswith(".slice"):
+            changed.add(bases[base])
+    return changed
+
+
+def reloaded_units(
+    config: Config, remote: RemoteState, env_content: str | None = None
+) -> list[str]:
+    """
+    Units of the processes using the reload restart strategy, unless their unit files
+    changed, a new ``ExecStart`` needs a restart. A new ``.env`` (``env_content``)
+    needs a restart too, a reloaded process keeps the environment it started with.
+    """
+    if env_content is not None and remote.env_hash != echoed_hash(env_content):
+        return []
+    changed = changed_processes(config, remote)
+    return [
+        unit
+        for name, process in config.processes.items()
+        if process.restart_strategy == "reload"
+        and name not in changed
+        and not (name == "web" and config.webserver.blue_green)
+        for unit in config.get_active_unit_names(name)
+    ]
+
+
+def build_plan(config: Config, remote: RemoteState, env_content: str) -> DeployPlan:
+    version = config.version
+    release_dir = config.get_release_dir(version)
+
+    def compare(path: str, content: str, remote_hash: str | None) -> FileChange:
+        if remote_hash is None:
+            status = "new"
+        elif echoed_hash(content) != remote_hash:
+            status = "changed"
+        else:
+            status = "unchanged"
+        return FileChange(path, status, len(content.encode()) + 1)
+
+    # artifacts
+    distfile = config.get_distfile_path(version)
+    uploads = [
+        FileChange(
+            f"{release_dir}/{distfile.name}",
+            "new",
+            distfile.stat().st_size if distfile.exists() else 0,
+        )
+    ]
+    rebuild_venv = None
+    if config.installation_mode == InstallationMode.PY_PACKAGE:
+        rebuild_venv = True
+        if config.requirements:
+            local_reqs = Path(config.requirements)
+            content = local_reqs.read_bytes() if local_reqs.exists() else b""
+            reuse = (
+                bool(remote.current_version)
+                and md5_hexdigest(content) == remote.requirements_hash
+            )
+            rebuild_venv = not reuse
+            uploads.append(
+                FileChange(
+                    f"{release_dir}/requirements.txt",
+                    "unchanged" if reuse else "new",
+                    len(content),
+                )
+            )
+
+    # configuration files
+    rewrites = [compare(f"{config.app_dir}/.env", env_content, remote.env_hash)]
+    units = config.render_systemd_units()
+    for filename, content in units.items():
+        rewrites.append(
+            compare(
+                f"{SYSTEMD_DIR}/{filename}", content, remote.unit_hashes.get(filename)
+            )
+        )
+    for filename in remote.unit_hashes:
+        if filename not in units:
+            rewrites.append(FileChange(f"{SYSTEMD_DIR}/{filename}", "stale"))
+    reloads = reloaded_units(config, remote, env_content)
+    restarts = [u for u in config.active_systemd_units if u not in reloads]
+    if config.webserver.enabled:
+        color = None
+        if config.webserver.blue_green:
+            # the deploy starts the idle color and points caddy at it
+            color = next_color(remote.live_color)
+            web = config.get_active_unit_names("web")
+            restarts = [u for u in restarts if u not in web]
+            restarts += config.get_active_unit_names("web", color)
+        rewrites.append(
+            compare(
+                config.caddy_config_path,
+                config.render_caddyfile(color),
+                remote.caddy_hash,
+            )
+        )
+
+    # release history after the deploy
+    versions = remote.versions_after_deploy(version)
+    prunes = versions[config.versions_to_keep :] if config.versions_to_keep else []
+
+    return DeployPlan(
+        version=version,
+        current_version=remote.current_version,
+        uploads=uploads,
+        rewrites=rewrites,
+        rebuild_venv=rebuild_venv,
+        restarts=restarts,
+        reloads=reloads,
+        prunes=prunes,
+        remote=remote,
+    )
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import re
+import shlex
+import zlib
+from pathlib import Path
+from typing import Iterable
+
+import cappa
+
+from fujin.config import Config
+
+UNIT_MARKER = "::unit::"
+
+_SECONDS = re.compile(r"^(\d+)\s*(s|m)?$")
+
+
+def parse_seconds(value: str) -> int:
+    """Parse a duration in seconds, e.g: ``30``, ``30s`` or ``2m``."""
+    if match := _SECONDS.match(value.strip()):
+        amount, unit = match.groups()
+        return int(amount) * (60 if unit == "m" else 1)
+    raise cappa.Exit(f"Invalid duration {value!r}, use e.g: 30s or 2m", code=1)
+
+
+def tools_dir(config: Config) -> str:
+    return f"{config.host.apps_dir}/.tools"
+
+
+def py_spy_path(config: Config) -> str:
+    return f"{tools_dir(config)}/bin/py-spy"
+
+
+def install_command(config: Config) -> str:
+    """Install py-spy with uv in the fujin tools directory, unless it is already there."""
+    tools = tools_dir(config)
+    return (
+        f"test -x {py_spy_path(config)} || "
+        f"UV_TOOL_DIR={tools} UV_TOOL_BIN_DIR={tools}/bin uv tool install --quiet py-spy >&2"
+    )
+
+
+def resolve_units(config: Config, process_name: str, replica: int | None) -> list[str]:
+    """
+    Units of the process that can be profiled, a single replica when ``replica`` is set.
+    Only the live color of a blue/green web process is running.
+    """
+    if process_name not in config.processes:
+        raise cappa.Exit(f"Unknown process {process_name!r}", code=1)
+    units = config.get_active_unit_names(process_name)
+    if replica is None:
+        return units
+    if not config.is_template(process_name):
+        if replica != 1:
+            raise cappa.Exit(f"The {process_name} process has no replicas", code=1)
+        return units
+    selected = [
+        unit
+        for unit in units
+        if unit.rsplit("@", 1)[1].removesuffix(".service").rpartition("-")[2]
+        == str(replica)
+    ]
+    if not selected:
+        raise cappa.Exit(f"The {process_name} process has no replica {replica}", code=1)
+    return selected
+
+
+def record_command(
+    config: Config,
+    units: list[str],
+    *,
+    sudo: str,
+    duration: int,
+    rate: int,
+    output_format: str,
+) -> str:
+    """
+    Sample the first running unit of ``units`` and its subprocesses (e.g: gunicorn
+    workers), the profile is printed gzip compressed.
+    """
+    script = (
+        "set -e; pid=0; "
+        f"for unit in {' '.join(units)}; do "
+        'pid=$(systemctl show -p MainPID --value "$unit"); '
+        '[ "$pid" != 0 ] && break; done; '
+        f'if [ "$pid" = 0 ]; then echo "{" ".join(units)} not running" >&2; exit 1; fi; '
+        "out=$(mktemp); trap 'rm -f \"$out\"' EXIT; "
+        f'{py_spy_path(config)} record --pid "$pid" --subprocesses --nonblocking '
+        f'--duration {duration} --rate {rate} --format {output_format} --output "$out" >&2; '
+        'gzip -c "$out"'
+    )
+    return f"{install_command(config)} && {sudo} bash -c {shlex.quote(script)}"
+
+
+def dump_command(config: Config, units: list[str], *, sudo: str) -> str:
+    """
+    Dump the current stack of every unit in parallel, each dump follows a
+    ``::unit::<name>`` marker line.
+    """
+    script = (
+        "dir=$(mktemp -d); trap 'rm -rf \"$dir\"' EXIT; "
+        f"for unit in {' '.join(units)}; do ("
+        'pid=$(systemctl show -p MainPID --value "$unit"); '
+        'if [ "$pid" = 0 ]; then echo "not running"; '
+        f'else {py_spy_path(config)} dump --pid "$pid" --subprocesses; fi'
+        ') > "$dir/$unit" 2>&1 & done; wait; '
+        f"for unit in {' '.join(units)}; do "
+        f'echo "{UNIT_MARKER}$unit"; cat "$dir/$unit"; done'
+    )
+    return f"{install_command(config)} && {sudo} bash -c {shlex.quote(script)}"
+
+
+def parse_dumps(output: str) -> dict[str, str]:
+    dumps: dict[str, list[str]] = {}
+    current: list[str] | None = None
+    for line in output.splitlines():
+        if line.startswith(UNIT_MARKER):
+            current = dumps.setdefault(line[len(UNIT_MARKER) :].strip(), [])
+        elif current is not None:
+            current.append(line)
+    return {unit: "\n".join(lines).strip() for unit, lines in dumps.items()}
+
+
+def write_decompressed(chunks: Iterable[bytes], path: Path) -> int:
+    """
+    Write a gzip stream to ``path`` as it arrives, returns the written size. The stream
+    goes to a temporary sibling first, a failed command leaves no partial profile.
+    """
+    decompressor = zlib.decompressobj(wbits=31)
+    size = 0
+    partial = path.with_name(f".{path.name}.part")
+    try:
+        with partial.open("wb") as f:
+            for chunk in chunks:
+                data = decompressor.decompress(chunk)
+                size += f.write(data)
+            size += f.write(decompressor.flush())
+        partial.replace(path)
+    except BaseException:
+        partial.unlink(missing_ok=True)
+        raise
+    return size
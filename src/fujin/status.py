@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import msgspec
+
+from fujin.config import Config
+
+SHOW_PROPERTIES = [
+    "Id",
+    "ActiveState",
+    "SubState",
+    "MainPID",
+    "MemoryCurrent",
+    "CPUUsageNSec",
+    "NRestarts",
+    "ActiveEnterTimestamp",
+]
+
+# systemd reports unavailable counters as the maximum uint64 value
+_UNSET = 2**64 - 1
+
+
+class UnitStatus(msgspec.Struct, kw_only=True):
+    unit: str
+    process: str
+    active_state: str = "unknown"
+    sub_state: str = ""
+    main_pid: int | None = None
+    memory_bytes: int | None = None
+    cpu_seconds: float | None = None
+    restarts: int | None = None
+    active_since: str | None = None
+
+
+def show_command(units: list[str]) -> str:
+    return f"systemctl show -p {','.join(SHOW_PROPERTIES)} {' '.join(units)}"
+
+
+def parse_show(output: str) -> dict[str, dict[str, str]]:
+    """Parse the ``Key=Value`` blocks printed by ``systemctl show``, keyed by unit id."""
+    units: dict[str, dict[str, str]] = {}
+    block: dict[str, str] = {}
+    for line in [*output.splitlines(), ""]:
+        line = line.strip()
+        if not line:
+            if "Id" in block:
+                units[block["Id"]] = block
+            block = {}
+            continue
+        key, _, value = line.partition("=")
+        block[key] = value
+    return units
+
+
+def parse_counter(value: str | None) -> int | None:
+    """A counter of ``systemctl show``, ``None`` when systemd doesn't track it."""
+    if not value or not value.isdigit() or int(value) == _UNSET:
+        return None
+    return int(value)
+
+
+def unit_labels(config: Config) -> dict[str, str]:
+    """Map every active unit to the process (and replica) it runs, e.g: worker@2."""
+    labels = {}
+    for name, process in config.processes.items():
+        units = config.get_active_unit_names(name)
+        for unit in units:
+            if config.is_template(name):
+                replica = unit.rsplit("@", 1)[1].removesuffix(".service")
+                labels[unit] = f"{name}@{replica}"
+            else:
+                labels[unit] = name
+        if process.socket:
+            for socket in config.get_active_socket_names(name):
+                if process.templated:
+                    replica = socket.rsplit("@", 1)[1].removesuffix(".socket")
+                    labels[socket] = f"socket@{replica}"
+                else:
+                    labels[socket] = "socket"
+        if process.timer:
+            timer = config.get_unit_template_name(name).replace(".service", ".timer")
+            labels[timer] = f"{name} timer"
+    return labels
+
+
+def _unit_status(unit: str, label: str, props: dict[str, str]) -> UnitStatus:
+    cpu = parse_counter(props.get("CPUUsageNSec"))
+    pid = parse_counter(props.get("MainPID"))
+    return UnitStatus(
+        unit=unit,
+        process=label,
+        active_state=props.get("ActiveState") or "unknown",
+        sub_state=props.get("SubState", ""),
+        main_pid=pid or None,
+        memory_bytes=parse_counter(props.get("MemoryCurrent")),
+        cpu_seconds=cpu / 1e9 if cpu is not None else None,
+        restarts=parse_counter(props.get("NRestarts")),
+        active_since=props.get("ActiveEnterTimestamp") or None,
+    )
+
+
+def unit_statuses(config: Config, show_output: str) -> list[UnitStatus]:
+    properties = parse_show(show_output)
+    return [
+        _unit_status(unit, label, properties.get(unit, {}))
+        for unit, label in unit_labels(config).items()
+    ]
+
+
+def slice_status(config: Config, show_output: str) -> UnitStatus | None:
+    """Aggregated usage of all the units of the app, when they run in a slice."""
+    if not config.slice_name:
+        return None
+    props = parse_show(show_output).get(config.slice_name, {})
+    return _unit_status(config.slice_name, "total", props)
@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+from functools import cache
+from pathlib import Path
+
+from jinja2 import Environment
+from jinja2 import FileSystemBytecodeCache
+from jinja2 import FileSystemLoader
+from jinja2 import Template
+from jinja2 import meta
+from jinja2.bccache import Bucket
+
+from fujin.localstate import ignored_dir
+
+PACKAGE_TEMPLATES_DIR = Path(__file__).parent / "templates"
+
+
+@cache
+def get_environment(local_config_dir: Path) -> Environment:
+    """
+    Process-wide template engine, one per local config directory.
+
+    Templates are compiled once per process and the compiled bytecode is persisted
+    under ``{local_config_dir}/.cache/jinja`` so subsequent runs skip the compilation
+    step entirely. Jinja validates cached bytecode against the template source, so
+    editing a template in the local config directory invalidates its cache entry.
+    """
+    env = Environment(
+        loader=FileSystemLoader([local_config_dir, PACKAGE_TEMPLATES_DIR]),
+        bytecode_cache=_BytecodeCache(local_config_dir),
+        # templates don't change during a single fujin invocation
+        auto_reload=False,
+        cache_size=-1,
+    )
+    # precompile the built-in templates, they are used on every render
+    for path in PACKAGE_TEMPLATES_DIR.glob("*.j2"):
+        env.get_template(path.name)
+    return env
+
+
+def select_template(local_config_dir: Path, *names: str) -> Template:
+    return get_environment(local_config_dir).select_template(names)
+
+
+def render_string(local_config_dir: Path, source: str, **context) -> str:
+    return get_environment(local_config_dir).from_string(source).render(**context)
+
+
+def is_template_string(source: str) -> bool:
+    return "{{" in source or "{%" in source
+
+
+@cache
+def template_variables(source: str) -> frozenset[str]:
+    """Variables a template string reads from its render context."""
+    return frozenset(meta.find_undeclared_variables(Environment().parse(source)))
+
+
+class _BytecodeCache(FileSystemBytecodeCache):
+    """
+    Bytecode cache under ``{local_config_dir}/.cache/jinja``, the directory is only
+    created when there is bytecode to write and the local config directory exists.
+    """
+
+    def __init__(self, local_config_dir: Path):
+        self.local_config_dir = local_config_dir
+        super().__init__(str(local_config_dir / ".cache" / "jinja"))
+
+    def dump_bytecode(self, bucket: Bucket) -> None:
+        if not self.local_config_dir.is_dir():
+            return
+        cache_dir = Path(self.directory)
+        try:
+            ignored_dir(cache_dir.parent)
+            cache_dir.mkdir(exist_ok=True)
+            super().dump_bytecode(bucket)
+        except OSError:
+            # read-only checkout or similar, fallback to in-memory compilation only
+            pass
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import shlex
+from typing import Iterable
+from typing import Iterator
+
+import msgspec
+from rich.filesize import decimal
+from rich.table import Table
+
+from fujin.config import Config
+from fujin.status import parse_counter
+from fujin.status import parse_show
+from fujin.status import unit_labels
+
+SAMPLE_PROPERTIES = [
+    "Id",
+    "ActiveState",
+    "CPUUsageNSec",
+    "MemoryCurrent",
+    "IOReadBytes",
+    "IOWriteBytes",
+    "TasksCurrent",
+]
+
+CADDY_METRICS_URL = "http://localhost:2019/metrics"
+
+
+class Sample(msgspec.Struct, kw_only=True):
+    timestamp: float
+    units: dict[str, dict[str, str]]
+    caddy_requests: float | None = None
+
+
+def sampler_command(
+    config: Config, *, interval: float, caddy_metrics_url: str | None
+) -> str:
+    """
+    A shell loop run once on the host, printing one sample of every unit per interval.
+    Samples are framed by ``::sample:: <timestamp>`` and ``::end::`` lines.
+    """
+    units = " ".join(config.active_systemd_units)
+    body = [
+        'echo "::sample:: $(date +%s.%N)"',
+        f"systemctl show -p {','.join(SAMPLE_PROPERTIES)} {units}",
+    ]
+    if caddy_metrics_url:
+        # total of the requests counters, only when caddy metrics are enabled
+        body += [
+            "echo '::caddy::'",
+            f"curl -sf --max-time 1 {shlex.quote(caddy_metrics_url)} "
+            "| awk '/^caddy_http_requests_total/ {s += $NF} END {if (NR) print s}'",
+        ]
+    body += ["echo '::end::'", f"sleep {interval}"]
+    return f"while true; do {'; '.join(body)}; done"
+
+
+def iter_samples(lines: Iterable[bytes]) -> Iterator[Sample]:
+    timestamp = None
+    block: list[str] = []
+    for raw in lines:
+        line = raw.decode(errors="replace").strip()
+        if line.startswith("::sample::"):
+            timestamp = float(line.split()[1])
+            block = []
+        elif line == "::end::" and timestamp is not None:
+            show, _, caddy = "\n".join(block).partition("::caddy::")
+            caddy = caddy.strip()
+            yield Sample(
+                timestamp=timestamp,
+                units=parse_show(show),
+                caddy_requests=float(caddy) if caddy else None,
+            )
+            timestamp = None
+        else:
+            block.append(line)
+
+
+def _rate(
+    previous: dict[str, str] | None, props: dict[str, str], key: str, elapsed: float
+) -> float | None:
+    if previous is None or elapsed <= 0:
+        return None
+    before = parse_counter(previous.get(key))
+    after = parse_counter(props.get(key))
+    if before is None or after is None or after < before:
+        return None
+    return (after - before) / elapsed
+
+
+def _signed(value: int) -> str:
+    sign = "+" if value >= 0 else "-"
+    return f"{sign}{decimal(abs(value))}"
+
+
+def build_table(config: Config, sample: Sample, previous: Sample | None) -> Table:
+    elapsed = sample.timestamp - previous.timestamp if previous else 0.0
+    table = Table(
+        title=f"{config.app_name} on {config.host.ip}", header_style="bold cyan"
+    )
+    table.add_column("Process")
+    table.add_column("State")
+    table.add_column("CPU", justify="right")
+    table.add_column("Memory", justify="right")
+    table.add_column("Δ Memory", justify="right")
+    table.add_column("IO read/s", justify="right")
+    table.add_column("IO write/s", justify="right")
+    table.add_column("Tasks", justify="right")
+    for unit, label in unit_labels(config).items():
+        props = sample.units.get(unit, {})
+        before = previous.units.get(unit) if previous else None
+        cpu = _rate(before, props, "CPUUsageNSec", elapsed)
+        memory = parse_counter(props.get("MemoryCurrent"))
+        memory_before = parse_counter(before.get("MemoryCurrent")) if before else None
+        read = _rate(before, props, "IOReadBytes", elapsed)
+        write = _rate(before, props, "IOWriteBytes", elapsed)
+        tasks = parse_counter(props.get("TasksCurrent"))
+        state = props.get("ActiveState", "unknown")
+        table.add_row(
+            label,
+            f"[green]{state}[/green]" if state == "active" else f"[red]{state}[/red]",
+            f"{cpu / 1e7:.1f}%" if cpu is not None else "-",
+            decimal(memory) if memory is not None else "-",
+            _signed(memory - memory_before)
+            if memory is not None and memory_before is not None
+            else "-",
+            f"{decimal(int(read))}" if read is not None else "-",
+            f"{decimal(int(write))}" if write is not None else "-",
+            str(tasks) if tasks is not None else "-",
+        )
+    caption = f"every {elapsed:.1f}s" if previous else "collecting..."
+    if sample.caddy_requests is not None and previous is not None:
+        if previous.caddy_requests is not None and elapsed > 0:
+            rate = (sample.caddy_requests - previous.caddy_requests) / elapsed
+            caption += f", caddy {rate:.1f} req/s"
+    table.caption = caption
+    return table
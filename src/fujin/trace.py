@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any
+from typing import Iterator
+
+import msgspec
+from rich.filesize import decimal
+from rich.table import Table
+
+
+class Span(msgspec.Struct, kw_only=True):
+    name: str
+    category: str = "step"
+    start: float = 0.0
+    duration: float = 0.0
+    depth: int = 0
+    args: dict[str, Any] = msgspec.field(default_factory=dict)
+
+
+class Tracer:
+    """
+    Collects nested timing spans for a single fujin invocation.
+
+    Steps are spans opened by commands (build, upload, restart, ...), remote spans are
+    recorded automatically for every command run or file transferred on the host and
+    named after the step they belong to. Commands are never recorded, they can hold
+    secrets (e.g: the ``.env`` content).
+    """
+
+    def __init__(self) -> None:
+        self.origin = time.perf_counter()
+        self.started_at = time.time()
+        self.spans: list[Span] = []
+        self._depth = 0
+        self._open_steps: list[Span] = []
+
+    @contextmanager
+    def span(self, name: str, category: str = "step", **args) -> Iterator[Span]:
+        span = Span(
+            name=name,
+            category=category,
+            start=time.perf_counter() - self.origin,
+            depth=self._depth,
+            args=args,
+        )
+        self.spans.append(span)
+        self._depth += 1
+        if category == "step":
+            self._open_steps.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.args.setdefault("error", repr(e))
+            raise
+        finally:
+            self._depth -= 1
+            if category == "step":
+                self._open_steps.remove(span)
+            span.duration = time.perf_counter() - self.origin - span.start
+
+    @property
+    def current_step(self) -> str | None:
+        """Name of the innermost step still running."""
+        return self._open_steps[-1].name if self._open_steps else None
+
+    @property
+    def steps(self) -> list[Span]:
+        return [s for s in self.spans if s.category == "step"]
+
+    @property
+    def remote_spans(self) -> list[Span]:
+        return [s for s in self.spans if s.category in ("remote", "transfer")]
+
+    @property
+    def bytes_transferred(self) -> int:
+        return sum(
+            s.args.get("bytes", 0) for s in self.spans if s.category == "transfer"
+        )
+
+    @property
+    def round_trips(self) -> int:
+        """Number of commands run and files transferred on the host."""
+        return len(self.remote_spans)
+
+    @property
+    def sudo_invocations(self) -> int:
+        return sum(s.args.get("sudo", 0) for s in self.spans if s.category == "remote")
+
+    @property
+    def duration(self) -> float:
+        return time.perf_counter() - self.origin
+
+    def has_step(self, name: str) -> bool:
+        return any(s.name == name for s in self.steps)
+
+    def step_durations(self) -> dict[str, float]:
+        """
+        Total time spent in each top level step, in seconds. Steps still running have
+        no duration yet and are left out.
+        """
+        running = {id(s) for s in self._open_steps}
+        durations: dict[str, float] = {}
+        for span in self.steps:
+            if span.depth == 0 and id(span) not in running:
+                durations[span.name] = durations.get(span.name, 0.0) + span.duration
+        return durations
+
+    def to_chrome_trace(self) -> dict:
+        """Export the spans in the Chrome trace event format (chrome://tracing, Perfetto)."""
+        events = [
+            {
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": round(span.start * 1_000_000),
+                "dur": round(span.duration * 1_000_000),
+                "pid": 1,
+                "tid": 1,
+                "args": span.args,
+            }
+            for span in self.spans
+        ]
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "started_at": self.started_at,
+                "round_trips": self.round_trips,
+                "sudo_invocations": self.sudo_invocations,
+            },
+        }
+
+    def save(self, path: Path) -> None:
+        path.write_bytes(msgspec.json.encode(self.to_chrome_trace()))
+
+    def summary_table(self, limit: int = 5) -> Table:
+        table = Table(title="Slowest steps", header_style="bold cyan")
+        table.add_column("Step")
+        table.add_column("Duration", justify="right")
+        table.add_column("Share", justify="right")
+        total = self.duration or 1
+        durations = sorted(
+            self.step_durations().items(), key=lambda item: item[1], reverse=True
+        )
+        for name, duration in durations[:limit]:
+            table.add_row(name, f"{duration:.2f}s", f"{duration / total:.0%}")
+        table.caption = (
+            f"total {self.duration:.2f}s, {self.round_trips} round trips "
+            f"({self.sudo_invocations} with sudo), "
+            f"{decimal(self.bytes_transferred)} transferred"
+        )
+        return table
+
+
+_current_tracer: ContextVar[Tracer | None] = ContextVar("fujin_tracer", default=None)
+
+
+@contextmanager
+def tracing() -> Iterator[Tracer]:
+    """Activate a tracer, spans opened with :func:`span` are recorded on it."""
+    tracer = Tracer()
+    token = _current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _current_tracer.reset(token)
+
+
+def current_tracer() -> Tracer | None:
+    return _current_tracer.get()
+
+
+@contextmanager
+def command_span(command: str) -> Iterator[Span]:
+    """
+    Record a command run on the host, named after the running step. Only the number of
+    sudo invocations is kept, never the command itself.
+    """
+    tracer = _current_tracer.get()
+    step = tracer.current_step if tracer else None
+    with span(step or "command", "remote", sudo=command.count("sudo ")) as s:
+        try:
+            yield s
+        except BaseException as e:
+            # the repr of a failed run includes the command
+            s.args["error"] = type(e).__name__
+            raise
+
+
+@contextmanager
+def span(name: str, category: str = "step", **args) -> Iterator[Span]:
+    """Record a span on the active tracer, a noop when no tracer is active."""
+    tracer = _current_tracer.get()
+    if tracer is None:
+        yield Span(name=name, category=category, args=args)
+        return
+    with tracer.span(name, category, **args) as s:
+        yield s
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import shlex
+
+import msgspec
+
+from fujin.config import Config
+
+MARKER = "::warmup::"
+
+
+class WarmupReport(msgspec.Struct, kw_only=True):
+    process: str
+    latencies: list[float]
+    failures: int = 0
+
+    @property
+    def first(self) -> float:
+        return self.latencies[0]
+
+    @property
+    def last(self) -> float:
+        return self.latencies[-1]
+
+
+def _curl_targets(config: Config, url: str, color: str | None) -> list[str]:
+    """curl arguments for each instance serving ``url``, paths go to every web upstream."""
+    if not url.startswith("/"):
+        return [shlex.quote(url)]
+    targets = []
+    for upstream in config.get_web_upstreams(color):
+        if upstream.startswith("unix/"):
+            socket = upstream.removeprefix("unix/")
+            targets.append(
+                f"--unix-socket {shlex.quote(socket)} "
+                f"{shlex.quote(f'http://localhost{url}')}"
+            )
+        else:
+            targets.append(shlex.quote(f"http://{upstream}{url}"))
+    return targets
+
+
+def warmup_command(config: Config, process_name: str, color: str | None = None) -> str:
+    """
+    A shell loop sending the warm-up requests of a process to its new instances, each
+    request prints a ``::warmup:: <process> <status> <seconds>`` line where the status is
+    ``http:<code>`` for urls and ``exit:<code>`` for a command.
+    """
+    warmup = config.processes[process_name].warmup
+    steps = []
+    if warmup.command:
+        steps.append(
+            f"s=$(date +%s%N); (source .appenv && {warmup.command}) > /dev/null 2>&1; "
+            f'echo "$? $s $(date +%s%N)" | '
+            f"awk '{{printf \"{MARKER} {process_name} exit:%d %.6f\\n\", $1, ($3 - $2) / 1e9}}'"
+        )
+    for url in warmup.urls:
+        for target in _curl_targets(config, url, color):
+            steps.append(
+                "curl -s -o /dev/null --max-time 30 "
+                f"-w '{MARKER} {process_name} http:%{{http_code}} %{{time_total}}\\n' {target}"
+            )
+    return (
+        f"cd {config.app_dir} && for i in $(seq {warmup.requests}); do "
+        f"{'; '.join(steps)}; done"
+    )
+
+
+def _failed(status: str) -> bool:
+    kind, _, code = status.partition(":")
+    if kind == "exit":
+        return code != "0"
+    # curl reports 000 when it got no response
+    return code == "000" or code.startswith("5")
+
+
+def parse_reports(output: str) -> list[WarmupReport]:
+    reports: dict[str, WarmupReport] = {}
+    for line in output.splitlines():
+        parts = line.strip().split()
+        if len(parts) != 4 or parts[0] != MARKER:
+            continue
+        _, process, status, seconds = parts
+        try:
+            latency = float(seconds)
+        except ValueError:
+            continue
+        report = reports.setdefault(
+            process, WarmupReport(process=process, latencies=[])
+        )
+        report.latencies.append(latency)
+        if _failed(status):
+            report.failures += 1
+    return list(reports.values())
@@ -0,0 +1,129 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from rich.console import Console
+from rich.table import Table
+
+from fujin.config import Config
+from fujin.config import HostConfig
+from fujin.config import InstallationMode
+from fujin.config import ProcessConfig
+from fujin.config import Webserver
+
+from .sshd import PASSWORD
+from .sshd import USER
+from .sshd import BenchmarkServer
+
+BASELINE = Path(__file__).parent / "baseline.json"
+RESULTS: dict[str, dict] = {}
+
+
+@pytest.fixture(scope="session")
+def ssh_server():
+    bandwidth = os.getenv("FUJIN_BENCH_BANDWIDTH_MB")
+    server = BenchmarkServer(
+        latency=float(os.getenv("FUJIN_BENCH_LATENCY", "0")),
+        bandwidth=float(bandwidth) * 1_000_000 if bandwidth else None,
+    )
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def bench_config(ssh_server, tmp_path, monkeypatch):
+    """A config deploying to the benchmark server, Config.read returns it."""
+    monkeypatch.setenv("FUJIN_BENCH_PASSWORD", PASSWORD)
+    monkeypatch.chdir(tmp_path)
+    # fabric forwards the local stdin to commands running with a pty
+    monkeypatch.setattr("sys.stdin", open(os.devnull))
+    ssh_server.reset(tmp_path / "host")
+    (tmp_path / "dist").mkdir()
+    config = Config(
+        app_name="benchapp",
+        version="0.1.0",
+        build_command="true",
+        distfile=str(tmp_path / "dist" / "benchapp-{version}-py3-none-any.whl"),
+        installation_mode=InstallationMode.PY_PACKAGE,
+        python_version="3.12",
+        host=HostConfig(
+            ip="127.0.0.1",
+            ssh_port=ssh_server.port,
+            domain_name="bench.example.com",
+            user=USER,
+            password_env="FUJIN_BENCH_PASSWORD",
+            env_content="DEBUG=false",
+        ),
+        webserver=Webserver(upstream="localhost:8000"),
+        processes={"web": ProcessConfig(command=".venv/bin/gunicorn app:app")},
+        local_config_dir=tmp_path / ".fujin",
+    )
+    with patch("fujin.config.Config.read", return_value=config):
+        yield config
+
+
+@pytest.fixture
+def measure(ssh_server):
+    """Run a fujin command and record wall time, round trips and bytes for it."""
+
+    @contextmanager
+    def _measure(scenario: str):
+        ssh_server.stats.commands.clear()
+        start_round_trips = ssh_server.stats.round_trips
+        start_sent = ssh_server.stats.bytes_sent
+        start_received = ssh_server.stats.bytes_received
+        start = time.perf_counter()
+        yield
+        RESULTS[scenario] = {
+            "seconds": round(time.perf_counter() - start, 3),
+            "round_trips": ssh_server.stats.round_trips - start_round_trips,
+            "bytes_uploaded": ssh_server.stats.bytes_received - start_received,
+            "bytes_downloaded": ssh_server.stats.bytes_sent - start_sent,
+        }
+        check_baseline(scenario, RESULTS[scenario])
+
+    return _measure
+
+
+def write_distfile(config: Config, size: int) -> None:
+    config.get_distfile_path().write_bytes(os.urandom(size))
+
+
+def check_baseline(scenario: str, result: dict) -> None:
+    """Round trips are deterministic, any increase over the baseline is a regression."""
+    if os.getenv("FUJIN_BENCH_UPDATE_BASELINE"):
+        baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+        baseline[scenario] = {"round_trips": result["round_trips"]}
+        BASELINE.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+        return
+    expected = json.loads(BASELINE.read_text()).get(scenario)
+    assert expected is not None, f"{scenario} missing from {BASELINE.name}"
+    assert result["round_trips"] <= expected["round_trips"], (
+        f"{scenario} made {result['round_trips']} round trips, "
+        f"the baseline is {expected['round_trips']}"
+    )
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not RESULTS:
+        return
+    table = Table(title="fujin benchmarks", header_style="bold cyan")
+    for column in ("Scenario", "Seconds", "Round trips", "Uploaded", "Downloaded"):
+        table.add_column(column, justify="left" if column == "Scenario" else "right")
+    for scenario, result in RESULTS.items():
+        table.add_row(
+            scenario,
+            f"{result['seconds']:.3f}",
+            str(result["round_trips"]),
+            str(result["bytes_uploaded"]),
+            str(result["bytes_downloaded"]),
+        )
+    console = Console(file=terminalreporter._tw, force_terminal=False, width=120)
+    console.print(table)
+    output = os.getenv("FUJIN_BENCH_OUTPUT")
+    if output:
+        Path(output).write_text(json.dumps(RESULTS, indent=2) + "\n")
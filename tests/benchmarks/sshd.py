@@ -0,0 +1,285 @@
+"""
+A local, in-process SSH server used to benchmark fujin commands end to end.
+
+Every command is executed with bash inside a temporary root directory: absolute paths
+under ``/home``, ``/etc``, ``/run`` and ``/var`` are rewritten to live under that root,
+and stub ``sudo``, ``systemctl``, ``journalctl`` and ``uv`` executables are installed on
+the PATH fujin sets for the remote user. Latency is injected for every round trip and
+uploads are throttled to the configured bandwidth, the server counts round trips and
+bytes so scenarios can be compared from run to run.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import socket
+import stat
+import subprocess
+import threading
+import time
+from pathlib import Path
+
+import paramiko
+
+USER = "bench"
+PASSWORD = "bench"
+REMOTE_HOME = f"/home/{USER}"
+
+_ABSOLUTE_PATH = re.compile(r"(?<![\w./-])/(?=(?:home|etc|run|var)/)")
+
+STUBS = {
+    "sudo": """#!/usr/bin/env bash
+[ "$1" = "-S" ] && shift
+exec "$@"
+""",
+    "systemctl": """#!/usr/bin/env bash
+case "$1" in
+  is-active) shift; for _ in "$@"; do echo active; done ;;
+  show)
+    shift
+    [ "$1" = "-p" ] && shift 2
+    for unit in "$@"; do
+      case "$unit" in -*) continue ;; esac
+      printf 'Id=%s\\nActiveState=active\\nSubState=running\\nMainPID=4242\\nMemoryCurrent=52428800\\nCPUUsageNSec=1000000000\\nNRestarts=0\\nActiveEnterTimestamp=Mon 2025-01-06 10:00:00 UTC\\n\\n' "$unit"
+    done ;;
+esac
+exit 0
+""",
+    "journalctl": """#!/usr/bin/env bash
+exit 0
+""",
+    "uv": """#!/usr/bin/env bash
+case "$1 $2" in
+  "venv "*) mkdir -p .venv/bin ;;
+  "pip install") sleep "${FUJIN_BENCH_UV_SECONDS:-0}" ;;
+esac
+exit 0
+""",
+}
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.commands: list[str] = []
+
+    def add(self, *, round_trips=0, sent=0, received=0, command=None) -> None:
+        with self.lock:
+            self.round_trips += round_trips
+            self.bytes_sent += sent
+            self.bytes_received += received
+            if command is not None:
+                self.commands.append(command)
+
+
+class BenchmarkServer:
+    def __init__(self, *, latency: float = 0.0, bandwidth: float | None = None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.stats = Stats()
+        self.root: Path | None = None
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(("127.0.0.1", 0))
+        self._sock.listen(16)
+        self.port = self._sock.getsockname()[1]
+        self._transports: list[paramiko.Transport] = []
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+
+    def reset(self, root: Path) -> None:
+        """Start a new scenario with an empty host filesystem under ``root``."""
+        self.root = root
+        self.stats = Stats()
+        home = self.local_path(REMOTE_HOME)
+        bin_dir = home / ".local" / "bin"
+        bin_dir.mkdir(parents=True)
+        for name, content in STUBS.items():
+            path = bin_dir / name
+            path.write_text(content)
+            path.chmod(0o755)
+        for directory in ("/etc/systemd/system", "/etc/caddy/conf.d", "/run"):
+            self.local_path(directory).mkdir(parents=True, exist_ok=True)
+
+    def local_path(self, remote_path: str) -> Path:
+        if not remote_path.startswith("/"):
+            remote_path = f"{REMOTE_HOME}/{remote_path}"
+        return Path(f"{self.root}{os.path.normpath(remote_path)}")
+
+    def rewrite(self, command: str) -> str:
+        return _ABSOLUTE_PATH.sub(f"{self.root}/", command)
+
+    def throttle(self, size: int) -> None:
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    def close(self) -> None:
+        for transport in self._transports:
+            transport.close()
+        self._sock.close()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                client, _ = self._sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, _SFTPServer)
+            transport.start_server(server=_ServerInterface(self))
+            self._transports.append(transport)
+
+    def execute(self, channel: paramiko.Channel, command: str) -> None:
+        time.sleep(self.latency)
+        self.stats.add(round_trips=1, received=len(command), command=command)
+        home = self.local_path(REMOTE_HOME)
+        process = subprocess.Popen(
+            ["bash", "-c", self.rewrite(command)],
+            cwd=home,
+            env={"HOME": str(home), "PATH": os.environ["PATH"], "LANG": "C.UTF-8"},
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        stdout, stderr = process.communicate()
+        self.stats.add(sent=len(stdout) + len(stderr))
+        channel.sendall(stdout)
+        channel.sendall_stderr(stderr)
+        channel.send_exit_status(process.returncode)
+        channel.close()
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, server: BenchmarkServer):
+        self.server = server
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        if username == USER and password == PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_env_request(self, channel, name, value):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(
+            target=self.server.execute,
+            args=(channel, command.decode()),
+            daemon=True,
+        ).start()
+        return True
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    def __init__(self, server: BenchmarkServer, flags=0):
+        super().__init__(flags)
+        self.server = server
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+    def write(self, offset, data):
+        self.server.throttle(len(data))
+        self.server.stats.add(received=len(data))
+        return super().write(offset, data)
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+    def __init__(self, server: _ServerInterface, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.server = server.server
+
+    def _path(self, path: str) -> Path:
+        return self.server.local_path(path)
+
+    def canonicalize(self, path):
+        if not path.startswith("/"):
+            path = f"{REMOTE_HOME}/{path}"
+        return os.path.normpath(path)
+
+    def open(self, path, flags, attr):
+        time.sleep(self.server.latency)
+        self.server.stats.add(round_trips=1)
+        local = self._path(path)
+        try:
+            fd = os.open(local, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        mode = "wb" if flags & os.O_WRONLY else "r+b" if flags & os.O_RDWR else "rb"
+        handle = _SFTPHandle(self.server, flags)
+        f = os.fdopen(fd, mode)
+        handle.filename = str(local)
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def list_folder(self, path):
+        local = self._path(path)
+        try:
+            return [
+                paramiko.SFTPAttributes.from_stat(os.stat(local / name), name)
+                for name in os.listdir(local)
+            ]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, path, attr):
+        if attr._flags & attr.FLAG_PERMISSIONS:
+            os.chmod(self._path(path), stat.S_IMODE(attr.st_mode))
+        return paramiko.SFTP_OK
+
+    def remove(self, path):
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
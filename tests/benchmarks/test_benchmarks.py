@@ -0,0 +1,78 @@
+import os
+from unittest.mock import patch
+
+from fujin.commands.app import App
+from fujin.commands.deploy import Deploy
+from fujin.commands.prune import Prune
+from fujin.commands.rollback import Rollback
+from fujin.config import InstallationMode
+from fujin.config import ProcessConfig
+
+from .conftest import write_distfile
+
+KB = 1_000
+MB = 1_000_000
+
+
+def deploy(config, version: str, size: int) -> None:
+    config.version = version
+    write_distfile(config, size)
+    Deploy()()
+
+
+def test_small_wheel(bench_config, measure, ssh_server, tmp_path):
+    requirements = tmp_path / "requirements.txt"
+    requirements.write_text("django==5.1\ngunicorn==23.0\n")
+    bench_config.requirements = str(requirements)
+    bench_config.processes["worker"] = ProcessConfig(
+        command=".venv/bin/celery worker", replicas=2
+    )
+
+    with measure("small-wheel/deploy"):
+        deploy(bench_config, "0.1.0", 50 * KB)
+    with measure("small-wheel/redeploy"):
+        deploy(bench_config, "0.2.0", 50 * KB)
+    deploy(bench_config, "0.3.0", 50 * KB)
+
+    with (
+        measure("small-wheel/prune"),
+        patch("rich.prompt.Confirm.ask", return_value=True),
+    ):
+        Prune(keep=2)()
+
+    with (
+        measure("small-wheel/rollback"),
+        patch("rich.prompt.Prompt.ask", return_value="0.2.0"),
+        patch("rich.prompt.Confirm.ask", return_value=True),
+    ):
+        Rollback()()
+
+    with measure("small-wheel/app-info"):
+        App().info()
+
+    versions = ssh_server.local_path(f"{bench_config.app_dir}/.versions")
+    assert versions.read_text().split() == ["0.2.0"]
+
+
+def test_large_binary(bench_config, measure, ssh_server):
+    bench_config.installation_mode = InstallationMode.BINARY
+    bench_config.distfile = bench_config.distfile.replace("-py3-none-any.whl", "")
+    size = int(os.getenv("FUJIN_BENCH_LARGE_MB", "100")) * MB
+
+    with measure("large-binary/deploy"):
+        deploy(bench_config, "0.1.0", size)
+
+    release = ssh_server.local_path(bench_config.get_release_dir())
+    assert (release / bench_config.get_distfile_path().name).stat().st_size == size
+
+
+def test_many_processes(bench_config, measure):
+    for i in range(1, 10):
+        bench_config.processes[f"worker{i}"] = ProcessConfig(
+            command=f".venv/bin/worker --queue {i}", replicas=3
+        )
+
+    with measure("many-processes/deploy"):
+        deploy(bench_config, "0.1.0", 50 * KB)
+    with measure("many-processes/app-info"):
+        App().info()
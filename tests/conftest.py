@@ -1,11 +1,10 @@
 import pytest
-from pathlib import Path
 from unittest.mock import MagicMock, patch
 from fujin.config import Config, HostConfig, Webserver, ProcessConfig, InstallationMode
 
 
 @pytest.fixture
-def mock_config():
+def mock_config(tmp_path):
     return Config(
         app_name="testapp",
         version="0.1.0",
@@ -23,7 +22,7 @@ def mock_config():
             "web": ProcessConfig(command="run web"),
             "worker": ProcessConfig(command="run worker", replicas=2),
         },
-        local_config_dir=Path(__file__).parent.parent / "src" / "fujin" / "templates",
+        local_config_dir=tmp_path / ".fujin",
     )
 
 
@@ -68,3 +67,27 @@ def get_commands():
         return commands
 
     return _get
+
+
+@pytest.fixture
+def remote_state_output():
+    """Build the output of the single preflight command run by deploy and rollback."""
+
+    def _build(
+        versions=(), requirements_hash=None, units=(), loaded=(), wants=(), host=None
+    ):
+        lines = ["::versions::", *versions, "::requirements::"]
+        if requirements_hash:
+            lines.append(f"{requirements_hash}  requirements.txt")
+        lines += ["::units::", *(f"abc  /etc/systemd/system/{u}" for u in units)]
+        lines += [
+            "::wants::",
+            *(f"/etc/systemd/system/multi-user.target.wants/{u}" for u in wants),
+        ]
+        lines += ["::loaded::", *(f"{u} loaded active running" for u in loaded)]
+        lines += ["::caddy::", "::env::", "::disk::"]
+        if host:
+            lines += ["::host::", *(str(value) for value in host)]
+        return "\n".join(lines)
+
+    return _build
@@ -1,6 +1,23 @@
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest.mock import patch
+
+import cappa
 import pytest
 from inline_snapshot import snapshot
+from rich.console import Console
+
+from fujin import benchmark
 from fujin.commands.app import App
+from fujin.config import BlueGreenConfig
+from fujin.config import SliceConfig
+from fujin.config import Webserver
+from fujin.top import Sample
+from fujin.top import build_table
 
 
 def test_app_start_resolves_process_name(mock_connection, get_commands):
@@ -19,9 +36,418 @@ def test_app_start_resolves_worker_replicas(mock_connection, get_commands):
     )
 
 
+def test_app_reload_skips_units_without_anything_to_reload(
+    mock_config, mock_connection, get_commands
+):
+    mock_config.processes["web"].socket = True
+    app = App()
+    app.reload()
+    assert get_commands(mock_connection.mock_calls) == snapshot(
+        [
+            "sudo systemctl reload-or-restart testapp.service testapp-worker@1.service testapp-worker@2.service"
+        ]
+    )
+
+
+def test_app_restart_with_blue_green_only_targets_the_live_color(
+    mock_config, mock_connection, get_commands
+):
+    mock_config.webserver = Webserver(
+        port_base=8000, blue_green=BlueGreenConfig(readiness_path="/up")
+    )
+    mock_connection.run.return_value.stdout = "green\n"
+    mock_connection.run.return_value.ok = True
+    App().restart()
+    assert get_commands(mock_connection.mock_calls) == snapshot(
+        [
+            "cat /home/testuser/.local/share/fujin/testapp/.color",
+            "sudo systemctl restart testapp@green-1.service testapp-worker@1.service testapp-worker@2.service",
+        ]
+    )
+
+
 def test_app_start_fallback_to_service_name(mock_connection, get_commands):
     app = App()
     app.start("custom.service")
     assert get_commands(mock_connection.mock_calls) == snapshot(
         ["sudo systemctl start custom.service"]
     )
+
+
+def journal_entries(*entries) -> bytes:
+    lines = [
+        json.dumps(
+            {"__REALTIME_TIMESTAMP": str(ts), "_SYSTEMD_UNIT": unit, "MESSAGE": msg}
+        )
+        for ts, unit, msg in entries
+    ]
+    return "\n".join(lines).encode() + b"\n"
+
+
+def test_app_logs_filters_on_the_host_and_prefixes_units(mock_connection, capsys):
+    data = gzip.compress(
+        journal_entries(
+            (1_700_000_000_000_000, "testapp.service", "GET / 200"),
+            (1_700_000_001_000_000, "testapp-worker@2.service", "task done"),
+        )
+    )
+    # split the stream in the middle of a line
+    chunks = [data[:20], data[20:]]
+    with patch("fujin.commands.app.iter_output", return_value=chunks) as iter_output:
+        App().logs(since="1 hour ago", grep="GET|task", priority="err")
+
+    assert iter_output.call_args.args[1] == snapshot(
+        "set -o pipefail; sudo -n journalctl -u testapp.service -u testapp-worker@1.service -u testapp-worker@2.service -o json --no-pager --since '1 hour ago' --grep 'GET|task' --priority err | gzip -c -1"
+    )
+    out = capsys.readouterr().out.splitlines()
+    assert [line.split(" | ")[0] for line in out] == ["web     ", "worker@2"]
+    assert out[0].endswith(" GET / 200")
+    assert out[1].endswith(" task done")
+
+
+def test_app_logs_follow_is_not_compressed(mock_connection, tmp_path):
+    output = tmp_path / "logs.jsonl"
+    data = journal_entries((1, "testapp.service", "hello"))
+    with patch("fujin.commands.app.iter_output", return_value=[data]) as iter_output:
+        App().logs(name="web", follow=True, as_json=True, output=output)
+
+    assert iter_output.call_args.args[1] == snapshot(
+        "sudo -n journalctl -u testapp.service -o json --no-pager -n 50 -f"
+    )
+    assert json.loads(output.read_text())["MESSAGE"] == "hello"
+
+
+def test_app_logs_explains_a_sudo_password_prompt(mock_connection):
+    def iter_output(*args, **kwargs):
+        raise cappa.Exit("sudo: a password is required", code=1)
+        yield
+
+    with (
+        patch("fujin.commands.app.iter_output", iter_output),
+        pytest.raises(cappa.Exit) as exc_info,
+    ):
+        App().logs()
+    assert "Set 'password_env' in the host config" in exc_info.value.message
+
+
+def sync_stream(*units) -> list[bytes]:
+    lines = []
+    for unit, entries in units:
+        lines.append(f"::unit::{unit}".encode())
+        for ts, message in entries:
+            lines.append(
+                json.dumps(
+                    {
+                        "__CURSOR": f"s={unit};t={ts}",
+                        "__REALTIME_TIMESTAMP": str(ts),
+                        "_SYSTEMD_UNIT": unit,
+                        "PRIORITY": "6",
+                        "MESSAGE": message,
+                    }
+                ).encode()
+            )
+    return [gzip.compress(b"\n".join(lines) + b"\n")]
+
+
+def test_app_logs_sync_fetches_after_cursors_and_search(
+    mock_config, mock_connection, capsys
+):
+    now = int(time.time() * 1_000_000)
+    first = sync_stream(
+        ("testapp.service", [(now - 3_600_000_000, "redis timeout on GET /")]),
+        ("testapp-worker@1.service", [(now, "task failed: redis timeout")]),
+        ("testapp-worker@2.service", []),
+    )
+    with patch("fujin.commands.app.iter_output", return_value=first):
+        App().logs_sync()
+    second = sync_stream(
+        ("testapp.service", [(now + 1, "GET / 200")]),
+        ("testapp-worker@1.service", []),
+        ("testapp-worker@2.service", []),
+    )
+    with patch("fujin.commands.app.iter_output", return_value=second) as iter_output:
+        App().logs_sync()
+
+    command = iter_output.call_args.args[1]
+    assert f"--after-cursor 's=testapp.service;t={now - 3_600_000_000}'" in command
+    assert f"--after-cursor 's=testapp-worker@1.service;t={now}'" in command
+    assert "-u testapp-worker@2.service -o json --no-pager;" in command
+    assert (mock_config.local_config_dir / "logs" / "index.sqlite3").exists()
+
+    capsys.readouterr()
+    App().logs_search("redis AND timeout", since="30m")
+    out = capsys.readouterr().out.splitlines()
+    assert len(out) == 1
+    assert out[0].startswith("worker@1 | ")
+    assert out[0].endswith("task failed: redis timeout")
+
+
+def test_app_info_reads_everything_in_one_round_trip(
+    mock_connection, get_commands, capsys
+):
+    mock_connection.run.return_value.stdout = """\
+0.1.0
+0.0.9
+::units::
+Id=testapp.service
+ActiveState=active
+SubState=running
+MainPID=101
+MemoryCurrent=52428800
+CPUUsageNSec=1500000000
+NRestarts=0
+ActiveEnterTimestamp=Mon 2025-01-06 10:00:00 UTC
+
+Id=testapp-worker@1.service
+ActiveState=active
+SubState=running
+MainPID=102
+MemoryCurrent=18446744073709551615
+CPUUsageNSec=250000000
+NRestarts=3
+ActiveEnterTimestamp=Mon 2025-01-06 10:05:00 UTC
+
+Id=testapp-worker@2.service
+ActiveState=failed
+SubState=failed
+MainPID=0
+MemoryCurrent=[not set]
+CPUUsageNSec=[not set]
+NRestarts=5
+ActiveEnterTimestamp=
+"""
+    App().info(as_json=True)
+
+    assert get_commands(mock_connection.mock_calls) == snapshot(
+        [
+            "cat /home/testuser/.local/share/fujin/testapp/.versions 2>/dev/null; echo '::units::'; systemctl show -p Id,ActiveState,SubState,MainPID,MemoryCurrent,CPUUsageNSec,NRestarts,ActiveEnterTimestamp testapp.service testapp-worker@1.service testapp-worker@2.service"
+        ]
+    )
+    data = json.loads(capsys.readouterr().out)
+    assert data["remote_version"] == "0.1.0"
+    assert data["rollback_targets"] == ["0.0.9"]
+    assert data["units"] == snapshot(
+        [
+            {
+                "unit": "testapp.service",
+                "process": "web",
+                "active_state": "active",
+                "sub_state": "running",
+                "main_pid": 101,
+                "memory_bytes": 52428800,
+                "cpu_seconds": 1.5,
+                "restarts": 0,
+                "active_since": "Mon 2025-01-06 10:00:00 UTC",
+            },
+            {
+                "unit": "testapp-worker@1.service",
+                "process": "worker@1",
+                "active_state": "active",
+                "sub_state": "running",
+                "main_pid": 102,
+                "memory_bytes": None,
+                "cpu_seconds": 0.25,
+                "restarts": 3,
+                "active_since": "Mon 2025-01-06 10:05:00 UTC",
+            },
+            {
+                "unit": "testapp-worker@2.service",
+                "process": "worker@2",
+                "active_state": "failed",
+                "sub_state": "failed",
+                "main_pid": None,
+                "memory_bytes": None,
+                "cpu_seconds": None,
+                "restarts": 5,
+                "active_since": None,
+            },
+        ]
+    )
+
+
+def test_app_info_reports_slice_usage(mock_config, mock_connection, capsys):
+    mock_config.slice = SliceConfig(cpu_weight=200)
+    mock_connection.run.return_value.stdout = """\
+0.1.0
+::units::
+Id=testapp.slice
+ActiveState=active
+SubState=active
+MainPID=0
+MemoryCurrent=104857600
+CPUUsageNSec=4000000000
+NRestarts=[not set]
+ActiveEnterTimestamp=Mon 2025-01-06 10:00:00 UTC
+"""
+    App().info(as_json=True)
+
+    (command,) = [c.args[0] for c in mock_connection.run.call_args_list]
+    assert command.endswith(" testapp-worker@2.service testapp.slice")
+    data = json.loads(capsys.readouterr().out)
+    assert data["slice"]["unit"] == "testapp.slice"
+    assert data["slice"]["memory_bytes"] == 104857600
+    assert data["slice"]["cpu_seconds"] == 4.0
+
+
+def test_app_info_shows_values_resolved_from_host_facts(
+    mock_config, mock_connection, get_commands, capsys
+):
+    mock_config.processes["worker"].replicas = "auto"
+    mock_config.processes["web"].command = "gunicorn --workers {{ host.cpus + 1 }}"
+    mock_connection.run.return_value.stdout = "2\n1987\n"
+    App().info(as_json=True)
+
+    # the facts are discovered once, then read from the local cache
+    commands = get_commands(mock_connection.mock_calls)
+    assert commands[0] == "nproc; free -m | awk '/^Mem:/ {print $2}'"
+    assert commands[1].endswith("testapp-worker@1.service testapp-worker@2.service")
+    data = json.loads(capsys.readouterr().out)
+    assert data["host_cpus"] == 2
+    assert data["host_mem_mb"] == 1987
+    assert data["worker_replicas"] == 2
+    assert data["web_command"] == "gunicorn --workers 3"
+
+
+def test_app_top_samples_over_one_channel_and_records(mock_connection, tmp_path):
+    def sample(ts, cpu_ns, memory, requests):
+        lines = [f"::sample:: {ts}"]
+        for unit in (
+            "testapp.service",
+            "testapp-worker@1.service",
+            "testapp-worker@2.service",
+        ):
+            lines += [
+                f"Id={unit}",
+                "ActiveState=active",
+                f"CPUUsageNSec={cpu_ns}",
+                f"MemoryCurrent={memory}",
+                "IOReadBytes=18446744073709551615",
+                "IOWriteBytes=0",
+                "TasksCurrent=4",
+                "",
+            ]
+        lines += ["::caddy::", str(requests), "::end::"]
+        return "\n".join(lines).encode() + b"\n"
+
+    stream = [sample(100.0, 0, 1000, 10), sample(102.0, 1_000_000_000, 900, 30)]
+    record = tmp_path / "top.jsonl"
+    with patch("fujin.commands.app.iter_output", return_value=stream) as iter_output:
+        App().top(interval=2, record=record, count=2)
+
+    iter_output.assert_called_once()
+    command = iter_output.call_args.args[1]
+    assert command.startswith("while true; do ")
+    assert "sleep 2" in command
+    assert "http://localhost:2019/metrics" in command
+    samples = [json.loads(line) for line in record.read_text().splitlines()]
+    assert [s["timestamp"] for s in samples] == [100.0, 102.0]
+    assert samples[1]["caddy_requests"] == 30.0
+    assert samples[1]["units"]["testapp.service"]["CPUUsageNSec"] == "1000000000"
+
+
+def test_top_table_shows_rates_between_samples(mock_config):
+    def sample(ts, cpu_ns, memory, requests):
+        props = {"ActiveState": "active", "CPUUsageNSec": str(cpu_ns)}
+        props["MemoryCurrent"] = str(memory)
+        return Sample(
+            timestamp=ts,
+            units={"testapp.service": props},
+            caddy_requests=requests,
+        )
+
+    table = build_table(
+        mock_config, sample(102.0, 1_000_000_000, 900, 30), sample(100.0, 0, 1000, 10)
+    )
+    console = Console(width=200, record=True)
+    console.print(table)
+    text = console.export_text()
+    assert "50.0%" in text
+    assert "-100 bytes" in text
+    assert "caddy 10.0 req/s" in text
+
+
+def test_app_bench_compares_with_a_previous_release(
+    mock_config, mock_connection, capsys
+):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200 if self.headers["Host"] == "example.com" else 400)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    mock_config.webserver.upstream = f"127.0.0.1:{server.server_port}"
+    # the app runs on this machine, nothing to forward
+    del mock_connection.forward_local
+    try:
+        for version in ("0.1.0", "0.2.0"):
+            mock_connection.run.return_value.stdout = f"{version}\n::color::\n"
+            App().bench(
+                paths=["/", "/up"], concurrency=2, duration=0.2, compare="0.1.0"
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    records = benchmark.read(benchmark.history_path(mock_config))
+    assert [(r.version, r.target, r.paths) for r in records] == [
+        ("0.1.0", "upstream", ["/", "/up"]),
+        ("0.2.0", "upstream", ["/", "/up"]),
+    ]
+    assert records[1].requests > 0 and records[1].errors == 0
+    out = capsys.readouterr().out
+    assert "testapp v0.2.0 via upstream" in out
+    assert "Change" in out
+
+
+def test_app_profile_saves_the_flamegraph_of_a_replica(mock_connection, tmp_path):
+    output = tmp_path / "worker.svg"
+    data = gzip.compress(b"<svg>flamegraph</svg>")
+    with patch(
+        "fujin.commands.app.iter_output", return_value=[data[:10], data[10:]]
+    ) as iter_output:
+        App().profile("worker", replica=2, duration="1m", output=output)
+
+    command = iter_output.call_args.args[1]
+    assert command.startswith(
+        "test -x /home/testuser/.local/share/fujin/.tools/bin/py-spy || "
+        "UV_TOOL_DIR=/home/testuser/.local/share/fujin/.tools"
+    )
+    assert "for unit in testapp-worker@2.service; do" in command
+    assert "--duration 60 --rate 100 --format flamegraph" in command
+    assert output.read_bytes() == b"<svg>flamegraph</svg>"
+
+
+def test_app_profile_leaves_no_file_when_the_command_fails(mock_connection, tmp_path):
+    output = tmp_path / "worker.svg"
+    data = gzip.compress(b"<svg>flamegraph</svg>")
+
+    def iter_output(*args, **kwargs):
+        yield data[:10]
+        raise cappa.Exit("py-spy failed", code=1)
+
+    with (
+        patch("fujin.commands.app.iter_output", iter_output),
+        pytest.raises(cappa.Exit),
+    ):
+        App().profile("worker", duration="1m", output=output)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_app_profile_dumps_every_replica(mock_connection, capsys):
+    stream = (
+        b"::unit::testapp-worker@1.service\nThread 1 (idle): MainThread\n"
+        b"::unit::testapp-worker@2.service\nnot running\n"
+    )
+    with patch("fujin.commands.app.iter_output", return_value=[stream]):
+        App().profile("worker", dump=True)
+
+    out = capsys.readouterr().out
+    assert out.index("testapp-worker@1.service") < out.index("Thread 1 (idle)")
+    assert out.index("testapp-worker@2.service") < out.index("not running")
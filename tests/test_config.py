@@ -1,7 +1,19 @@
+import msgspec
 import pytest
+from inline_snapshot import snapshot
 from pathlib import Path
+from unittest.mock import MagicMock
 from unittest.mock import patch
 from fujin.config import Config, ProcessConfig, Webserver, HostConfig, InstallationMode
+from fujin.config import ResourcesConfig
+from fujin.config import SliceConfig
+from fujin.config import HostFacts
+from fujin.config import SocketConfig
+from fujin.config import EdgeBackend
+from fujin.config import EdgeConfig
+from fujin.config import BlueGreenConfig
+from fujin.config import next_color
+from fujin.config import WarmupConfig
 from fujin.errors import ImproperlyConfiguredError
 
 
@@ -139,7 +151,9 @@ def test_render_caddyfile_with_statics(mock_config):
 
 def test_process_config_validation_replicas_and_socket_or_timer():
     with pytest.raises(ImproperlyConfiguredError):
-        ProcessConfig(command="cmd", replicas=2, socket=True)
+        ProcessConfig(
+            command="cmd", replicas=2, socket=SocketConfig(listen="127.0.0.1:8000")
+        )
 
     with pytest.raises(ImproperlyConfiguredError):
         ProcessConfig(command="cmd", replicas=2, timer="OnCalendar=daily")
@@ -150,3 +164,360 @@ def test_caddy_config_path(mock_config):
 
     mock_config.webserver.config_dir = "/custom/path"
     assert mock_config.caddy_config_path == "/custom/path/testapp.caddy"
+
+
+def test_systemd_unit_files_match_rendered_units(mock_config):
+    mock_config.processes["cleanup"] = ProcessConfig(
+        command="cleanup", timer="OnCalendar=daily"
+    )
+    mock_config.processes["api"] = ProcessConfig(command="api", socket=True)
+    assert mock_config.systemd_unit_files == list(
+        mock_config.render_systemd_units().keys()
+    )
+
+
+def test_local_template_overrides_default(mock_config):
+    mock_config.local_config_dir.mkdir()
+    (mock_config.local_config_dir / "worker.service.j2").write_text(
+        "custom {{ process_name }}"
+    )
+    units = mock_config.render_systemd_units()
+    assert units["testapp-worker@.service"] == "custom testapp-worker@"
+    assert (mock_config.local_config_dir / ".cache" / "jinja").is_dir()
+
+
+def test_rendering_without_local_config_dir_leaves_the_project_untouched(
+    mock_config,
+):
+    mock_config.render_systemd_units()
+    assert not mock_config.local_config_dir.exists()
+
+
+@pytest.mark.parametrize(
+    "resources",
+    [
+        {"cpu_quota": "2 cores"},
+        {"memory_max": "1 GB"},
+        {"cpu_weight": 0},
+        {"nice": 20},
+        {"cpu_affinity": "0-3;8"},
+        {"pin_replicas": True},
+    ],
+)
+def test_resources_config_validation(resources):
+    with pytest.raises(ImproperlyConfiguredError):
+        ResourcesConfig(**resources)
+
+
+def test_render_systemd_units_with_resources(mock_config):
+    mock_config.processes["web"].resources = ResourcesConfig(
+        cpu_quota="150%", memory_max="1G", timeout_stop_sec=30
+    )
+    mock_config.processes["worker"].resources = ResourcesConfig(nice=5)
+    units = mock_config.render_systemd_units()
+    web = units["testapp.service"]
+    assert "TimeoutStopSec=30" in web
+    assert "TimeoutStopSec=5" not in web
+    assert "CPUQuota=150%\nMemoryMax=1G\n" in web
+    assert "Restart=always\nNice=5\n" in units["testapp-worker@.service"]
+
+
+def test_replica_cpu_affinity_drop_ins(mock_config):
+    mock_config.processes["worker"].replicas = 3
+    mock_config.processes["worker"].resources = ResourcesConfig(
+        cpu_affinity="4-11", pin_replicas=True
+    )
+    units = mock_config.render_systemd_units()
+    assert "CPUAffinity" not in units["testapp-worker@.service"]
+    affinities = {
+        name: content.splitlines()[-1]
+        for name, content in units.items()
+        if name.endswith("cpu-affinity.conf")
+    }
+    assert affinities == {
+        "testapp-worker@1.service.d/cpu-affinity.conf": "CPUAffinity=4-6",
+        "testapp-worker@2.service.d/cpu-affinity.conf": "CPUAffinity=7-9",
+        "testapp-worker@3.service.d/cpu-affinity.conf": "CPUAffinity=10-11",
+    }
+
+
+def test_replica_affinities_with_fewer_cpus_than_replicas():
+    resources = ResourcesConfig(cpu_affinity="0,2", pin_replicas=True)
+    assert resources.replica_affinities(3) == ["0", "2", "0"]
+
+
+def test_render_systemd_units_with_slice(mock_config):
+    mock_config.slice = SliceConfig(cpu_weight=200, memory_max="4G")
+    units = mock_config.render_systemd_units()
+    assert units["testapp.slice"].endswith("[Slice]\nCPUWeight=200\nMemoryMax=4G")
+    for name in ("testapp.service", "testapp-worker@.service"):
+        assert "\nSlice=testapp.slice\n" in units[name]
+    assert mock_config.systemd_unit_files == list(units.keys())
+
+
+def test_slice_config_validation():
+    with pytest.raises(ImproperlyConfiguredError):
+        SliceConfig(io_weight=20000)
+
+
+def test_process_config_validation_replicas():
+    with pytest.raises(ImproperlyConfiguredError):
+        ProcessConfig(command="cmd", replicas="many")
+    with pytest.raises(ImproperlyConfiguredError):
+        ProcessConfig(command="cmd", replicas="auto", timer="OnCalendar=daily")
+
+
+def test_auto_replicas_use_the_host_cpus(mock_config):
+    mock_config.processes["worker"].replicas = "auto"
+    assert mock_config.needs_host_facts
+    with pytest.raises(ImproperlyConfiguredError):
+        mock_config.get_active_unit_names("worker")
+
+    mock_config.host_facts = HostFacts(cpus=3, mem_mb=2048)
+    assert mock_config.get_active_unit_names("worker") == [
+        "testapp-worker@1.service",
+        "testapp-worker@2.service",
+        "testapp-worker@3.service",
+    ]
+
+
+def test_host_facts_are_cached_locally(mock_config):
+    mock_config.host_facts = HostFacts(cpus=16, mem_mb=64000)
+    config = msgspec.structs.replace(mock_config)
+    assert config.host_facts == HostFacts(cpus=16, mem_mb=64000)
+
+
+def test_host_facts_are_fetched_only_when_needed(mock_config):
+    fetch = MagicMock(return_value=HostFacts(cpus=4, mem_mb=2048))
+    mock_config.fetch_host_facts = fetch
+    mock_config.processes["web"].command = "gunicorn --bind host.docker.internal:80"
+    assert not mock_config.needs_host_facts
+    mock_config.render_systemd_units()
+    fetch.assert_not_called()
+
+    mock_config.processes["web"].command = "gunicorn -w {{ host.cpus }}"
+    assert mock_config.needs_host_facts
+    assert mock_config.get_command("web") == "gunicorn -w 4"
+    assert mock_config.get_command("web") == "gunicorn -w 4"
+    fetch.assert_called_once()
+
+
+def test_unit_names_do_not_render_the_commands(mock_config):
+    fetch = MagicMock(return_value=HostFacts(cpus=4, mem_mb=2048))
+    mock_config.fetch_host_facts = fetch
+    mock_config.processes["web"].command = "gunicorn -w {{ host.cpus }}"
+    assert "testapp.service" in mock_config.systemd_unit_files
+    assert "testapp.service" in mock_config.active_systemd_units
+    fetch.assert_not_called()
+
+    mock_config.fetch_host_facts = None
+    assert "testapp.service" in mock_config.all_systemd_units
+
+
+def test_host_facts_are_not_a_config_key(mock_config):
+    fields = {field.encode_name for field in msgspec.structs.fields(Config)}
+    assert not {"_host_facts", "fetch_host_facts"} & fields
+
+
+def test_command_rendered_with_host_facts(mock_config):
+    mock_config.processes[
+        "web"
+    ].command = "gunicorn --workers {{ host.cpus * 2 + 1 }} --max-requests {{ host.mem_mb // 4 }}"
+    mock_config.host_facts = HostFacts(cpus=2, mem_mb=4000)
+    assert mock_config.get_command("web") == "gunicorn --workers 5 --max-requests 1000"
+    assert (
+        "gunicorn --workers 5" in mock_config.render_systemd_units()["testapp.service"]
+    )
+
+
+def test_replicated_web_process_with_per_instance_sockets(mock_config):
+    mock_config.processes["web"] = ProcessConfig(
+        command="gunicorn app.wsgi", replicas=3, socket=SocketConfig(backlog=4096)
+    )
+    units = mock_config.render_systemd_units()
+    socket = units["testapp@.socket"]
+    assert "ListenStream=/run/testapp-%i.sock\nBacklog=4096\n" in socket
+    assert "Requires=testapp@%i.socket" in units["testapp@.service"]
+    assert mock_config.active_systemd_units[:3] == [
+        "testapp@1.service",
+        "testapp@2.service",
+        "testapp@3.service",
+    ]
+    assert "testapp@3.socket" in mock_config.active_systemd_units
+    assert (
+        "reverse_proxy unix//run/testapp-1.sock unix//run/testapp-2.sock unix//run/testapp-3.sock"
+        in mock_config.render_caddyfile()
+    )
+
+
+def test_replicated_unix_listener_needs_the_replica_number():
+    with pytest.raises(ImproperlyConfiguredError) as exc_info:
+        ProcessConfig(
+            command="gunicorn app.wsgi",
+            replicas=3,
+            socket=SocketConfig(listen="/run/app.sock"),
+        )
+    assert "add '%i' to the listen path" in exc_info.value.message
+    process = ProcessConfig(
+        command="gunicorn app.wsgi",
+        replicas=3,
+        socket=SocketConfig(listen="/run/app-%i.sock"),
+    )
+    assert process.socket_config.listen == "/run/app-%i.sock"
+
+
+def test_replicated_web_process_sharing_a_reuse_port_listener(mock_config):
+    mock_config.processes["web"] = ProcessConfig(
+        command="gunicorn app.wsgi",
+        replicas=2,
+        socket=SocketConfig(listen="127.0.0.1:8000", reuse_port=True),
+    )
+    socket = mock_config.render_systemd_units()["testapp@.socket"]
+    assert "ListenStream=127.0.0.1:8000\nReusePort=true\n" in socket
+    # every replica accepts on the same port, caddy has a single upstream
+    assert mock_config.get_web_upstreams() == ["localhost:8000"]
+
+
+def test_render_caddyfile_load_balances_port_replicas(mock_config):
+    mock_config.processes["web"].replicas = 3
+    mock_config.webserver = Webserver(
+        port_base=8000,
+        lb_policy="least_conn",
+        lb_try_duration="5s",
+        health_uri="/up",
+        health_interval="10s",
+        keepalive_idle_conns_per_host=32,
+    )
+    assert mock_config.render_caddyfile() == snapshot("""\
+example.com {
+	
+
+	reverse_proxy localhost:8001 localhost:8002 localhost:8003 {
+		lb_policy least_conn
+		lb_try_duration 5s
+		lb_try_interval 250ms
+		health_uri /up
+		health_interval 10s
+		transport http {
+			keepalive_idle_conns_per_host 32
+		}
+	}
+}\
+""")
+    ports = {
+        name: content.splitlines()[-1]
+        for name, content in mock_config.render_systemd_units().items()
+        if name.endswith("port.conf")
+    }
+    assert ports == {
+        "testapp@1.service.d/port.conf": "Environment=PORT=8001",
+        "testapp@2.service.d/port.conf": "Environment=PORT=8002",
+        "testapp@3.service.d/port.conf": "Environment=PORT=8003",
+    }
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{"lb_policy": "fastest"}, {"health_interval": "10"}, {"health_uri": "up"}],
+)
+def test_webserver_load_balancing_validation(options):
+    with pytest.raises(ImproperlyConfiguredError):
+        Webserver(upstream="localhost:8000", **options)
+
+
+def test_render_caddyfile_holds_requests_while_the_upstream_restarts(mock_config):
+    mock_config.webserver = Webserver(
+        upstream="localhost:8000", fail_duration="30s", request_buffers="4MB"
+    )
+    assert mock_config.render_caddyfile() == snapshot("""\
+example.com {
+	
+
+	reverse_proxy localhost:8000 {
+		lb_try_duration 10s
+		lb_try_interval 250ms
+		fail_duration 30s
+		request_buffers 4MB
+	}
+}\
+""")
+    mock_config.webserver = Webserver(upstream="localhost:8000", hold_requests=False)
+    assert "reverse_proxy localhost:8000\n" in mock_config.render_caddyfile()
+    with pytest.raises(ImproperlyConfiguredError):
+        Webserver(upstream="localhost:8000", request_buffers="4 megs")
+
+
+def test_port_base_needs_web_replicas(mock_config):
+    with pytest.raises(ImproperlyConfiguredError):
+        msgspec.structs.replace(mock_config, webserver=Webserver(port_base=8000))
+
+
+def test_blue_green_runs_each_color_on_its_own_ports(mock_config):
+    mock_config.processes["web"].replicas = 2
+    mock_config.webserver = Webserver(port_base=8000, blue_green=BlueGreenConfig())
+    assert mock_config.get_active_unit_names("web", "green") == [
+        "testapp@green-1.service",
+        "testapp@green-2.service",
+    ]
+    assert mock_config.get_web_upstreams("blue") == ["localhost:8001", "localhost:8002"]
+    assert mock_config.get_web_upstreams("green") == [
+        "localhost:8003",
+        "localhost:8004",
+    ]
+    assert "reverse_proxy localhost:8003 localhost:8004" in (
+        mock_config.render_caddyfile("green")
+    )
+    mock_config.live_color = "green"
+    assert mock_config.get_web_upstreams() == ["localhost:8003", "localhost:8004"]
+    units = mock_config.render_systemd_units()
+    assert "testapp@.service" in units
+    assert units["testapp@green-2.service.d/port.conf"].endswith("PORT=8004")
+    assert [next_color(None), next_color("blue"), next_color("green")] == [
+        "blue",
+        "green",
+        "blue",
+    ]
+
+
+def test_blue_green_validation(mock_config):
+    with pytest.raises(ImproperlyConfiguredError):
+        BlueGreenConfig(readiness_path="up")
+    with pytest.raises(ImproperlyConfiguredError):
+        # the colors need their own ports
+        msgspec.structs.replace(
+            mock_config,
+            webserver=Webserver(
+                upstream="localhost:8000", blue_green=BlueGreenConfig()
+            ),
+        )
+    mock_config.processes["web"].socket = True
+    with pytest.raises(ImproperlyConfiguredError):
+        msgspec.structs.replace(
+            mock_config,
+            webserver=Webserver(port_base=8000, blue_green=BlueGreenConfig()),
+        )
+
+
+def test_warmup_validation(mock_config):
+    with pytest.raises(ImproperlyConfiguredError):
+        WarmupConfig()
+    with pytest.raises(ImproperlyConfiguredError):
+        WarmupConfig(urls=["/"], command="true")
+    with pytest.raises(ImproperlyConfiguredError):
+        WarmupConfig(urls=["products/"])
+    mock_config.processes["worker"].warmup = WarmupConfig(urls=["/"])
+    with pytest.raises(ImproperlyConfiguredError):
+        # only the web process has upstreams
+        msgspec.structs.replace(mock_config)
+
+
+def test_edge_config_validation():
+    with pytest.raises(ImproperlyConfiguredError):
+        EdgeConfig(
+            ip="10.0.0.1",
+            user="edge",
+            backends=[EdgeBackend(address="10.0.0.2:8000")],
+            backend="10.0.0.9:8000",
+        )
+    with pytest.raises(ImproperlyConfiguredError):
+        EdgeConfig(ip="10.0.0.1", user="edge", backends=[])
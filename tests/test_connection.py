@@ -0,0 +1,156 @@
+import getpass
+import io
+import json
+from unittest.mock import patch
+
+import cappa
+import pytest
+from invoke.exceptions import UnexpectedExit
+
+from fujin import trace
+from fujin.config import HostConfig
+from fujin.connection import LocalConnection
+from fujin.connection import host_connection
+from fujin.connection import iter_output
+
+
+def local_host(**kwargs) -> HostConfig:
+    return HostConfig(
+        ip="localhost", domain_name="example.com", user=getpass.getuser(), **kwargs
+    )
+
+
+def test_localhost_uses_local_connection():
+    with host_connection(local_host()) as conn:
+        assert isinstance(conn, LocalConnection)
+
+
+def test_localhost_with_another_user_uses_ssh():
+    host = HostConfig(ip="localhost", domain_name="example.com", user="someone-else")
+    with patch("fujin.connection.Connection") as connection:
+        with host_connection(host):
+            pass
+    connection.assert_called_once()
+
+
+def test_forwarded_loopback_port_uses_ssh():
+    host = local_host(ssh_port=2222)
+    with patch("fujin.connection.Connection") as connection:
+        with host_connection(host):
+            pass
+    connection.assert_called_once()
+
+
+def test_local_connection_runs_commands(tmp_path, monkeypatch):
+    # invoke forwards stdin to local subprocesses
+    monkeypatch.setattr("sys.stdin", io.StringIO())
+    with host_connection(local_host()) as conn:
+        with conn.cd(str(tmp_path)):
+            conn.run("echo hello > greeting")
+        result = conn.run(f"cat {tmp_path}/greeting; echo $PATH", hide=True)
+    greeting, path = result.stdout.splitlines()
+    assert greeting == "hello"
+    assert path.startswith(f"/home/{getpass.getuser()}/.cargo/bin:")
+    assert "$PATH" not in path
+
+
+def test_iter_output_streams_with_the_run_path():
+    # more stderr than a pipe holds, the command must not block on it
+    command = "head -c 200000 /dev/zero >&2; echo $PATH"
+    with host_connection(local_host()) as conn:
+        output = b"".join(iter_output(conn, command))
+    assert output.decode().startswith(f"/home/{getpass.getuser()}/.cargo/bin:")
+
+
+def test_iter_output_exports_the_run_path_over_ssh():
+    host = HostConfig(ip="10.0.0.1", domain_name="example.com", user="deploy")
+    with patch("fujin.connection.Connection") as connection:
+        connection.return_value.user = "deploy"
+        with host_connection(host) as conn:
+            channel = conn.client.get_transport().open_session()
+            channel.recv.return_value = b""
+            channel.recv_stderr.return_value = b""
+            channel.recv_exit_status.return_value = 0
+            assert list(iter_output(conn, "uv --version")) == []
+    (command,) = channel.exec_command.call_args.args
+    assert command == (
+        'export PATH="/home/deploy/.cargo/bin:/home/deploy/.local/bin:$PATH" '
+        "&& uv --version"
+    )
+
+
+def test_local_connection_runs_commands_from_home(tmp_path, monkeypatch):
+    monkeypatch.setattr("sys.stdin", io.StringIO())
+    home = tmp_path / "home"
+    (home / "releases").mkdir(parents=True)
+    monkeypatch.setenv("HOME", str(home))
+    monkeypatch.chdir(tmp_path)
+    with host_connection(local_host()) as conn:
+        assert conn.run("pwd", hide=True).stdout.strip() == str(home)
+        with conn.cd("releases"):
+            result = conn.run("pwd", hide=True)
+    assert result.stdout.strip() == str(home / "releases")
+
+
+def test_iter_output_reads_the_stderr_over_ssh():
+    host = HostConfig(ip="10.0.0.1", domain_name="example.com", user="deploy")
+    with patch("fujin.connection.Connection"):
+        with host_connection(host) as conn:
+            channel = conn.client.get_transport().open_session()
+            channel.recv.side_effect = [b"partial", b""]
+            channel.recv_stderr.side_effect = [b"disk ", b"full", b""]
+            channel.recv_exit_status.return_value = 1
+            with pytest.raises(cappa.Exit) as exc_info:
+                list(iter_output(conn, "cat big.log"))
+    assert exc_info.value.message == "disk full"
+
+
+def test_local_connection_put_links_files(tmp_path):
+    source = tmp_path / "app.whl"
+    source.write_bytes(b"v1")
+    source.chmod(0o755)
+    release_dir = tmp_path / "v0.1.0"
+    release_dir.mkdir()
+
+    with host_connection(local_host()) as conn:
+        conn.put(str(source), str(release_dir / "app.whl"))
+        # putting to an existing file replaces it
+        conn.put(str(source), str(release_dir / "app.whl"))
+        conn.put(str(source), str(release_dir))
+
+    target = release_dir / "app.whl"
+    assert target.read_bytes() == b"v1"
+    assert target.stat().st_mode & 0o777 == 0o755
+
+
+def test_local_connection_put_never_changes_the_source_mode(tmp_path):
+    source = tmp_path / "app.pyz"
+    source.write_bytes(b"v1")
+    source.chmod(0o2755)
+
+    with host_connection(local_host()) as conn:
+        conn.put(str(source), str(tmp_path / "copy.pyz"))
+
+    assert source.stat().st_mode & 0o7777 == 0o2755
+    assert (tmp_path / "copy.pyz").stat().st_mode & 0o7777 == 0o755
+
+
+def test_traced_commands_are_not_recorded(monkeypatch):
+    monkeypatch.setattr("sys.stdin", io.StringIO())
+    with trace.tracing() as tracer:
+        with host_connection(local_host()) as conn:
+            with trace.span("env"):
+                conn.run(
+                    "echo 'SECRET_KEY=hunter2' > /dev/null; sudo -n true",
+                    warn=True,
+                    hide=True,
+                )
+            with pytest.raises(UnexpectedExit):
+                conn.run("echo 'SECRET_KEY=hunter2'; exit 3", hide=True)
+
+    exported = json.dumps(tracer.to_chrome_trace())
+    assert "hunter2" not in exported
+    remote = tracer.remote_spans
+    assert [s.name for s in remote] == ["env", "command"]
+    assert tracer.sudo_invocations == 1
+    assert remote[1].args == {"sudo": 0, "exit_code": 3, "error": "UnexpectedExit"}
@@ -1,9 +1,24 @@
+import json
 import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 from unittest.mock import MagicMock, patch
 
+import cappa
+import pytest
 from inline_snapshot import snapshot
+from invoke.exceptions import UnexpectedExit
+from fujin import history
 from fujin.commands.deploy import Deploy
-from fujin.config import InstallationMode
+from fujin.plan import echoed_hash
+from fujin.config import InstallationMode, MetricsConfig
+from fujin.config import ResourcesConfig
+from fujin.config import EdgeBackend
+from fujin.config import EdgeConfig
+from fujin.config import BlueGreenConfig
+from fujin.config import Webserver
+from fujin.config import WarmupConfig
 
 
 def test_deploy_binary_mode(mock_config, mock_connection, get_commands):
@@ -17,19 +32,27 @@ def test_deploy_binary_mode(mock_config, mock_connection, get_commands):
 
     assert get_commands(mock_connection.mock_calls) == snapshot(
         [
-            "mkdir -p /home/testuser/.local/share/fujin/myapp",
-            "echo 'FOO=bar' > /home/testuser/.local/share/fujin/myapp/.env",
-            "mkdir -p /home/testuser/.local/share/fujin/myapp/v0.1.0",
+            """\
+echo '::versions::'; { cat /home/testuser/.local/share/fujin/myapp/.versions; } 2>/dev/null
+echo '::requirements::'; { md5sum /home/testuser/.local/share/fujin/myapp/v$(head -n 1 /home/testuser/.local/share/fujin/myapp/.versions 2>/dev/null)/requirements.txt; } 2>/dev/null
+echo '::units::'; { md5sum /etc/systemd/system/myapp* /etc/systemd/system/myapp*.d/*.conf; } 2>/dev/null
+echo '::wants::'; { ls /etc/systemd/system/multi-user.target.wants/myapp*; } 2>/dev/null
+echo '::loaded::'; { systemctl list-units --full --all --plain --no-legend 'myapp*'; } 2>/dev/null
+echo '::caddy::'; { md5sum /etc/caddy/conf.d/myapp.caddy; } 2>/dev/null
+echo '::env::'; { md5sum /home/testuser/.local/share/fujin/myapp/.env; } 2>/dev/null
+echo '::host::'; { nproc; free -m | awk '/^Mem:/ {print $2}'; } 2>/dev/null
+echo '::color::'; { cat /home/testuser/.local/share/fujin/myapp/.color; } 2>/dev/null
+echo '::5xx::'; { curl -sf --max-time 1 http://localhost:2019/metrics | awk -v site='host="example.com"' '/^caddy_http_request_duration_seconds_count\\{/ && index($0, site) && index($0, "handler=\\"reverse_proxy\\"") {n++; if ($0 ~ /code="5/) s += $NF} END {if (n) printf "%d\\n", s}'; } 2>/dev/null\
+""",
+            "mkdir -p /home/testuser/.local/share/fujin/myapp/v0.1.0 && echo 'FOO=bar' > /home/testuser/.local/share/fujin/myapp/.env",
             """\
 echo 'set -a  # Automatically export all variables
 source .env
 set +a  # Stop automatic export
 export PATH="/home/testuser/.local/share/fujin/myapp:$PATH"' > /home/testuser/.local/share/fujin/myapp/.appenv\
 """,
-            "rm /home/testuser/.local/share/fujin/myapp/myapp",
-            "ln -s /home/testuser/.local/share/fujin/myapp/v0.1.0/testapp-0.1.0.whl /home/testuser/.local/share/fujin/myapp/myapp",
-            "head -n 1 .versions",
-            "sed -i '1i 0.1.0' .versions",
+            "ln -sfn /home/testuser/.local/share/fujin/myapp/v0.1.0/testapp-0.1.0.whl /home/testuser/.local/share/fujin/myapp/myapp",
+            "echo '0.1.0' > .versions",
             """\
 echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
 # Inspiration was taken from here https://docs.gunicorn.org/en/stable/deploy.html#systemd
@@ -55,10 +78,7 @@ PrivateTmp=true
 ProtectSystem=strict
 
 [Install]
-WantedBy=multi-user.target' | sudo tee /etc/systemd/system/myapp.service\
-""",
-            """\
-echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
+WantedBy=multi-user.target' | sudo tee /etc/systemd/system/myapp.service > /dev/null && echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
 [Unit]
 Description=myapp-worker@
 
@@ -71,23 +91,20 @@ EnvironmentFile=/home/testuser/.local/share/fujin/myapp/.env
 Restart=always
 
 [Install]
-WantedBy=multi-user.target' | sudo tee /etc/systemd/system/myapp-worker@.service\
+WantedBy=multi-user.target' | sudo tee /etc/systemd/system/myapp-worker@.service > /dev/null && sudo systemctl daemon-reload\
 """,
-            "sudo systemctl daemon-reload",
             "sudo systemctl enable --now myapp.service myapp-worker@1.service myapp-worker@2.service",
-            "systemctl list-units --full --all --plain --no-legend 'myapp*'",
-            "ls /etc/systemd/system/myapp*",
-            "ls /etc/systemd/system/multi-user.target.wants/myapp*",
             "sudo systemctl restart myapp.service myapp-worker@1.service myapp-worker@2.service",
             """\
 echo 'example.com {
 	
 
-	reverse_proxy localhost:8000
-}' | sudo tee /etc/caddy/conf.d/myapp.caddy\
+	reverse_proxy localhost:8000 {
+		lb_try_duration 10s
+		lb_try_interval 250ms
+	}
+}' | sudo tee /etc/caddy/conf.d/myapp.caddy > /dev/null && sudo systemctl reload caddy\
 """,
-            "sudo systemctl reload caddy",
-            "sed -n '6,$p' .versions",
         ]
     )
 
@@ -108,8 +125,6 @@ def test_deploy_python_rebuild_venv(
         mock_res = MagicMock()
         mock_res.ok = True
         mock_res.stdout = ""
-        if "head -n 1 .versions" in cmd:
-            mock_res.stdout = ""
         return mock_res
 
     mock_connection.run.side_effect = run_side_effect
@@ -120,9 +135,19 @@ def test_deploy_python_rebuild_venv(
 
     assert get_commands(mock_connection.mock_calls) == snapshot(
         [
-            "mkdir -p /home/testuser/.local/share/fujin/testapp",
-            "echo 'FOO=bar' > /home/testuser/.local/share/fujin/testapp/.env",
-            "mkdir -p /home/testuser/.local/share/fujin/testapp/v0.1.0",
+            """\
+echo '::versions::'; { cat /home/testuser/.local/share/fujin/testapp/.versions; } 2>/dev/null
+echo '::requirements::'; { md5sum /home/testuser/.local/share/fujin/testapp/v$(head -n 1 /home/testuser/.local/share/fujin/testapp/.versions 2>/dev/null)/requirements.txt; } 2>/dev/null
+echo '::units::'; { md5sum /etc/systemd/system/testapp* /etc/systemd/system/testapp*.d/*.conf; } 2>/dev/null
+echo '::wants::'; { ls /etc/systemd/system/multi-user.target.wants/testapp*; } 2>/dev/null
+echo '::loaded::'; { systemctl list-units --full --all --plain --no-legend 'testapp*'; } 2>/dev/null
+echo '::caddy::'; { md5sum /etc/caddy/conf.d/testapp.caddy; } 2>/dev/null
+echo '::env::'; { md5sum /home/testuser/.local/share/fujin/testapp/.env; } 2>/dev/null
+echo '::host::'; { nproc; free -m | awk '/^Mem:/ {print $2}'; } 2>/dev/null
+echo '::color::'; { cat /home/testuser/.local/share/fujin/testapp/.color; } 2>/dev/null
+echo '::5xx::'; { curl -sf --max-time 1 http://localhost:2019/metrics | awk -v site='host="example.com"' '/^caddy_http_request_duration_seconds_count\\{/ && index($0, site) && index($0, "handler=\\"reverse_proxy\\"") {n++; if ($0 ~ /code="5/) s += $NF} END {if (n) printf "%d\\n", s}'; } 2>/dev/null\
+""",
+            "mkdir -p /home/testuser/.local/share/fujin/testapp/v0.1.0 && echo 'FOO=bar' > /home/testuser/.local/share/fujin/testapp/.env",
             """\
 echo 'set -a  # Automatically export all variables
 source .env
@@ -131,13 +156,8 @@ export UV_COMPILE_BYTECODE=1
 export UV_PYTHON=python3.12
 export PATH=".venv/bin:$PATH"' > /home/testuser/.local/share/fujin/testapp/.appenv\
 """,
-            "head -n 1 .versions",
-            "sudo rm -rf .venv",
-            "uv python install 3.12",
-            "uv venv",
-            "uv pip install -r /home/testuser/.local/share/fujin/testapp/v0.1.0/requirements.txt",
+            "sudo rm -rf .venv && uv python install 3.12 && uv venv && uv pip install -r /home/testuser/.local/share/fujin/testapp/v0.1.0/requirements.txt",
             "uv pip install /home/testuser/.local/share/fujin/testapp/v0.1.0/testapp-0.1.0.whl",
-            "head -n 1 .versions",
             "echo '0.1.0' > .versions",
             """\
 echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
@@ -164,10 +184,7 @@ PrivateTmp=true
 ProtectSystem=strict
 
 [Install]
-WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp.service\
-""",
-            """\
-echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
+WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp.service > /dev/null && echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
 [Unit]
 Description=testapp-worker@
 
@@ -180,28 +197,27 @@ EnvironmentFile=/home/testuser/.local/share/fujin/testapp/.env
 Restart=always
 
 [Install]
-WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp-worker@.service\
+WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp-worker@.service > /dev/null && sudo systemctl daemon-reload\
 """,
-            "sudo systemctl daemon-reload",
             "sudo systemctl enable --now testapp.service testapp-worker@1.service testapp-worker@2.service",
-            "systemctl list-units --full --all --plain --no-legend 'testapp*'",
-            "ls /etc/systemd/system/testapp*",
-            "ls /etc/systemd/system/multi-user.target.wants/testapp*",
             "sudo systemctl restart testapp.service testapp-worker@1.service testapp-worker@2.service",
             """\
 echo 'example.com {
 	
 
-	reverse_proxy localhost:8000
-}' | sudo tee /etc/caddy/conf.d/testapp.caddy\
+	reverse_proxy localhost:8000 {
+		lb_try_duration 10s
+		lb_try_interval 250ms
+	}
+}' | sudo tee /etc/caddy/conf.d/testapp.caddy > /dev/null && sudo systemctl reload caddy\
 """,
-            "sudo systemctl reload caddy",
-            "sed -n '6,$p' .versions",
         ]
     )
 
 
-def test_deploy_python_reuse_venv(mock_config, mock_connection, tmp_path, get_commands):
+def test_deploy_python_reuse_venv(
+    mock_config, mock_connection, tmp_path, get_commands, remote_state_output
+):
     mock_config.installation_mode = InstallationMode.PY_PACKAGE
     mock_config.requirements = "requirements.txt"
 
@@ -217,10 +233,10 @@ def test_deploy_python_reuse_venv(mock_config, mock_connection, tmp_path, get_co
         mock_res = MagicMock()
         mock_res.ok = True
         mock_res.stdout = ""
-        if "head -n 1 .versions" in cmd:
-            mock_res.stdout = "0.0.1"
-        if "md5sum" in cmd:
-            mock_res.stdout = f"{local_hash}  requirements.txt"
+        if "::versions::" in cmd:
+            mock_res.stdout = remote_state_output(
+                versions=["0.0.1"], requirements_hash=local_hash
+            )
         return mock_res
 
     mock_connection.run.side_effect = run_side_effect
@@ -231,9 +247,19 @@ def test_deploy_python_reuse_venv(mock_config, mock_connection, tmp_path, get_co
 
     assert get_commands(mock_connection.mock_calls) == snapshot(
         [
-            "mkdir -p /home/testuser/.local/share/fujin/testapp",
-            "echo 'FOO=bar' > /home/testuser/.local/share/fujin/testapp/.env",
-            "mkdir -p /home/testuser/.local/share/fujin/testapp/v0.1.0",
+            """\
+echo '::versions::'; { cat /home/testuser/.local/share/fujin/testapp/.versions; } 2>/dev/null
+echo '::requirements::'; { md5sum /home/testuser/.local/share/fujin/testapp/v$(head -n 1 /home/testuser/.local/share/fujin/testapp/.versions 2>/dev/null)/requirements.txt; } 2>/dev/null
+echo '::units::'; { md5sum /etc/systemd/system/testapp* /etc/systemd/system/testapp*.d/*.conf; } 2>/dev/null
+echo '::wants::'; { ls /etc/systemd/system/multi-user.target.wants/testapp*; } 2>/dev/null
+echo '::loaded::'; { systemctl list-units --full --all --plain --no-legend 'testapp*'; } 2>/dev/null
+echo '::caddy::'; { md5sum /etc/caddy/conf.d/testapp.caddy; } 2>/dev/null
+echo '::env::'; { md5sum /home/testuser/.local/share/fujin/testapp/.env; } 2>/dev/null
+echo '::host::'; { nproc; free -m | awk '/^Mem:/ {print $2}'; } 2>/dev/null
+echo '::color::'; { cat /home/testuser/.local/share/fujin/testapp/.color; } 2>/dev/null
+echo '::5xx::'; { curl -sf --max-time 1 http://localhost:2019/metrics | awk -v site='host="example.com"' '/^caddy_http_request_duration_seconds_count\\{/ && index($0, site) && index($0, "handler=\\"reverse_proxy\\"") {n++; if ($0 ~ /code="5/) s += $NF} END {if (n) printf "%d\\n", s}'; } 2>/dev/null\
+""",
+            "mkdir -p /home/testuser/.local/share/fujin/testapp/v0.1.0 && echo 'FOO=bar' > /home/testuser/.local/share/fujin/testapp/.env",
             """\
 echo 'set -a  # Automatically export all variables
 source .env
@@ -242,11 +268,8 @@ export UV_COMPILE_BYTECODE=1
 export UV_PYTHON=python3.12
 export PATH=".venv/bin:$PATH"' > /home/testuser/.local/share/fujin/testapp/.appenv\
 """,
-            "head -n 1 .versions",
-            "md5sum /home/testuser/.local/share/fujin/testapp/v0.0.1/requirements.txt",
             "cp /home/testuser/.local/share/fujin/testapp/v0.0.1/requirements.txt /home/testuser/.local/share/fujin/testapp/v0.1.0/requirements.txt",
             "uv pip install /home/testuser/.local/share/fujin/testapp/v0.1.0/testapp-0.1.0.whl",
-            "head -n 1 .versions",
             "sed -i '1i 0.1.0' .versions",
             """\
 echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
@@ -273,10 +296,7 @@ PrivateTmp=true
 ProtectSystem=strict
 
 [Install]
-WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp.service\
-""",
-            """\
-echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
+WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp.service > /dev/null && echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
 [Unit]
 Description=testapp-worker@
 
@@ -289,35 +309,35 @@ EnvironmentFile=/home/testuser/.local/share/fujin/testapp/.env
 Restart=always
 
 [Install]
-WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp-worker@.service\
+WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp-worker@.service > /dev/null && sudo systemctl daemon-reload\
 """,
-            "sudo systemctl daemon-reload",
             "sudo systemctl enable --now testapp.service testapp-worker@1.service testapp-worker@2.service",
-            "systemctl list-units --full --all --plain --no-legend 'testapp*'",
-            "ls /etc/systemd/system/testapp*",
-            "ls /etc/systemd/system/multi-user.target.wants/testapp*",
             "sudo systemctl restart testapp.service testapp-worker@1.service testapp-worker@2.service",
             """\
 echo 'example.com {
 	
 
-	reverse_proxy localhost:8000
-}' | sudo tee /etc/caddy/conf.d/testapp.caddy\
+	reverse_proxy localhost:8000 {
+		lb_try_duration 10s
+		lb_try_interval 250ms
+	}
+}' | sudo tee /etc/caddy/conf.d/testapp.caddy > /dev/null && sudo systemctl reload caddy\
 """,
-            "sudo systemctl reload caddy",
-            "sed -n '6,$p' .versions",
         ]
     )
 
 
-def test_deploy_version_update(mock_config, mock_connection, get_commands):
+def test_deploy_version_update(
+    mock_config, mock_connection, get_commands, remote_state_output
+):
     # Mock remote state: .versions file exists
     def run_side_effect(cmd, **kwargs):
         mock_res = MagicMock()
         mock_res.ok = True
         mock_res.stdout = ""
-        if "head -n 1 .versions" in cmd:
-            mock_res.stdout = "0.0.1"  # Different from current version
+        if "::versions::" in cmd:
+            # Different from current version
+            mock_res.stdout = remote_state_output(versions=["0.0.1"])
         return mock_res
 
     mock_connection.run.side_effect = run_side_effect
@@ -328,9 +348,19 @@ def test_deploy_version_update(mock_config, mock_connection, get_commands):
 
     assert get_commands(mock_connection.mock_calls) == snapshot(
         [
-            "mkdir -p /home/testuser/.local/share/fujin/testapp",
-            "echo 'FOO=bar' > /home/testuser/.local/share/fujin/testapp/.env",
-            "mkdir -p /home/testuser/.local/share/fujin/testapp/v0.1.0",
+            """\
+echo '::versions::'; { cat /home/testuser/.local/share/fujin/testapp/.versions; } 2>/dev/null
+echo '::requirements::'; { md5sum /home/testuser/.local/share/fujin/testapp/v$(head -n 1 /home/testuser/.local/share/fujin/testapp/.versions 2>/dev/null)/requirements.txt; } 2>/dev/null
+echo '::units::'; { md5sum /etc/systemd/system/testapp* /etc/systemd/system/testapp*.d/*.conf; } 2>/dev/null
+echo '::wants::'; { ls /etc/systemd/system/multi-user.target.wants/testapp*; } 2>/dev/null
+echo '::loaded::'; { systemctl list-units --full --all --plain --no-legend 'testapp*'; } 2>/dev/null
+echo '::caddy::'; { md5sum /etc/caddy/conf.d/testapp.caddy; } 2>/dev/null
+echo '::env::'; { md5sum /home/testuser/.local/share/fujin/testapp/.env; } 2>/dev/null
+echo '::host::'; { nproc; free -m | awk '/^Mem:/ {print $2}'; } 2>/dev/null
+echo '::color::'; { cat /home/testuser/.local/share/fujin/testapp/.color; } 2>/dev/null
+echo '::5xx::'; { curl -sf --max-time 1 http://localhost:2019/metrics | awk -v site='host="example.com"' '/^caddy_http_request_duration_seconds_count\\{/ && index($0, site) && index($0, "handler=\\"reverse_proxy\\"") {n++; if ($0 ~ /code="5/) s += $NF} END {if (n) printf "%d\\n", s}'; } 2>/dev/null\
+""",
+            "mkdir -p /home/testuser/.local/share/fujin/testapp/v0.1.0 && echo 'FOO=bar' > /home/testuser/.local/share/fujin/testapp/.env",
             """\
 echo 'set -a  # Automatically export all variables
 source .env
@@ -339,11 +369,8 @@ export UV_COMPILE_BYTECODE=1
 export UV_PYTHON=python3.12
 export PATH=".venv/bin:$PATH"' > /home/testuser/.local/share/fujin/testapp/.appenv\
 """,
-            "sudo rm -rf .venv",
-            "uv python install 3.12",
-            "uv venv",
+            "sudo rm -rf .venv && uv python install 3.12 && uv venv",
             "uv pip install /home/testuser/.local/share/fujin/testapp/v0.1.0/testapp-0.1.0.whl",
-            "head -n 1 .versions",
             "sed -i '1i 0.1.0' .versions",
             """\
 echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
@@ -370,10 +397,7 @@ PrivateTmp=true
 ProtectSystem=strict
 
 [Install]
-WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp.service\
-""",
-            """\
-echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
+WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp.service > /dev/null && echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
 [Unit]
 Description=testapp-worker@
 
@@ -386,28 +410,27 @@ EnvironmentFile=/home/testuser/.local/share/fujin/testapp/.env
 Restart=always
 
 [Install]
-WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp-worker@.service\
+WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp-worker@.service > /dev/null && sudo systemctl daemon-reload\
 """,
-            "sudo systemctl daemon-reload",
             "sudo systemctl enable --now testapp.service testapp-worker@1.service testapp-worker@2.service",
-            "systemctl list-units --full --all --plain --no-legend 'testapp*'",
-            "ls /etc/systemd/system/testapp*",
-            "ls /etc/systemd/system/multi-user.target.wants/testapp*",
             "sudo systemctl restart testapp.service testapp-worker@1.service testapp-worker@2.service",
             """\
 echo 'example.com {
 	
 
-	reverse_proxy localhost:8000
-}' | sudo tee /etc/caddy/conf.d/testapp.caddy\
+	reverse_proxy localhost:8000 {
+		lb_try_duration 10s
+		lb_try_interval 250ms
+	}
+}' | sudo tee /etc/caddy/conf.d/testapp.caddy > /dev/null && sudo systemctl reload caddy\
 """,
-            "sudo systemctl reload caddy",
-            "sed -n '6,$p' .versions",
         ]
     )
 
 
-def test_deploy_pruning(mock_config, mock_connection, get_commands):
+def test_deploy_pruning(
+    mock_config, mock_connection, get_commands, remote_state_output
+):
     mock_config.versions_to_keep = 2
 
     # Mock remote state: return list of versions to prune
@@ -415,9 +438,9 @@ def test_deploy_pruning(mock_config, mock_connection, get_commands):
         mock_res = MagicMock()
         mock_res.ok = True
         mock_res.stdout = ""
-        if "sed -n" in cmd:
-            # Simulate 3 versions existing, keeping 2, so 1 to prune
-            mock_res.stdout = "0.0.1"
+        if "::versions::" in cmd:
+            # Simulate 3 versions existing after the deploy, keeping 2, so 1 to prune
+            mock_res.stdout = remote_state_output(versions=["0.0.2", "0.0.1"])
         return mock_res
 
     mock_connection.run.side_effect = run_side_effect
@@ -428,9 +451,19 @@ def test_deploy_pruning(mock_config, mock_connection, get_commands):
 
     assert get_commands(mock_connection.mock_calls) == snapshot(
         [
-            "mkdir -p /home/testuser/.local/share/fujin/testapp",
-            "echo 'FOO=bar' > /home/testuser/.local/share/fujin/testapp/.env",
-            "mkdir -p /home/testuser/.local/share/fujin/testapp/v0.1.0",
+            """\
+echo '::versions::'; { cat /home/testuser/.local/share/fujin/testapp/.versions; } 2>/dev/null
+echo '::requirements::'; { md5sum /home/testuser/.local/share/fujin/testapp/v$(head -n 1 /home/testuser/.local/share/fujin/testapp/.versions 2>/dev/null)/requirements.txt; } 2>/dev/null
+echo '::units::'; { md5sum /etc/systemd/system/testapp* /etc/systemd/system/testapp*.d/*.conf; } 2>/dev/null
+echo '::wants::'; { ls /etc/systemd/system/multi-user.target.wants/testapp*; } 2>/dev/null
+echo '::loaded::'; { systemctl list-units --full --all --plain --no-legend 'testapp*'; } 2>/dev/null
+echo '::caddy::'; { md5sum /etc/caddy/conf.d/testapp.caddy; } 2>/dev/null
+echo '::env::'; { md5sum /home/testuser/.local/share/fujin/testapp/.env; } 2>/dev/null
+echo '::host::'; { nproc; free -m | awk '/^Mem:/ {print $2}'; } 2>/dev/null
+echo '::color::'; { cat /home/testuser/.local/share/fujin/testapp/.color; } 2>/dev/null
+echo '::5xx::'; { curl -sf --max-time 1 http://localhost:2019/metrics | awk -v site='host="example.com"' '/^caddy_http_request_duration_seconds_count\\{/ && index($0, site) && index($0, "handler=\\"reverse_proxy\\"") {n++; if ($0 ~ /code="5/) s += $NF} END {if (n) printf "%d\\n", s}'; } 2>/dev/null\
+""",
+            "mkdir -p /home/testuser/.local/share/fujin/testapp/v0.1.0 && echo 'FOO=bar' > /home/testuser/.local/share/fujin/testapp/.env",
             """\
 echo 'set -a  # Automatically export all variables
 source .env
@@ -439,12 +472,9 @@ export UV_COMPILE_BYTECODE=1
 export UV_PYTHON=python3.12
 export PATH=".venv/bin:$PATH"' > /home/testuser/.local/share/fujin/testapp/.appenv\
 """,
-            "sudo rm -rf .venv",
-            "uv python install 3.12",
-            "uv venv",
+            "sudo rm -rf .venv && uv python install 3.12 && uv venv",
             "uv pip install /home/testuser/.local/share/fujin/testapp/v0.1.0/testapp-0.1.0.whl",
-            "head -n 1 .versions",
-            "echo '0.1.0' > .versions",
+            "sed -i '1i 0.1.0' .versions",
             """\
 echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
 # Inspiration was taken from here https://docs.gunicorn.org/en/stable/deploy.html#systemd
@@ -470,10 +500,7 @@ PrivateTmp=true
 ProtectSystem=strict
 
 [Install]
-WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp.service\
-""",
-            """\
-echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
+WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp.service > /dev/null && echo '# All options are documented here https://www.freedesktop.org/software/systemd/man/latest/systemd.exec.html
 [Unit]
 Description=testapp-worker@
 
@@ -486,24 +513,493 @@ EnvironmentFile=/home/testuser/.local/share/fujin/testapp/.env
 Restart=always
 
 [Install]
-WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp-worker@.service\
+WantedBy=multi-user.target' | sudo tee /etc/systemd/system/testapp-worker@.service > /dev/null && sudo systemctl daemon-reload\
 """,
-            "sudo systemctl daemon-reload",
             "sudo systemctl enable --now testapp.service testapp-worker@1.service testapp-worker@2.service",
-            "systemctl list-units --full --all --plain --no-legend 'testapp*'",
-            "ls /etc/systemd/system/testapp*",
-            "ls /etc/systemd/system/multi-user.target.wants/testapp*",
             "sudo systemctl restart testapp.service testapp-worker@1.service testapp-worker@2.service",
             """\
 echo 'example.com {
 	
 
-	reverse_proxy localhost:8000
-}' | sudo tee /etc/caddy/conf.d/testapp.caddy\
+	reverse_proxy localhost:8000 {
+		lb_try_duration 10s
+		lb_try_interval 250ms
+	}
+}' | sudo tee /etc/caddy/conf.d/testapp.caddy > /dev/null && sudo systemctl reload caddy\
 """,
-            "sudo systemctl reload caddy",
-            "sed -n '3,$p' .versions",
-            "rm -r /home/testuser/.local/share/fujin/testapp/v0.0.1",
-            "sed -i '3,$d' .versions",
+            "rm -r /home/testuser/.local/share/fujin/testapp/v0.0.1; sed -i '3,$d' .versions",
         ]
     )
+
+
+def test_deploy_plan_does_not_change_anything(
+    mock_config, mock_connection, tmp_path, get_commands
+):
+    req_path = tmp_path / "requirements.txt"
+    req_path.write_bytes(b"django")
+    mock_config.requirements = str(req_path)
+    mock_config.versions_to_keep = 2
+    web_unit = mock_config.render_systemd_units()["testapp.service"]
+    web_unit_hash = hashlib.md5(f"{web_unit}\n".encode()).hexdigest()
+    env_hash = hashlib.md5(b"FOO=bar\n").hexdigest()
+    remote_output = "\n".join(
+        [
+            "::versions::",
+            "0.0.2",
+            "0.0.1",
+            "::requirements::",
+            f"{hashlib.md5(b'django').hexdigest()}  /apps/testapp/v0.0.2/requirements.txt",
+            "::units::",
+            f"{web_unit_hash}  /etc/systemd/system/testapp.service",
+            "abc  /etc/systemd/system/testapp-beat.service",
+            "::caddy::",
+            "::env::",
+            f"{env_hash}  /apps/testapp/.env",
+            "::disk::",
+            "1000",
+            "5000",
+        ]
+    )
+    mock_connection.run.return_value.stdout = remote_output
+
+    with (
+        patch("subprocess.run") as build,
+        patch.object(Deploy, "print_plan") as print_plan,
+    ):
+        Deploy(plan=True)()
+
+    build.assert_not_called()
+    [preflight] = get_commands(mock_connection.mock_calls)
+    # only the plan measures the app directory, a deploy skips it
+    assert "du -sb /home/testuser/.local/share/fujin/testapp" in preflight
+    mock_connection.put.assert_not_called()
+
+    plan = print_plan.call_args.args[0]
+    assert plan.current_version == "0.0.2"
+    assert plan.rebuild_venv is False
+    assert plan.prunes == ["0.0.1"]
+    assert plan.remote.free_bytes == 5000
+    assert {c.path.rsplit("/", 1)[-1]: c.status for c in plan.rewrites} == snapshot(
+        {
+            ".env": "unchanged",
+            "testapp.service": "unchanged",
+            "testapp-worker@.service": "new",
+            "testapp-beat.service": "stale",
+            "testapp.caddy": "new",
+        }
+    )
+
+
+def test_deploy_writes_chrome_trace(mock_connection, tmp_path):
+    trace_file = tmp_path / "trace.json"
+    with patch("subprocess.run"):
+        Deploy(trace_file=trace_file)()
+
+    data = json.loads(trace_file.read_text())
+    assert {"round_trips", "sudo_invocations"} <= data["otherData"].keys()
+    events = data["traceEvents"]
+    assert all(event["ph"] == "X" for event in events)
+    assert [e["name"] for e in events if e["cat"] == "step"] == snapshot(
+        [
+            "secrets",
+            "build",
+            "preflight",
+            "env",
+            "upload",
+            "install",
+            "venv rebuild",
+            "install services",
+            "daemon-reload",
+            "restart",
+            "caddy",
+            "prune",
+        ]
+    )
+
+
+def test_deploy_appends_to_history(mock_config, mock_connection):
+    with patch("subprocess.run"):
+        Deploy()()
+        mock_connection.run.side_effect = UnexpectedExit(MagicMock(exited=1))
+        with pytest.raises(UnexpectedExit):
+            Deploy()()
+
+    records = history.read(history.history_path(mock_config))
+    assert [(r.command, r.version, r.outcome) for r in records] == [
+        ("deploy", "0.1.0", "success"),
+        ("deploy", "0.1.0", "failure"),
+    ]
+    assert records[0].venv_rebuilt is True
+    assert "build" in records[0].steps
+
+
+def test_deploy_writes_replica_cpu_affinity_drop_ins(
+    mock_config, mock_connection, get_commands
+):
+    mock_config.processes["worker"].resources = ResourcesConfig(
+        cpu_affinity="0-3", pin_replicas=True
+    )
+    with patch("subprocess.run"):
+        Deploy()()
+
+    commands = get_commands(mock_connection.mock_calls)
+    (reload,) = [c for c in commands if c.endswith("sudo systemctl daemon-reload")]
+    for replica, cpus in [(1, "0-1"), (2, "2-3")]:
+        drop_in = f"/etc/systemd/system/testapp-worker@{replica}.service.d"
+        assert f"sudo mkdir -p {drop_in} && echo '" in reload
+        assert f"CPUAffinity={cpus}' | sudo tee {drop_in}/cpu-affinity.conf" in reload
+
+
+def test_deploy_writes_metrics_textfile_without_extra_round_trip(
+    mock_config, mock_connection, get_commands, remote_state_output
+):
+    mock_config.versions_to_keep = 2
+    mock_connection.run.return_value.stdout = remote_state_output(
+        versions=["0.0.2", "0.0.1"]
+    )
+    with patch("subprocess.run"):
+        Deploy()()
+    commands_without_metrics = get_commands(mock_connection.mock_calls)
+    mock_connection.reset_mock()
+
+    mock_config.metrics = MetricsConfig(textfile_dir="/var/lib/node_exporter")
+    with patch("subprocess.run"):
+        Deploy()()
+    commands = get_commands(mock_connection.mock_calls)
+
+    assert len(commands) == len(commands_without_metrics)
+    last = commands[-1]
+    assert last.endswith(
+        "rm -r /home/testuser/.local/share/fujin/testapp/v0.0.1; sed -i '3,$d' .versions"
+    )
+    assert (
+        "sudo tee /var/lib/node_exporter/fujin_testapp.prom.tmp > /dev/null "
+        "&& sudo mv /var/lib/node_exporter/fujin_testapp.prom.tmp "
+        "/var/lib/node_exporter/fujin_testapp.prom" in last
+    )
+    assert 'fujin_release_info{app="testapp",version="0.1.0"} 1' in last
+    assert (
+        'fujin_deploy_duration_seconds{app="testapp",command="deploy",step="build"}'
+        in last
+    )
+    # the textfile is rendered while pruning, before the step has a duration
+    assert 'step="prune"' not in last
+    assert 'fujin_venv_rebuilt{app="testapp"} 1' in last
+
+
+def test_deploy_sizes_processes_from_the_preflight_host_facts(
+    mock_config, mock_connection, get_commands, remote_state_output
+):
+    mock_config.processes["web"].command = "gunicorn --workers {{ host.cpus * 2 + 1 }}"
+    mock_config.processes["worker"].replicas = "auto"
+    mock_connection.run.return_value.stdout = remote_state_output(host=(4, 7972))
+    with patch("subprocess.run"):
+        Deploy()()
+
+    commands = get_commands(mock_connection.mock_calls)
+    assert (
+        "ExecStart=/home/testuser/.local/share/fujin/testapp/gunicorn --workers 9\n"
+        in next(c for c in commands if c.endswith("sudo systemctl daemon-reload"))
+    )
+    assert (
+        "sudo systemctl restart testapp.service testapp-worker@1.service testapp-worker@2.service testapp-worker@3.service testapp-worker@4.service"
+        in commands
+    )
+    # the other commands reuse the facts without connecting
+    assert mock_config.host_facts_path.exists()
+
+
+def test_deploy_drains_the_host_on_the_edge_while_restarting(
+    mock_config, mock_connection, get_commands
+):
+    mock_config.edge = EdgeConfig(
+        ip="10.0.0.1",
+        user="edge",
+        backends=[
+            EdgeBackend(address="10.0.0.2:8000", weight=2),
+            EdgeBackend(address="10.0.0.3:8000"),
+        ],
+        backend="10.0.0.2:8000",
+        health_uri="/up",
+    )
+    with (
+        patch("fujin.caddy.host_connection") as edge_connection,
+        patch("subprocess.run"),
+    ):
+        # a single mock records the app host and edge commands in order
+        edge_connection.return_value.__enter__.return_value = mock_connection
+        Deploy()()
+
+    assert edge_connection.call_args.kwargs["host"].ip == "10.0.0.1"
+    commands = get_commands(mock_connection.mock_calls)
+    restart = next(i for i, c in enumerate(commands) if "systemctl restart" in c)
+    drain, restore = commands[restart - 1], commands[restart + 1]
+    assert "reverse_proxy 10.0.0.3:8000 {" in drain
+    assert "reverse_proxy 10.0.0.2:8000 10.0.0.3:8000 {" in restore
+    assert "lb_policy weighted_round_robin 2 1" in restore
+    assert restore.endswith(
+        "sudo tee /etc/caddy/conf.d/testapp.caddy > /dev/null && sudo systemctl reload caddy"
+    )
+
+
+def test_deploy_restores_the_edge_when_the_restart_fails(
+    mock_config, mock_connection, get_commands
+):
+    mock_config.edge = EdgeConfig(
+        ip="10.0.0.1",
+        user="edge",
+        backends=[EdgeBackend(address="10.0.0.2:8000")],
+        backend="10.0.0.2:8000",
+    )
+    with (
+        patch("fujin.caddy.host_connection") as edge_connection,
+        patch.object(Deploy, "restart_services", side_effect=cappa.Exit("boom")),
+        patch("subprocess.run"),
+        pytest.raises(cappa.Exit) as exc,
+    ):
+        edge_connection.return_value.__enter__.return_value = mock_connection
+        Deploy()()
+
+    assert exc.value.message == "boom"
+    drain, restore = get_commands(mock_connection.mock_calls)[-2:]
+    assert "10.0.0.2:8000" not in drain
+    assert "reverse_proxy 10.0.0.2:8000 {" in restore
+
+
+def test_deploy_blue_green_switches_traffic_to_the_idle_color(
+    mock_config, mock_connection, get_commands, remote_state_output
+):
+    mock_config.webserver = Webserver(
+        port_base=8000,
+        blue_green=BlueGreenConfig(readiness_path="/up", grace_period=10),
+    )
+    output = remote_state_output(loaded=["testapp@blue-1.service"])
+    mock_connection.run.return_value.stdout = f"{output}\n::color::\nblue"
+    with patch("subprocess.run"):
+        Deploy()()
+
+    commands = get_commands(mock_connection.mock_calls)
+    assert (
+        "sudo systemctl enable --now testapp-worker@1.service testapp-worker@2.service"
+        in commands
+    )
+    assert (
+        "sudo systemctl restart testapp-worker@1.service testapp-worker@2.service"
+        in commands
+    )
+    (ready,) = [c for c in commands if "ready http://localhost:8002/up" in c]
+    assert "sudo systemctl restart testapp@green-1.service" in ready
+    switch = commands[commands.index(ready) + 1]
+    assert "reverse_proxy localhost:8002" in switch
+    assert switch.endswith(
+        "&& sudo systemctl reload caddy"
+        ' && echo "::switched:: $(( ($(date +%s%N) - start) / 1000000 ))"'
+        " && echo green > /home/testuser/.local/share/fujin/testapp/.color"
+        " && sudo systemctl enable testapp@green-1.service"
+        " && sleep 10 && sudo systemctl disable --now testapp@blue-1.service"
+    )
+    # the live color is not a stale unit, caddy is not configured a second time
+    assert not any(
+        c.startswith("sudo systemctl disable")
+        for c in commands[: commands.index(ready)]
+    )
+    assert [c for c in commands if "reload caddy" in c] == [switch]
+
+
+def test_deploy_blue_green_restores_the_caddyfile_when_the_reload_fails(
+    mock_config, mock_connection, get_commands, remote_state_output
+):
+    mock_config.webserver = Webserver(port_base=8000, blue_green=BlueGreenConfig())
+    output = f"{remote_state_output()}\n::color::\nblue"
+
+    def run(command, **kwargs):
+        if "::switched::" in command:
+            return MagicMock(ok=False, stdout="")
+        return MagicMock(ok=True, stdout=output)
+
+    mock_connection.run.side_effect = run
+    with patch("subprocess.run"), pytest.raises(cappa.Exit) as exc_info:
+        Deploy()()
+
+    assert exc_info.value.message == (
+        "Failed to point Caddy at the green instances, traffic stays on blue"
+    )
+    commands = get_commands(mock_connection.mock_calls)
+    switch = next(i for i, c in enumerate(commands) if "::switched::" in c)
+    restore, stop = commands[switch + 1 : switch + 3]
+    assert "reverse_proxy localhost:8001" in restore
+    assert restore.endswith(
+        f"| sudo tee {mock_config.caddy_config_path} > /dev/null && sudo systemctl reload caddy"
+    )
+    assert stop == "sudo systemctl stop testapp@green-1.service"
+
+
+def test_deploy_warms_up_the_restarted_processes(
+    mock_config, mock_connection, get_commands, capsys
+):
+    mock_config.processes["web"].warmup = WarmupConfig(urls=["/", "/up"], requests=3)
+    mock_config.processes["worker"].warmup = WarmupConfig(
+        command="python -c 'import myapp.tasks'", requests=1
+    )
+    mock_connection.run.return_value.stdout = "\n".join(
+        [
+            "::warmup:: web http:200 1.250000",
+            "::warmup:: web http:502 0.100000",
+            "::warmup:: web http:200 0.045000",
+            "::warmup:: worker exit:0 0.800000",
+        ]
+    )
+    with patch("subprocess.run"):
+        Deploy()()
+
+    commands = get_commands(mock_connection.mock_calls)
+    restart = next(i for i, c in enumerate(commands) if "systemctl restart" in c)
+    warmup = commands[restart + 1]
+    assert warmup.startswith(
+        "cd /home/testuser/.local/share/fujin/testapp && for i in $(seq 3); do curl -s -o /dev/null"
+    )
+    assert "http://localhost:8000/up" in warmup
+    assert (
+        "; cd /home/testuser/.local/share/fujin/testapp && for i in $(seq 1)" in warmup
+    )
+    assert (
+        "(source .appenv && python -c 'import myapp.tasks') > /dev/null 2>&1" in warmup
+    )
+    out = capsys.readouterr().out
+    assert "web warm-up: 3 requests, first 1250 ms, last 45 ms, 1 failed" in out
+    assert "worker warm-up: 1 requests, first 800 ms, last 800 ms" in out
+
+
+def test_deploy_reloads_processes_unless_their_unit_changed(
+    mock_config, mock_connection, get_commands, remote_state_output
+):
+    mock_config.processes["web"].restart_strategy = "reload"
+    mock_config.processes["worker"].restart_strategy = "reload"
+    units = mock_config.render_systemd_units()
+    output = remote_state_output()
+    # the worker template is unchanged, the web one differs from the host
+    output = output.replace(
+        "::units::",
+        "::units::\n"
+        f"{echoed_hash(units['testapp-worker@.service'])}  /etc/systemd/system/testapp-worker@.service\n"
+        "abc  /etc/systemd/system/testapp.service",
+    ).replace(
+        "::env::",
+        f"::env::\n{echoed_hash(mock_config.host.env_content)}  /apps/testapp/.env",
+    )
+    mock_connection.run.return_value.stdout = output
+    with patch("subprocess.run"):
+        Deploy()()
+
+    commands = get_commands(mock_connection.mock_calls)
+    assert (
+        "sudo systemctl restart testapp.service && "
+        "sudo systemctl reload-or-restart testapp-worker@1.service testapp-worker@2.service"
+        in commands
+    )
+    assert "ExecReload=/bin/kill -s HUP $MAINPID" in units["testapp-worker@.service"]
+
+
+def test_deploy_restarts_reloaded_processes_when_the_env_changed(
+    mock_config, mock_connection, get_commands, remote_state_output
+):
+    mock_config.processes["worker"].restart_strategy = "reload"
+    units = mock_config.render_systemd_units()
+    output = remote_state_output().replace(
+        "::units::",
+        "::units::\n"
+        + "\n".join(
+            f"{echoed_hash(content)}  /etc/systemd/system/{filename}"
+            for filename, content in units.items()
+        ),
+    )
+    # only the .env differs from the host
+    mock_connection.run.return_value.stdout = output.replace(
+        "::env::", "::env::\nabc  /apps/testapp/.env"
+    )
+    with patch("subprocess.run"):
+        Deploy()()
+
+    commands = get_commands(mock_connection.mock_calls)
+    assert not any("reload-or-restart" in c for c in commands)
+    assert (
+        "sudo systemctl restart testapp.service testapp-worker@1.service testapp-worker@2.service"
+        in commands
+    )
+
+
+def test_deploy_counts_caddy_server_errors_during_the_restart(
+    mock_connection, get_commands, capsys
+):
+    def run(command, **kwargs):
+        if "::versions::" in command:
+            return MagicMock(ok=True, stdout="::5xx::\n3\n")
+        if "caddy_http_request_duration_seconds_count" in command:
+            return MagicMock(ok=True, stdout="5\n")
+        return MagicMock(ok=True, stdout="")
+
+    mock_connection.run.side_effect = run
+    with patch("subprocess.run"):
+        Deploy()()
+
+    commands = get_commands(mock_connection.mock_calls)
+    # the first sample is part of the preflight, only the second one is extra
+    samples = [
+        i
+        for i, c in enumerate(commands)
+        if "caddy_http_request_duration_seconds_count" in c and "::versions::" not in c
+    ]
+    restart = next(i for i, c in enumerate(commands) if "systemctl restart" in c)
+    assert samples == [restart + 1]
+    assert "Caddy returned 2 5xx responses during the deploy" in capsys.readouterr().out
+
+
+@pytest.fixture
+def http_server():
+    """A local http server answering with the status stored on the server."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(self.server.status)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.status = 200
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_deploy_verifies_zero_downtime(mock_connection, http_server, capsys):
+    url = f"http://127.0.0.1:{http_server.server_port}/"
+    with patch("subprocess.run"), patch("fujin.loadgen.SETTLE_SECONDS", 0.2):
+        Deploy(verify_zero_downtime=True, verify_url=url)()
+
+    out = capsys.readouterr().out
+    assert f"Requests to {url}" in out
+    for window in ("before", "during", "after"):
+        assert window in out
+    assert "No failed requests, zero downtime verified." in out
+
+
+def test_deploy_verify_zero_downtime_fails_on_server_errors(
+    mock_connection, http_server
+):
+    http_server.status = 502
+    url = f"http://127.0.0.1:{http_server.server_port}/"
+    with (
+        patch("subprocess.run"),
+        patch("fujin.loadgen.SETTLE_SECONDS", 0.2),
+        pytest.raises(cappa.Exit) as exc_info,
+    ):
+        Deploy(verify_zero_downtime=True, verify_url=url)()
+    assert exc_info.value.message.endswith("requests failed during the deploy")
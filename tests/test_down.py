@@ -25,7 +25,7 @@ def test_down_removes_files_and_stops_services(mock_connection, get_commands):
                 "sudo rm /etc/caddy/conf.d/testapp.caddy",
                 "sudo systemctl reload caddy",
                 "sudo systemctl disable --now testapp.service testapp-worker@1.service testapp-worker@2.service",
-                "sudo rm /etc/systemd/system/testapp.service /etc/systemd/system/testapp-worker@.service",
+                "sudo rm -rf /etc/systemd/system/testapp.service /etc/systemd/system/testapp-worker@.service",
                 "sudo systemctl daemon-reload",
                 "sudo systemctl reset-failed",
             ]
@@ -43,7 +43,7 @@ def test_down_full_uninstall_proxy(mock_connection, get_commands):
                 "sudo rm /etc/caddy/conf.d/testapp.caddy",
                 "sudo systemctl reload caddy",
                 "sudo systemctl disable --now testapp.service testapp-worker@1.service testapp-worker@2.service",
-                "sudo rm /etc/systemd/system/testapp.service /etc/systemd/system/testapp-worker@.service",
+                "sudo rm -rf /etc/systemd/system/testapp.service /etc/systemd/system/testapp-worker@.service",
                 "sudo systemctl daemon-reload",
                 "sudo systemctl reset-failed",
                 "sudo systemctl stop caddy",
@@ -1,15 +1,16 @@
+import time
 from unittest.mock import patch, MagicMock
 from fujin.commands.rollback import Rollback
 from inline_snapshot import snapshot
 
+from fujin import history
 
-def test_rollback(mock_connection, get_commands):
+
+def test_rollback(mock_connection, get_commands, remote_state_output):
     def run_side_effect(command, **kwargs):
         mock = MagicMock()
-        if "sed -n '2,$p' .versions" in command:
-            mock.stdout = "0.0.9\n0.0.8"
-        elif "head -n 1 .versions" in command:
-            mock.stdout = "0.1.0"
+        if "::versions::" in command:
+            mock.stdout = remote_state_output(versions=["0.1.0", "0.0.9", "0.0.8"])
         else:
             mock.stdout = ""
         return mock
@@ -25,9 +26,18 @@ def test_rollback(mock_connection, get_commands):
 
         assert get_commands(mock_connection.mock_calls) == snapshot(
             [
-                "sed -n '2,$p' .versions",
-                "head -n 1 .versions",
-                "mkdir -p /home/testuser/.local/share/fujin/testapp/v0.0.9",
+                """\
+echo '::versions::'; { cat /home/testuser/.local/share/fujin/testapp/.versions; } 2>/dev/null
+echo '::requirements::'; { md5sum /home/testuser/.local/share/fujin/testapp/v$(head -n 1 /home/testuser/.local/share/fujin/testapp/.versions 2>/dev/null)/requirements.txt; } 2>/dev/null
+echo '::units::'; { md5sum /etc/systemd/system/testapp* /etc/systemd/system/testapp*.d/*.conf; } 2>/dev/null
+echo '::wants::'; { ls /etc/systemd/system/multi-user.target.wants/testapp*; } 2>/dev/null
+echo '::loaded::'; { systemctl list-units --full --all --plain --no-legend 'testapp*'; } 2>/dev/null
+echo '::caddy::'; { md5sum /etc/caddy/conf.d/testapp.caddy; } 2>/dev/null
+echo '::env::'; { md5sum /home/testuser/.local/share/fujin/testapp/.env; } 2>/dev/null
+echo '::host::'; { nproc; free -m | awk '/^Mem:/ {print $2}'; } 2>/dev/null
+echo '::color::'; { cat /home/testuser/.local/share/fujin/testapp/.color; } 2>/dev/null
+echo '::5xx::'; { curl -sf --max-time 1 http://localhost:2019/metrics | awk -v site='host="example.com"' '/^caddy_http_request_duration_seconds_count\\{/ && index($0, site) && index($0, "handler=\\"reverse_proxy\\"") {n++; if ($0 ~ /code="5/) s += $NF} END {if (n) printf "%d\\n", s}'; } 2>/dev/null\
+""",
                 """\
 echo 'set -a  # Automatically export all variables
 source .env
@@ -36,14 +46,32 @@ export UV_COMPILE_BYTECODE=1
 export UV_PYTHON=python3.12
 export PATH=".venv/bin:$PATH"' > /home/testuser/.local/share/fujin/testapp/.appenv\
 """,
-                "sudo rm -rf .venv",
-                "uv python install 3.12",
-                "uv venv",
+                "sudo rm -rf .venv && uv python install 3.12 && uv venv",
                 "uv pip install /home/testuser/.local/share/fujin/testapp/v0.0.9/testapp-0.0.9.whl",
-                "head -n 1 .versions",
-                "sed -i '1i 0.0.9' .versions",
                 "sudo systemctl restart testapp.service testapp-worker@1.service testapp-worker@2.service",
-                "rm -r v0.1.0",
-                "sed -i '1,/0.0.9/{/0.0.9/!d}' .versions",
+                "rm -r v0.1.0; sed -i '1,1d' .versions",
             ]
         )
+
+
+def test_rollback_recording_starts_after_the_prompts(
+    mock_config, mock_connection, remote_state_output
+):
+    mock_connection.run.return_value.stdout = remote_state_output(
+        versions=["0.1.0", "0.0.9"]
+    )
+
+    def slow_answer(*args, **kwargs):
+        time.sleep(0.3)
+        return True
+
+    with (
+        patch("rich.prompt.Prompt.ask", return_value="0.0.9"),
+        patch("rich.prompt.Confirm.ask", side_effect=slow_answer),
+    ):
+        Rollback()()
+
+    [record] = history.read(history.history_path(mock_config))
+    assert record.command == "rollback"
+    assert record.outcome == "success"
+    assert record.duration < 0.3
@@ -0,0 +1,167 @@
+"""
+Budgets of ssh round trips and sudo invocations per command and configuration shape.
+
+A round trip is a command run or a file transferred on the host. When a change makes a
+command exceed its budget, either batch the new remote calls or raise the budget here,
+so the cost is an explicit and reviewed part of the change.
+"""
+
+from pathlib import Path
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+
+from fujin.commands.app import App
+from fujin.commands.deploy import Deploy
+from fujin.commands.down import Down
+from fujin.commands.prune import Prune
+from fujin.commands.rollback import Rollback
+from fujin.config import ProcessConfig
+from fujin.plan import echoed_hash
+from fujin.plan import md5_hexdigest
+
+SHAPES = {
+    "single": {"web": ProcessConfig(command="run web")},
+    "replicas": {
+        "web": ProcessConfig(command="run web"),
+        "worker": ProcessConfig(command="run worker", replicas=4),
+    },
+    "many-processes": {
+        "web": ProcessConfig(command="run web"),
+        **{
+            f"worker{i}": ProcessConfig(command=f"run worker{i}", replicas=2)
+            for i in range(4)
+        },
+    },
+    "socket": {"web": ProcessConfig(command="run web", socket=True)},
+    "timer": {
+        "web": ProcessConfig(command="run web"),
+        "cleanup": ProcessConfig(command="run cleanup", timer="daily"),
+    },
+}
+
+# (command, shape) -> (round trips, sudo invocations)
+BUDGETS = {
+    ("deploy", "single"): (12, 7),
+    ("deploy", "replicas"): (12, 8),
+    ("deploy", "many-processes"): (12, 11),
+    ("deploy", "socket"): (12, 8),
+    ("deploy", "timer"): (12, 9),
+    ("redeploy", "single"): (7, 2),
+    ("redeploy", "replicas"): (7, 2),
+    ("redeploy", "many-processes"): (7, 2),
+    ("redeploy", "socket"): (7, 2),
+    ("redeploy", "timer"): (7, 2),
+    ("rollback", "single"): (6, 1),
+    ("rollback", "replicas"): (6, 1),
+    ("rollback", "many-processes"): (6, 1),
+    ("rollback", "socket"): (6, 1),
+    ("rollback", "timer"): (6, 1),
+    ("prune", "single"): (2, 0),
+    ("prune", "replicas"): (2, 0),
+    ("prune", "many-processes"): (2, 0),
+    ("prune", "socket"): (2, 0),
+    ("prune", "timer"): (2, 0),
+    ("app info", "single"): (1, 0),
+    ("app info", "replicas"): (1, 0),
+    ("app info", "many-processes"): (1, 0),
+    ("app info", "socket"): (1, 0),
+    ("app info", "timer"): (1, 0),
+    ("app restart", "single"): (1, 1),
+    ("app restart", "replicas"): (1, 1),
+    ("app restart", "many-processes"): (1, 1),
+    ("app restart", "socket"): (1, 1),
+    ("app restart", "timer"): (1, 1),
+    ("down", "single"): (7, 6),
+    ("down", "replicas"): (7, 6),
+    ("down", "many-processes"): (7, 6),
+    ("down", "socket"): (7, 6),
+    ("down", "timer"): (7, 6),
+}
+
+
+def count_round_trips(conn: MagicMock) -> tuple[int, int]:
+    round_trips = sudo = 0
+    for name, args, kwargs in conn.mock_calls:
+        if name not in ("run", "put"):
+            continue
+        round_trips += 1
+        if name == "run":
+            command = args[0] if args else kwargs.get("command", "")
+            sudo += command.count("sudo ")
+    return round_trips, sudo
+
+
+def host_output(config, *, versions, up_to_date=False) -> str:
+    """Preflight output of a host that runs ``versions``, with files matching the config when ``up_to_date``."""
+    lines = ["::versions::", *versions, "::requirements::"]
+    if up_to_date and config.requirements:
+        requirements = Path(config.requirements).read_bytes()
+        lines.append(f"{md5_hexdigest(requirements)}  r")
+    lines.append("::units::")
+    if up_to_date:
+        for filename, content in config.render_systemd_units().items():
+            lines.append(f"{echoed_hash(content)}  /etc/systemd/system/{filename}")
+    lines.append("::wants::")
+    lines.append("::loaded::")
+    if up_to_date:
+        lines += [
+            f"{unit} loaded active running" for unit in config.active_systemd_units
+        ]
+    lines.append("::caddy::")
+    if up_to_date:
+        lines.append(f"{echoed_hash(config.render_caddyfile())}  c")
+    lines.append("::env::")
+    if up_to_date:
+        lines.append(f"{echoed_hash(config.host.env_content)}  e")
+    return "\n".join(lines)
+
+
+def run(command: str, config, conn: MagicMock) -> None:
+    previous = ["0.0.9", "0.0.8"]
+    if command == "deploy":
+        conn.run.return_value.stdout = host_output(config, versions=[])
+    elif command in ("redeploy", "rollback"):
+        conn.run.return_value.stdout = host_output(
+            config, versions=[config.version, *previous], up_to_date=True
+        )
+    else:
+        conn.run.return_value.stdout = "0.0.8\n0.0.7"
+
+    with (
+        patch("subprocess.run"),
+        patch("rich.prompt.Prompt.ask", return_value="0.0.9"),
+        patch("rich.prompt.Confirm.ask", return_value=True),
+    ):
+        if command in ("deploy", "redeploy"):
+            Deploy()()
+        elif command == "rollback":
+            Rollback()()
+        elif command == "prune":
+            Prune()()
+        elif command == "app info":
+            App().info()
+        elif command == "app restart":
+            App().restart()
+        elif command == "down":
+            Down()()
+
+
+@pytest.mark.parametrize(("command", "shape"), list(BUDGETS))
+def test_round_trip_budget(command, shape, mock_config, mock_connection, tmp_path):
+    requirements = tmp_path / "requirements.txt"
+    requirements.write_text("django")
+    mock_config.requirements = str(requirements)
+    mock_config.processes = SHAPES[shape]
+
+    run(command, mock_config, mock_connection)
+
+    max_round_trips, max_sudo = BUDGETS[(command, shape)]
+    round_trips, sudo = count_round_trips(mock_connection)
+    assert round_trips <= max_round_trips, (
+        f"{command} ({shape}) made {round_trips} round trips, budget is {max_round_trips}"
+    )
+    assert sudo <= max_sudo, (
+        f"{command} ({shape}) invoked sudo {sudo} times, budget is {max_sudo}"
+    )
@@ -0,0 +1,55 @@
+from fujin import history
+from fujin.commands.stats import Stats
+
+
+def _record(mock_config, build: float, **kwargs) -> history.HistoryRecord:
+    return history.HistoryRecord(
+        timestamp=0,
+        command=kwargs.pop("command", "deploy"),
+        app=mock_config.app_name,
+        host=mock_config.host.ip,
+        version="0.1.0",
+        outcome=kwargs.pop("outcome", "success"),
+        duration=build + 1,
+        steps={"build": build, "restart": 1.0},
+        **kwargs,
+    )
+
+
+def test_percentile():
+    assert history.percentile([], 50) == 0.0
+    assert history.percentile([1.0, 2.0, 3.0, 4.0], 50) == 2.5
+    assert history.percentile([1.0, 2.0, 3.0, 4.0], 100) == 4.0
+
+
+def test_history_roundtrip_skips_partial_lines(mock_config):
+    path = history.history_path(mock_config)
+    history.append(path, _record(mock_config, 1.0))
+    with path.open("ab") as f:
+        f.write(b'{"timestamp": 1, "comm')
+    assert len(history.read(path)) == 1
+
+
+def test_history_is_ignored_by_git(mock_config):
+    path = history.history_path(mock_config)
+    history.append(path, _record(mock_config, 1.0))
+    assert (path.parent / ".gitignore").read_text() == "*\n"
+    assert not (mock_config.local_config_dir / ".gitignore").exists()
+
+
+def test_stats_flags_regressed_steps(mock_config, capsys):
+    path = history.history_path(mock_config)
+    for build in (1.0, 1.1, 0.9):
+        history.append(path, _record(mock_config, build))
+    history.append(path, _record(mock_config, 5.0, outcome="failure"))
+    history.append(path, _record(mock_config, 9.0, command="rollback"))
+    history.append(path, _record(mock_config, 2.5))
+
+    Stats()()
+
+    output = capsys.readouterr().out
+    build_row = next(line for line in output.splitlines() if "build" in line)
+    assert "regressed x2.5" in build_row
+    restart_row = next(line for line in output.splitlines() if "restart" in line)
+    assert "regressed" not in restart_row
+    assert "1 failed" in output